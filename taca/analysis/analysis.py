@@ -1,13 +1,19 @@
 """ Analysis methods for TACA """
+import contextlib
 import csv
+import fcntl
 import glob
+import json
 import logging
 import os
 import re
 import subprocess
+import tempfile
+import time
 import taca.utils.undetermined as ud
 import flowcell_parser.db as fcpdb
 
+from collections import OrderedDict
 from datetime import datetime
 
 import requests
@@ -15,11 +21,22 @@ import requests
 from taca.illumina import Run
 from taca.utils.filesystem import chdir, control_fastq_filename
 from taca.utils.config import CONFIG
-from taca.utils import misc
+from taca.utils import connections, filesystem, misc, transfer
 from flowcell_parser.classes import XTenRunParametersParser,XTenSampleSheetParser,XTenParser 
 
 logger = logging.getLogger(__name__)
 
+# List of the files sent to the analysis server, relative to the parent of the run
+TRANSFER_MANIFEST = 'transfer_manifest.txt'
+# Files already sent by transfer_lanes while demultiplexing was running
+LANES_MANIFEST = 'transferred_lanes.tsv'
+# Analysis triggers waiting to be acknowledged by the analysis server, and
+# the log of every trigger attempt, both in the status directory
+TRIGGER_QUEUE = 'trigger_queue.tsv'
+TRIGGER_LOG = 'triggers.tsv'
+# Index of the LIMS samplesheets, in the status directory
+SAMPLESHEET_INDEX = 'samplesheets_index.json'
+
 
 def is_transferred(run, transfer_file):
     """ Checks wether a run has been transferred to the analysis server or not.
@@ -48,23 +65,18 @@ def transfer_run(run, analysis=True):
     by any user/account in that group (i.e a functional account...). Run will be
     moved to data_dir/nosync after transferred.
 
+    The files to transfer are resolved locally from the sync include patterns
+    into a manifest, which is then given to rsync with ``--files-from``, so that
+    rsync does not need to walk and filter the whole run directory on both ends.
+
     :param str run: Run directory
     :param bool analysis: Trigger analysis on remote server
     """
-    command_line = ['rsync', '-av']
-    # Add R/W permissions to the group
-    command_line.append('--chmod=g+rw')
-    # rsync works in a really funny way, if you don't understand this, refer to
-    # this note: http://silentorbit.com/notes/2013/08/rsync-by-extension/
-    command_line.append("--include=*/")
-    for to_include in CONFIG['analysis']['analysis_server']['sync']['include']:
-        command_line.append("--include={}".format(to_include))
-    command_line.extend(["--exclude=*", "--prune-empty-dirs"])
+    sync_conf = CONFIG['analysis']['analysis_server']['sync']
     r_user = CONFIG['analysis']['analysis_server']['user']
     r_host = CONFIG['analysis']['analysis_server']['host']
-    r_dir = CONFIG['analysis']['analysis_server']['sync']['data_archive']
+    r_dir = sync_conf['data_archive']
     remote = "{}@{}:{}".format(r_user, r_host, r_dir)
-    command_line.extend([run, remote])
 
     # Create temp file indicating that the run is being transferred
     try:
@@ -78,10 +90,25 @@ def transfer_run(run, analysis=True):
     # In this particular case we want to capture the exception because we want
     # to delete the transfer file
     try:
-        misc.call_external_command(command_line, with_log_files=True)
-    except subprocess.CalledProcessError as exception:
+        files = filesystem.list_files_to_sync(run, sync_conf['include'],
+                                              skip=sync_conf.get('skip_dirs', []))
+        # Leave out what transfer_lanes already sent and has not changed since
+        sent = _read_lanes_manifest(run)
+        files = [(f, size) for f, size in files if sent.get(f) != _file_signature(run, f)]
+        manifest = _write_manifest(os.path.join(run, TRANSFER_MANIFEST),
+                                   [f for f, size in files])
+        with transfer.TransferGovernor().slot('analysis') as bwlimit:
+            streams = sync_conf.get('streams', 1)
+            if streams > 1:
+                _transfer_in_parallel(run, remote, files, streams, bwlimit=bwlimit)
+            # Final pass, sends whatever the parallel streams left behind and
+            # brings the metadata up to date
+            _transfer_manifest(run, manifest, remote, retries=sync_conf.get('retries', 0),
+                               validate=sync_conf.get('validate', False), bwlimit=bwlimit)
+    except:
+        # Left behind, the marker would make the run look transferred forever
         os.remove(os.path.join(run, 'transferring'))
-        raise exception
+        raise
 
     t_file = os.path.join(CONFIG['analysis']['status_dir'], 'transfer.tsv')
     logger.info('Adding run {} to {}'
@@ -97,8 +124,210 @@ def transfer_run(run, analysis=True):
     if analysis:
         trigger_analysis(run)
 
+
+def transfer_lanes(run, lanes):
+    """ Transfer the FASTQ files of some lanes while demultiplexing is still running
+
+    Only files whose names are final are sent, that is, neither the Undetermined
+    files nor the files that control_fastq_filename will rename. Everything sent
+    is recorded, so that the final transfer_run only sends the remaining lanes
+    and the stats.
+
+    :param str run: Run directory
+    :param list lanes: Lanes that bcl2fastq has finished with
+    """
+    if not lanes:
+        return
+    sync_conf = CONFIG['analysis']['analysis_server']['sync']
+    remote = "{}@{}:{}".format(CONFIG['analysis']['analysis_server']['user'],
+                               CONFIG['analysis']['analysis_server']['host'],
+                               sync_conf['data_archive'])
+    lanes_re = re.compile('_L0[01]({})_'.format('|'.join(str(l) for l in lanes)))
+    hyphen_re = re.compile(filesystem.HYPHEN_FASTQ_RE)
+    sent = _read_lanes_manifest(run)
+    files = []
+    for f, size in filesystem.list_files_to_sync(run, sync_conf['include'],
+                                                 skip=sync_conf.get('skip_dirs', [])):
+        name = os.path.basename(f)
+        if f in sent or not lanes_re.search(name) or \
+                name.startswith('Undetermined') or hyphen_re.search(name):
+            continue
+        files.append(f)
+    if not files:
+        return
+    logger.info('Transferring {} files of lanes {} of run {} while demultiplexing is running'
+                .format(len(files), ', '.join(str(l) for l in lanes), os.path.basename(run)))
+    fd, manifest = tempfile.mkstemp(prefix='{}_lanes_'.format(os.path.basename(run)))
+    os.close(fd)
+    try:
+        _write_manifest(manifest, files)
+        with transfer.TransferGovernor().slot('analysis') as bwlimit:
+            _transfer_manifest(run, manifest, remote, retries=sync_conf.get('retries', 0),
+                               bwlimit=bwlimit)
+    finally:
+        os.remove(manifest)
+    with open(os.path.join(run, LANES_MANIFEST), 'a') as lanes_file:
+        tsv_writer = csv.writer(lanes_file, delimiter='\t')
+        for f in files:
+            tsv_writer.writerow([f] + list(_file_signature(run, f)))
+
+
+def _file_signature(run, path):
+    """ Size and modification time of a file, to tell if it changed since it was sent
+
+    :param str run: Run directory
+    :param str path: File path relative to the parent of the run
+    :returns: A (size, mtime) tuple of strings, or None if the file does not exist
+    """
+    try:
+        st = os.lstat(os.path.join(os.path.dirname(os.path.abspath(run)), path))
+    except OSError:
+        return None
+    return (str(st.st_size), str(int(st.st_mtime)))
+
+
+def _read_lanes_manifest(run):
+    """ Read the files sent by transfer_lanes
+
+    :param str run: Run directory
+    :returns: Dictionary path -> (size, mtime)
+    :rtype: dict
+    """
+    sent = {}
+    try:
+        with open(os.path.join(run, LANES_MANIFEST), 'r') as lanes_file:
+            for row in csv.reader(lanes_file, delimiter='\t'):
+                sent[row[0]] = tuple(row[1:3])
+    except IOError:
+        pass
+    return sent
+
+
+def _write_manifest(manifest, files):
+    """ Write a list of files, one per line, as expected by rsync --files-from
+
+    :param str manifest: Path to the manifest file
+    :param list files: Paths relative to the parent directory of the run
+    :returns: The path to the manifest
+    """
+    with open(manifest, 'w') as f:
+        for path in files:
+            f.write('{}\n'.format(path))
+    return manifest
+
+
+def _rsync_command(run, manifest, remote, *options, **kwargs):
+    """ Build the rsync command line to transfer the files listed in a manifest
+
+    :param str run: Run directory
+    :param str manifest: Path to the manifest, with paths relative to the parent of the run
+    :param str remote: rsync destination, i.e user@host:/path
+    :param options: Extra options for rsync
+    :param int bwlimit: Bandwidth limit in KB/s, if any
+    """
+    # Add R/W permissions to the group
+    command_line = ['rsync', '-av', '--chmod=g+rw', '--files-from={}'.format(manifest)]
+    command_line.extend(options)
+    if kwargs.get('bwlimit'):
+        command_line.append('--bwlimit={}'.format(kwargs['bwlimit']))
+    command_line.extend([os.path.dirname(os.path.abspath(run)), remote])
+    return command_line
+
+
+def _transfer_manifest(run, manifest, remote, retries=0, validate=False, bwlimit=None):
+    """ Transfer the files listed in a manifest, retrying failed transfers
+
+    rsync only sends what is missing or changed on the destination, so each
+    retry resumes where the previous attempt stopped.
+
+    :param str run: Run directory
+    :param str manifest: Path to the manifest
+    :param str remote: rsync destination, i.e user@host:/path
+    :param int retries: Number of times to retry a failed or incomplete transfer
+    :param bool validate: Check with a dry run that no file is left to transfer
+    :param int bwlimit: Bandwidth limit in KB/s, if any
+    :raises subprocess.CalledProcessError: If the transfer still fails after all retries
+    """
+    for attempt in range(retries + 1):
+        try:
+            misc.call_external_command(_rsync_command(run, manifest, remote, '--partial',
+                                                      bwlimit=bwlimit),
+                                       with_log_files=True)
+        except subprocess.CalledProcessError as e:
+            if attempt == retries:
+                raise e
+            logger.warn('Transfer of run {} failed, retrying ({}/{})'
+                        .format(os.path.basename(run), attempt + 1, retries))
+            continue
+        if not validate:
+            return
+        pending = _pending_files(run, manifest, remote)
+        if not pending:
+            logger.info('All files of run {} are on the analysis server'
+                        .format(os.path.basename(run)))
+            return
+        logger.warn('{} files of run {} are still not transferred'
+                    .format(len(pending), os.path.basename(run)))
+    raise subprocess.CalledProcessError(1, 'rsync')
+
+
+def _pending_files(run, manifest, remote):
+    """ List the files of a manifest that differ between the run and the destination
+
+    :param str run: Run directory
+    :param str manifest: Path to the manifest
+    :param str remote: rsync destination, i.e user@host:/path
+    :returns: Files that rsync would still transfer
+    :rtype: list
+    """
+    command_line = _rsync_command(run, manifest, remote, '--dry-run', '--out-format=%n')
+    # Replace the verbose flag so that only the file names are printed
+    command_line[1] = '-a'
+    output = subprocess.check_output(command_line)
+    return [l for l in output.splitlines() if l and not l.endswith('/')]
+
+
+def _transfer_in_parallel(run, remote, files, streams, bwlimit=None):
+    """ Transfer the files of a run using several rsync processes at once
+
+    The files to include are split in groups of about the same total size,
+    and each group is sent by its own rsync process.
+
+    :param str run: Run directory
+    :param str remote: rsync destination, i.e user@host:/path
+    :param list files: List of (path, size) tuples, as given by filesystem.list_files_to_sync
+    :param int streams: Number of simultaneous rsync processes
+    :param int bwlimit: Bandwidth limit in KB/s for all the streams together, if any
+    :raises subprocess.CalledProcessError: If any of the rsync processes fails
+    """
+    run_name = os.path.basename(os.path.abspath(run))
+    shards = [shard for shard in filesystem.split_by_size(files, streams) if shard]
+    logger.info('Transferring {} files of run {} in {} parallel streams'
+                .format(len(files), run_name, len(shards)))
+    shard_files = []
+    handles = []
+    try:
+        for i, shard in enumerate(shards):
+            fd, shard_file = tempfile.mkstemp(prefix='{}_stream{}_'.format(run_name, i))
+            os.close(fd)
+            shard_files.append(_write_manifest(shard_file, shard))
+            handles.append(misc.call_external_command_detached(
+                _rsync_command(run, shard_file, remote,
+                               bwlimit=bwlimit and max(1, bwlimit / len(shards))),
+                with_log_files=True, prefix='{}_stream{}'.format(run_name, i)))
+        failed = [p.returncode for p in handles if p.wait() != 0]
+    finally:
+        for shard_file in shard_files:
+            os.remove(shard_file)
+    if failed:
+        raise subprocess.CalledProcessError(failed[0], 'rsync')
+
+
 def archive_run(run):
-    
+    """ Move a run to the archive directory of its run type
+
+    :param str run: Run directory
+    """
     rppath=os.path.join(run, 'runParameters.xml')
     try:
         rp=XTenRunParametersParser(os.path.join(run, 'runParameters.xml'))
@@ -124,11 +353,17 @@ def archive_run(run):
 
         if destination:
             logger.info('archiving run {}'.format(run))
-            os.move(os.path.abspath(run), os.path.join(destination, os.path.basename(os.path.abspath(run))))
+            filesystem.move_tree(os.path.abspath(run),
+                                 os.path.join(destination, os.path.basename(os.path.abspath(run))),
+                                 workers=CONFIG['storage'].get('move_workers', 8))
 
 def trigger_analysis(run_id):
     """ Trigger the analysis of the flowcell in the analysis sever.
 
+    The flowcell is added to a persistent queue of triggers, and every trigger
+    in the queue that is due is then sent, so that a flowcell whose trigger
+    fails is retried later instead of being forgotten.
+
     :param str run_id: run/flowcell id
     """
     if not CONFIG.get('analysis', {}).get('analysis_server', {}):
@@ -136,30 +371,126 @@ def trigger_analysis(run_id):
                      "Not triggering analysis of {}"
                      .format(os.path.basename(run_id))))
     else:
-        url = ("http://{host}:{port}/flowcell_analysis/{dir}"
-               .format(host=CONFIG['analysis']['analysis_server']['host'],
-                       port=CONFIG['analysis']['analysis_server']['port'],
-                       dir=os.path.basename(run_id)))
-        params = {'path': CONFIG['analysis']['analysis_server']['sync']['data_archive']}
-        try:
-            r = requests.get(url, params=params)
-            if r.status_code != requests.status_codes.codes.OK:
-                logger.warn(("Something went wrong when triggering the "
-                             "analysis of {}. Please check the logfile "
-                             "and make sure to start the analysis!"
-                             .format(os.path.basename(run_id))))
-            else:
+        with _locked_trigger_queue() as queue:
+            if os.path.basename(run_id) not in queue:
+                queue[os.path.basename(run_id)] = (0, 0)
+        process_trigger_queue()
+
+
+def process_trigger_queue():
+    """ Send the queued analysis triggers that are due.
+
+    Triggers are sent in a single batched request if the analysis server
+    configuration has a ``trigger.batch_path``, one request per flowcell otherwise.
+    Only acknowledged triggers are added to analysis.tsv; failed ones are retried
+    with an exponential backoff, and given up (with an email) after
+    ``trigger.max_attempts`` attempts. Every attempt is logged, with its outcome
+    and latency, to triggers.tsv.
+    """
+    server = CONFIG.get('analysis', {}).get('analysis_server', {})
+    if not server:
+        return
+    trigger_conf = server.get('trigger', {})
+    max_attempts = trigger_conf.get('max_attempts', 10)
+    backoff = trigger_conf.get('backoff', 300)
+    max_delay = trigger_conf.get('max_delay', 6 * 3600)
+    with _locked_trigger_queue() as queue:
+        now = time.time()
+        due = [run_id for run_id, (attempts, next_attempt) in queue.items()
+               if next_attempt <= now]
+        if not due:
+            return
+        acknowledged = _send_triggers(due)
+        for run_id in due:
+            if run_id in acknowledged:
+                del queue[run_id]
                 logger.info('Analysis of flowcell {} triggered in {}'
-                            .format(os.path.basename(run_id),
-                                    CONFIG['analysis']['analysis_server']['host']))
+                            .format(run_id, server['host']))
                 a_file = os.path.join(CONFIG['analysis']['status_dir'], 'analysis.tsv')
                 with open(a_file, 'a') as analysis_file:
                     tsv_writer = csv.writer(analysis_file, delimiter='\t')
-                    tsv_writer.writerow([os.path.basename(run_id), str(datetime.now())])
-        except requests.exceptions.ConnectionError:
-            logger.warn(("Something went wrong when triggering the analysis "
-                         "of {}. Please check the logfile and make sure to "
-                         "start the analysis!".format(os.path.basename(run_id))))
+                    tsv_writer.writerow([run_id, str(datetime.now())])
+                continue
+            attempts = queue[run_id][0] + 1
+            if attempts >= max_attempts:
+                del queue[run_id]
+                msg = ("The analysis of flowcell {} could not be triggered in {} after {} "
+                       "attempts. Please make sure to start the analysis!"
+                       .format(run_id, server['host'], attempts))
+                logger.error(msg)
+                rcp = CONFIG.get('mail', {}).get('recipients')
+                if rcp:
+                    misc.send_mail("Analysis of {} not triggered".format(run_id), msg, rcp)
+            else:
+                delay = min(backoff * 2 ** (attempts - 1), max_delay)
+                queue[run_id] = (attempts, now + delay)
+                logger.warn(("Something went wrong when triggering the analysis "
+                             "of {}, retrying in {} seconds".format(run_id, delay)))
+
+
+def _send_triggers(run_ids):
+    """ Send analysis triggers to the analysis server
+
+    :param list run_ids: Flowcells to trigger
+    :returns: The flowcells whose trigger was acknowledged
+    :rtype: set
+    """
+    server = CONFIG['analysis']['analysis_server']
+    session = connections.get_session('analysis')
+    params = {'path': server['sync']['data_archive']}
+    batch_path = server.get('trigger', {}).get('batch_path')
+    if batch_path:
+        requests_to_send = [(run_ids, 'post', "http://{host}:{port}/{path}".format(
+            host=server['host'], port=server['port'], path=batch_path.lstrip('/')),
+            {'json': dict(params, flowcells=run_ids)})]
+    else:
+        requests_to_send = [([run_id], 'get', "http://{host}:{port}/flowcell_analysis/{dir}".format(
+            host=server['host'], port=server['port'], dir=run_id), {'params': params})
+            for run_id in run_ids]
+    acknowledged = set()
+    for runs, method, url, kwargs in requests_to_send:
+        started = time.time()
+        try:
+            r = getattr(session, method)(url, **kwargs)
+            status = r.status_code
+            outcome = 'OK' if status == requests.status_codes.codes.OK else 'FAILED'
+        except requests.exceptions.RequestException as e:
+            status = ''
+            outcome = type(e).__name__
+        latency = time.time() - started
+        if outcome == 'OK':
+            acknowledged.update(runs)
+        t_log = os.path.join(CONFIG['analysis']['status_dir'], TRIGGER_LOG)
+        with open(t_log, 'a') as log_file:
+            tsv_writer = csv.writer(log_file, delimiter='\t')
+            for run_id in runs:
+                tsv_writer.writerow([run_id, str(datetime.now()), outcome, status,
+                                     '{:.3f}'.format(latency)])
+    return acknowledged
+
+
+@contextlib.contextmanager
+def _locked_trigger_queue():
+    """ Context manager giving exclusive access to the trigger queue
+
+    The queue is a dictionary run_id -> (attempts, next attempt timestamp),
+    written back to the queue file when the context exits, also on errors, so
+    that the changes made until then (i.e triggers already acknowledged) are kept.
+    """
+    q_file = os.path.join(CONFIG['analysis']['status_dir'], TRIGGER_QUEUE)
+    with open(q_file, 'a+') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        queue = OrderedDict()
+        with open(q_file, 'r') as queue_file:
+            for row in csv.reader(queue_file, delimiter='\t'):
+                queue[row[0]] = (int(row[1]), float(row[2]))
+        try:
+            yield queue
+        finally:
+            with open(q_file, 'w') as queue_file:
+                tsv_writer = csv.writer(queue_file, delimiter='\t')
+                for run_id, (attempts, next_attempt) in queue.items():
+                    tsv_writer.writerow([run_id, attempts, next_attempt])
 
 
 def prepare_sample_sheet(run):
@@ -169,27 +500,35 @@ def prepare_sample_sheet(run):
         This function returns with success if the samplesheet is in the correct place, otherwise
         this flowcell will not be processed.
 
+        The LIMS samplesheet is looked up in an index of the samplesheets directory,
+        and the clean samplesheet is only generated again if the LIMS one changed
+        since it was last generated.
+
         :param str run: Run directory
     """
-    #start by checking if samplesheet is in the correct place
     run_name = os.path.basename(run)
-    current_year = '20' + run_name[0:2]
-    samplesheets_dir = os.path.join(CONFIG['analysis']['samplesheets_dir'],
-                                    current_year)
-
     run_name_componets = run_name.split("_")
     FCID = run_name_componets[3][1:]
-
-    FCID_samplesheet_origin = os.path.join(samplesheets_dir, FCID + '.csv')
     FCID_samplesheet_dest   = os.path.join(run, "SampleSheet.csv")
 
-    ss_reader=XTenSampleSheetParser(FCID_samplesheet_origin)
-    #check that the samplesheet is not already present
+    index = update_samplesheet_index(FCID)
+    entry = index['sheets'].get(FCID)
+    generated = index['generated'].get(run_name)
+    #check that the samplesheet is not already present, before parsing anything
     if os.path.exists(FCID_samplesheet_dest):
-        logger.warn(("When trying to generate SampleSheet.csv for sample "
-                     "sheet {}  looks like that SampleSheet.csv was already "
-                     "present in {} !!".format(FCID, FCID_samplesheet_dest)))
+        if not (entry and generated and generated != entry['sha1']):
+            logger.warn(("When trying to generate SampleSheet.csv for sample "
+                         "sheet {}  looks like that SampleSheet.csv was already "
+                         "present in {} !!".format(FCID, FCID_samplesheet_dest)))
+            return False
+        logger.info(("The LIMS samplesheet of {} changed since SampleSheet.csv "
+                     "was generated, generating it again".format(FCID)))
+    if not entry:
+        logger.warn("No samplesheet found for flowcell {} in {}"
+                    .format(FCID, CONFIG['analysis']['samplesheets_dir']))
         return False
+
+    ss_reader=XTenSampleSheetParser(entry['path'])
     try:
         with open(FCID_samplesheet_dest, 'wb') as fcd:
             fcd.write(ss_reader.generate_clean_samplesheet(fields_to_remove=['index2'], rename_samples=True))
@@ -197,11 +536,83 @@ def prepare_sample_sheet(run):
         logger.error(e.text)
         return False
 
-
+    index['generated'][run_name] = entry['sha1']
+    _save_samplesheet_index(index)
     # everything ended correctly
     return True
 
 
+def update_samplesheet_index(fcid=None):
+    """ Bring the index of the LIMS samplesheets up to date and return it
+
+    The index maps every flowcell id to the path, modification time and SHA1
+    of its samplesheet in the samplesheets directory (and its per year
+    subdirectories). Only directories modified since the last update are
+    listed, and only samplesheets modified since then are hashed again.
+
+    :param str fcid: Flowcell whose samplesheet should be checked for changes
+        even if its directory was not modified
+
+    :returns: The index, with keys 'sheets' (FCID -> path, mtime, sha1),
+        'dirs' (directory -> mtime) and 'generated' (run -> sha1 of the
+        samplesheet SampleSheet.csv was generated from)
+    :rtype: dict
+    """
+    index = _load_samplesheet_index()
+    ss_dir = CONFIG['analysis']['samplesheets_dir']
+    dirs = [ss_dir] + [os.path.join(ss_dir, d) for d in os.listdir(ss_dir)
+                       if os.path.isdir(os.path.join(ss_dir, d))]
+    changed = False
+    for d in dirs:
+        mtime = os.stat(d).st_mtime
+        if index['dirs'].get(d) == mtime:
+            continue
+        for f in glob.glob(os.path.join(d, '*.csv')):
+            sheet_fcid = os.path.splitext(os.path.basename(f))[0]
+            f_mtime = os.stat(f).st_mtime
+            entry = index['sheets'].get(sheet_fcid)
+            if entry and entry['path'] == f and entry['mtime'] == f_mtime:
+                continue
+            # The same flowcell in several directories, keep the newest samplesheet
+            if entry and entry['path'] != f and os.path.exists(entry['path']) and \
+                    entry['mtime'] > f_mtime:
+                continue
+            index['sheets'][sheet_fcid] = {'path': f, 'mtime': f_mtime,
+                                     'sha1': misc.hashfile(f, hasher='sha1')}
+        index['dirs'][d] = mtime
+        changed = True
+    # A samplesheet rewritten in place does not change its directory's mtime
+    entry = index['sheets'].get(fcid)
+    if entry:
+        try:
+            f_mtime = os.stat(entry['path']).st_mtime
+        except OSError:
+            del index['sheets'][fcid]
+            changed = True
+        else:
+            if f_mtime != entry['mtime']:
+                entry.update(mtime=f_mtime, sha1=misc.hashfile(entry['path'], hasher='sha1'))
+                changed = True
+    if changed:
+        _save_samplesheet_index(index)
+    return index
+
+
+def _load_samplesheet_index():
+    s_file = os.path.join(CONFIG['analysis']['status_dir'], SAMPLESHEET_INDEX)
+    try:
+        with open(s_file, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'sheets': {}, 'dirs': {}, 'generated': {}}
+
+
+def _save_samplesheet_index(index):
+    s_file = os.path.join(CONFIG['analysis']['status_dir'], SAMPLESHEET_INDEX)
+    with open('{}.tmp'.format(s_file), 'w') as f:
+        json.dump(index, f)
+    os.rename('{}.tmp'.format(s_file), s_file)
+
 
 def post_qc(run, qc_file, status):
     """ Checks wether a run has passed the final qc.
@@ -243,7 +654,7 @@ def upload_to_statusdb(run_dir):
     
      :param string run_dir: the run directory to upload
     """
-    couch = fcpdb.setupServer(CONFIG)
+    couch = connections.get_statusdb_server()
     db=couch[CONFIG['statusdb']['xten_db']]
     parser=XTenParser(run_dir)
     fcpdb.update_doc(db,parser.obj)
@@ -274,6 +685,13 @@ def run_preprocessing(run):
                 ud.check_undetermined_status(run.run_dir, dex_status=run.status, und_tresh=CONFIG['analysis']['undetermined']['lane_treshold'],
                     q30_tresh=CONFIG['analysis']['undetermined']['q30_treshold'], freq_tresh=CONFIG['analysis']['undetermined']['highest_freq'],
                     pooled_tresh=CONFIG['analysis']['undetermined']['pooled_und_treshold'])
+                if CONFIG['analysis']['analysis_server']['sync'].get('pipelined', False):
+                    try:
+                        transfer_lanes(run.run_dir, ud.get_workable_lanes(run.run_dir, run.status))
+                    except subprocess.CalledProcessError:
+                        logger.warn(("Could not transfer the finished lanes of run {}, "
+                                     "they will be sent with the rest of the run"
+                                     .format(run.id)))
             elif run.status == 'COMPLETED':
                 logger.info(("Preprocessing of run {} is finished, check if "
                              "run has been transferred and transfer it "
@@ -320,3 +738,7 @@ def run_preprocessing(run):
             runs = glob.glob(os.path.join(data_dir, '1*XX'))
             for _run in runs:
                 _process(Run(_run))
+    # Retry the analysis triggers that failed in previous passes
+    process_trigger_queue()
+    # Runs archived to another filesystem are still being deleted from this one
+    filesystem.deletion_queue().wait()
@@ -0,0 +1,607 @@
+""" Long term storage backends where run archives are sent
+"""
+import base64
+import binascii
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+import zlib
+
+from collections import OrderedDict
+
+from taca.utils import connections, filesystem, misc
+from taca.utils.config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from or written to a stream at a time
+CHUNK_SIZE = 4 * 1024 * 1024
+# Digests computed while an archive is written, and kept in its checksum manifest
+DIGESTS = ['adler32', 'md5', 'sha256']
+# Suffix of the checksum manifest written next to each archive
+CHECKSUM_SUFFIX = '.checksums.json'
+# Seconds a listing of a swestore collection is trusted before listing it again
+CATALOG_TTL = 600
+
+_CATALOGS = {}
+
+
+class StorageBackend(object):
+    """ (Abstract) superclass for a long term storage backend. Objects are
+        identified by their name, relative to the root of the backend.
+    """
+    def __init__(self, root):
+        """ Creates a backend instance
+            :param string root: the collection or directory where archives are stored
+        """
+        self.root = root
+
+    def __str__(self):
+        return type(self).__name__
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def exists(self, name):
+        """ Abstract method, should be implemented by subclasses """
+        raise NotImplementedError("This method should be implemented by "\
+        "subclass")
+
+    def put(self, f, name=None, verify=True):
+        """ Abstract method, should be implemented by subclasses """
+        raise NotImplementedError("This method should be implemented by "\
+        "subclass")
+
+    def put_stream(self, stream, name):
+        """ Abstract method, should be implemented by subclasses """
+        raise NotImplementedError("This method should be implemented by "\
+        "subclass")
+
+    def checksum(self, name, algorithm='md5'):
+        """ Abstract method, should be implemented by subclasses """
+        raise NotImplementedError("This method should be implemented by "\
+        "subclass")
+
+    def remove(self, name):
+        """ Abstract method, should be implemented by subclasses """
+        raise NotImplementedError("This method should be implemented by "\
+        "subclass")
+
+    def remove_many(self, names):
+        """ Remove several objects, one by one unless the backend can do it
+            in fewer operations
+            :param list names: the object names
+            :returns: the names that could not be removed
+        """
+        failed = []
+        for name in names:
+            try:
+                self.remove(name)
+            except Exception as e:
+                # The object might be gone anyway, i.e removed by an earlier batch that failed
+                if self.size(name) is not None:
+                    logger.error("Could not remove {} from {}: {}".format(name, self, e))
+                    failed.append(name)
+        return failed
+
+    def list(self):
+        """ Abstract method, should be implemented by subclasses """
+        raise NotImplementedError("This method should be implemented by "\
+        "subclass")
+
+    def size(self, name):
+        """ Abstract method, should be implemented by subclasses """
+        raise NotImplementedError("This method should be implemented by "\
+        "subclass")
+
+    def write_chunk(self, name, offset, stream):
+        """ Abstract method, should be implemented by subclasses """
+        raise NotImplementedError("This method should be implemented by "\
+        "subclass")
+
+    def read_range(self, name, offset, length):
+        """ Abstract method, should be implemented by subclasses """
+        raise NotImplementedError("This method should be implemented by "\
+        "subclass")
+
+    def open_stream(self, name):
+        """ Abstract method, should be implemented by subclasses """
+        raise NotImplementedError("This method should be implemented by "\
+        "subclass")
+
+    def read_json(self, name):
+        """ Fetch and parse a (small) JSON object
+            :param string name: the object name
+            :returns: the parsed object, or None if it does not exist
+        """
+        size = self.size(name)
+        if size is None:
+            return None
+        return json.loads(self.read_range(name, 0, size))
+
+
+def list_collection(collection):
+    """ List an iRODS collection with ``ils``, data objects and subcollections alike
+
+    :param str collection: iRODS collection
+    :returns: Set of names
+    :raises subprocess.CalledProcessError: If ils fails
+    """
+    output = subprocess.check_output(['ils', collection])
+    names = set()
+    # The first line is the collection itself, followed by one entry per line
+    for line in output.splitlines()[1:]:
+        line = line.strip()
+        if line.startswith('C- '):
+            line = os.path.basename(line[len('C- '):].rstrip('/'))
+        if line:
+            names.add(line)
+    return names
+
+
+class SwestoreCatalog(object):
+    """ Local copy of the names in a swestore collection, filled with a single
+        listing and listed again once it is older than its TTL. Uploads and
+        deletions done through TACA update it directly.
+    """
+    def __init__(self, collection, ttl=CATALOG_TTL, lister=list_collection):
+        """ :param string collection: the iRODS collection to list
+            :param int ttl: seconds after which the collection is listed again
+            :param lister: function listing a collection, returning a set of names
+        """
+        self.collection = collection
+        self.ttl = ttl
+        self.lister = lister
+        self._names = None
+        self._listed = 0
+
+    def refresh(self):
+        """ List the collection again """
+        self._names = set(self.lister(self.collection))
+        self._listed = time.time()
+
+    def names(self):
+        """ :returns: the set of names in the collection """
+        if self._names is None or time.time() - self._listed > self.ttl:
+            self.refresh()
+        return self._names
+
+    def __contains__(self, name):
+        if os.path.dirname(name):
+            # Not directly in the collection, ask the server
+            return filesystem.is_in_swestore(os.path.join(self.collection, name))
+        return name in self.names()
+
+    def add(self, name):
+        if self._names is not None:
+            self._names.add(name)
+
+    def discard(self, name):
+        if self._names is not None:
+            self._names.discard(name)
+
+
+def get_catalog(collection, lister=list_collection, client='icommands'):
+    """ Catalog of a swestore collection, shared by the whole process with
+    the backends using the same client
+
+    :param str collection: iRODS collection
+    :param lister: function listing the collection, used if the catalog is new
+    :param str client: 'icommands' or 'native', the client the lister uses
+    :returns: A SwestoreCatalog, with the TTL in 'storage.irods.catalog_ttl'
+    """
+    if (collection, client) not in _CATALOGS:
+        ttl = CONFIG.get('storage', {}).get('irods', {}).get('catalog_ttl', CATALOG_TTL)
+        _CATALOGS[(collection, client)] = SwestoreCatalog(collection, ttl, lister)
+    return _CATALOGS[(collection, client)]
+
+
+class SwestoreBackend(StorageBackend):
+    """ Swestore (iRODS) backend, using the icommands
+    """
+    def __init__(self, root):
+        super(SwestoreBackend, self).__init__(root)
+        self.catalog = get_catalog(root)
+
+    def exists(self, name):
+        return name in self.catalog
+
+    def put(self, f, name=None, verify=True):
+        """ Upload a file
+            :param string f: the file to upload
+            :param string name: the object name, by default the file name
+            :param bool verify: have iput checksum the file on both ends. This
+                reads the whole file once more, so leave it out when the
+                checksum is already known and compared afterwards
+        """
+        command = ['iput', '-P', f, self.path(name or os.path.basename(f))]
+        if verify:
+            command.insert(1, '-K')
+        misc.call_external_command(command, with_log_files=True)
+        self.catalog.add(name or os.path.basename(f))
+
+    def put_stream(self, stream, name):
+        """ Upload the contents of a file-like object with ``istream write``
+            :param stream: object with a read() method
+            :param string name: the object name
+            :raises subprocess.CalledProcessError: if the upload fails
+        """
+        command = ['istream', 'write', self.path(name)]
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE)
+        try:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), ''):
+                proc.stdin.write(chunk)
+        finally:
+            proc.stdin.close()
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, ' '.join(command))
+        self.catalog.add(name)
+
+    def read_range(self, name, offset, length):
+        """ Read part of an object with ``istream read``
+            :param string name: the object name
+            :param int offset: position to start reading at
+            :param int length: number of bytes to read
+        """
+        return subprocess.check_output(['istream', 'read', '--offset', str(offset),
+                                        '--count', str(length), self.path(name)])
+
+    @contextlib.contextmanager
+    def open_stream(self, name):
+        """ Read an object with ``istream read``
+            :param string name: the object name
+            :raises subprocess.CalledProcessError: if istream fails
+        """
+        command = ['istream', 'read', self.path(name)]
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+        try:
+            yield proc.stdout
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, ' '.join(command))
+
+    def checksum(self, name, algorithm='md5'):
+        """ Ask the iRODS server to compute the checksum of an object
+            :param string name: the object name
+            :param string algorithm: the algorithm expected, 'md5' or 'sha256'
+            :returns: the hexadecimal digest, or None if the server uses
+                another algorithm
+        """
+        output = subprocess.check_output(['ichksum', self.path(name)])
+        return irods_hexdigest(output.split()[-1], algorithm)
+
+    def remove(self, name):
+        misc.call_external_command(['irm', '-f', self.path(name)])
+        self.catalog.discard(name)
+
+    def remove_many(self, names):
+        """ Remove several objects with a single irm, falling back to one irm
+            per object if it fails, to find out which ones cannot be removed
+        """
+        try:
+            misc.call_external_command(['irm', '-f'] + [self.path(name) for name in names])
+        except subprocess.CalledProcessError:
+            return super(SwestoreBackend, self).remove_many(names)
+        for name in names:
+            self.catalog.discard(name)
+        return []
+
+    def list(self):
+        return self.catalog.names()
+
+    def size(self, name):
+        """ :returns: the size of an object, or None if it does not exist """
+        with open(os.devnull, 'w') as null:
+            try:
+                output = subprocess.check_output(['ils', '-l', self.path(name)], stderr=null)
+            except subprocess.CalledProcessError:
+                return None
+        # <owner> <replica> <resource> <size> <date> <status> <name>
+        return int(output.split()[3])
+
+    def write_chunk(self, name, offset, stream):
+        """ Write a chunk of an object with ``istream write``, creating (or
+            truncating) the object if the chunk is the first one
+            :param string name: the object name
+            :param int offset: position of the chunk in the object
+            :param stream: object with a read() method giving the chunk
+        """
+        command = ['istream', 'write', self.path(name)]
+        if offset:
+            command[2:2] = ['--offset', str(offset), '--no-trunc']
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE)
+        try:
+            for data in iter(lambda: stream.read(CHUNK_SIZE), ''):
+                proc.stdin.write(data)
+        finally:
+            proc.stdin.close()
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, ' '.join(command))
+        self.catalog.add(name)
+
+
+class IRODSBackend(StorageBackend):
+    """ Swestore (iRODS) backend talking to the server in-process through
+        python-irodsclient, over the session shared by the process (see
+        taca.utils.connections.get_irods_session) instead of one icommand,
+        and one authentication, per operation
+    """
+    def __init__(self, root, session=None, put_threads=None):
+        """ :param string root: the collection where archives are stored
+            :param session: iRODS session, by default the one of the process
+            :param int put_threads: threads for parallel puts of large objects,
+                by default 'storage.irods.put_threads'
+        """
+        super(IRODSBackend, self).__init__(root)
+        self._session = session
+        self.put_threads = put_threads or CONFIG.get('storage', {}).get('irods', {}).get('put_threads', 4)
+        self.catalog = get_catalog(root, lister=self._list_collection, client='native')
+
+    @property
+    def session(self):
+        return self._session or connections.get_irods_session()
+
+    def _list_collection(self, collection):
+        coll = self.session.collections.get(collection)
+        return set([o.name for o in coll.data_objects] + [c.name for c in coll.subcollections])
+
+    def exists(self, name):
+        if os.path.dirname(name):
+            # Not directly in the collection, ask the server
+            return self.session.data_objects.exists(self.path(name)) or \
+                self.session.collections.exists(self.path(name))
+        return name in self.catalog
+
+    def put(self, f, name=None, verify=True):
+        """ Upload a file, in parallel for large files
+            :param string f: the file to upload
+            :param string name: the object name, by default the file name
+            :param bool verify: have the server verify the checksum of the upload
+        """
+        name = name or os.path.basename(f)
+        options = {'num_threads': self.put_threads}
+        if verify:
+            # irods.keywords REG_CHKSUM_KW and VERIFY_CHKSUM_KW, same as iput -K
+            options['regChksum'] = ''
+            options['verifyChksum'] = ''
+        self.session.data_objects.put(f, self.path(name), **options)
+        self.catalog.add(name)
+
+    def put_stream(self, stream, name):
+        """ Upload the contents of a file-like object
+            :param stream: object with a read() method
+            :param string name: the object name
+        """
+        self.session.data_objects.create(self.path(name))
+        with self.session.data_objects.open(self.path(name), 'w') as dest:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), ''):
+                dest.write(chunk)
+        self.catalog.add(name)
+
+    def checksum(self, name, algorithm='md5'):
+        digest = self.session.data_objects.get(self.path(name)).chksum()
+        return irods_hexdigest(digest, algorithm)
+
+    def remove(self, name):
+        self.session.data_objects.unlink(self.path(name), force=True)
+        self.catalog.discard(name)
+
+    def list(self):
+        return self.catalog.names()
+
+    def size(self, name):
+        if not self.session.data_objects.exists(self.path(name)):
+            return None
+        return self.session.data_objects.get(self.path(name)).size
+
+    def write_chunk(self, name, offset, stream):
+        if not offset:
+            self.session.data_objects.create(self.path(name), force=True)
+        with self.session.data_objects.open(self.path(name), 'r+') as dest:
+            dest.seek(offset)
+            for data in iter(lambda: stream.read(CHUNK_SIZE), ''):
+                dest.write(data)
+        self.catalog.add(name)
+
+    def read_range(self, name, offset, length):
+        with self.session.data_objects.open(self.path(name), 'r') as src:
+            src.seek(offset)
+            return src.read(length)
+
+    @contextlib.contextmanager
+    def open_stream(self, name):
+        with self.session.data_objects.open(self.path(name), 'r') as src:
+            yield src
+
+
+class LocalBackend(StorageBackend):
+    """ Backend storing archives in a local (or mounted) directory, useful for
+        testing and as a stand-in for remote storage
+    """
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def put(self, f, name=None, verify=True):
+        filesystem.create_folder(self.root)
+        shutil.copyfile(f, self.path(name or os.path.basename(f)))
+
+    def put_stream(self, stream, name):
+        filesystem.create_folder(self.root)
+        with open(self.path(name), 'wb') as dest:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), ''):
+                dest.write(chunk)
+
+    def checksum(self, name, algorithm='md5'):
+        return misc.hashfile(self.path(name), hasher=algorithm)
+
+    def remove(self, name):
+        os.remove(self.path(name))
+
+    def list(self):
+        return set(os.listdir(self.root)) if os.path.isdir(self.root) else set()
+
+    def size(self, name):
+        return os.path.getsize(self.path(name)) if self.exists(name) else None
+
+    def write_chunk(self, name, offset, stream):
+        filesystem.create_folder(self.root)
+        with open(self.path(name), 'r+b' if offset else 'wb') as dest:
+            dest.seek(offset)
+            for data in iter(lambda: stream.read(CHUNK_SIZE), ''):
+                dest.write(data)
+
+    def read_range(self, name, offset, length):
+        with open(self.path(name), 'rb') as src:
+            src.seek(offset)
+            return src.read(length)
+
+    @contextlib.contextmanager
+    def open_stream(self, name):
+        with open(self.path(name), 'rb') as src:
+            yield src
+
+
+def irods_hexdigest(digest, algorithm='md5'):
+    """ Hexadecimal digest from a checksum as reported by iRODS
+
+    :param str digest: Checksum reported by the server
+    :param str algorithm: The algorithm expected, 'md5' or 'sha256'
+    :returns: The hexadecimal digest, or None if the server uses another algorithm
+    """
+    # iRODS 4 servers configured for SHA-256 report "sha2:<base64 digest>"
+    if digest.startswith('sha2:'):
+        if algorithm != 'sha256':
+            return None
+        return binascii.hexlify(base64.b64decode(digest[len('sha2:'):]))
+    return digest if algorithm == 'md5' else None
+
+
+class Adler32(object):
+    """ hashlib-like wrapper around zlib.adler32, the checksum used by dCache
+    """
+    def __init__(self):
+        self.value = 1
+
+    def update(self, data):
+        self.value = zlib.adler32(data, self.value)
+
+    def hexdigest(self):
+        return '{:08x}'.format(self.value & 0xffffffff)
+
+
+def new_hasher(algorithm):
+    """ Hash object for any hashlib algorithm or adler32 """
+    if algorithm == 'adler32':
+        return Adler32()
+    return hashlib.new(algorithm)
+
+
+class ChecksumReader(object):
+    """ Wraps a file-like object, computing the checksums of everything read
+        through it
+    """
+    def __init__(self, stream, algorithms='md5'):
+        """ :param stream: object with a read() method
+            :param algorithms: algorithm name, or list of them
+        """
+        if isinstance(algorithms, basestring):
+            algorithms = [algorithms]
+        self.stream = stream
+        self.hashers = OrderedDict((a, new_hasher(a)) for a in algorithms)
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        for hasher in self.hashers.values():
+            hasher.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self, algorithm=None):
+        """ :param string algorithm: one of the algorithms computed, by default the first one """
+        return self.hashers[algorithm or next(iter(self.hashers))].hexdigest()
+
+    def hexdigests(self):
+        return dict((a, h.hexdigest()) for a, h in self.hashers.items())
+
+
+class LimitedReader(object):
+    """ Wraps a file-like object, reading at most a given number of bytes from it
+    """
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size) if size else ''
+        self.remaining -= len(data)
+        return data
+
+
+def checksum_manifest(name, reader):
+    """ Contents of the checksum manifest of an archive
+
+    :param str name: Archive name
+    :param reader: ChecksumReader the archive was read through
+    :returns: The manifest as a JSON string
+    """
+    return json.dumps({'name': name, 'size': reader.size, 'digests': reader.hexdigests()},
+                      indent=2, sort_keys=True)
+
+
+def read_checksum_manifest(archive):
+    """ Read the checksum manifest written next to an archive
+
+    :param str archive: Path to the archive
+    :returns: Dictionary with name, size and digests, or None if there is no manifest
+    """
+    try:
+        with open(archive + CHECKSUM_SUFFIX) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+BACKENDS = {
+    'swestore': SwestoreBackend,
+    'irods': IRODSBackend,
+    'local': LocalBackend,
+}
+
+
+def get_backend(name=None):
+    """ Build the storage backend set in the configuration file
+
+    :param str name: Backend to use instead of storage.archive.backend
+    :returns: A StorageBackend instance
+    """
+    conf = CONFIG.get('storage', {})
+    name = name or conf.get('archive', {}).get('backend', 'swestore')
+    if name in ['swestore', 'irods']:
+        # 'swestore' follows storage.irods.client, 'irods' is always the native client
+        return swestore_backend(conf.get('irods', {}).get('irodsHome'),
+                                'irods' if name == 'irods' else None)
+    return BACKENDS[name](conf.get('archive', {}).get('local_root'))
+
+
+def swestore_backend(collection, name=None):
+    """ Backend for a swestore collection, talking to the server in-process
+    ('irods') or through the icommands ('swestore'), as set in 'storage.irods.client'
+
+    :param str collection: iRODS collection
+    :param str name: 'irods' or 'swestore', instead of the configured client
+    :returns: An IRODSBackend or a SwestoreBackend
+    """
+    if name is None:
+        client = CONFIG.get('storage', {}).get('irods', {}).get('client', 'icommands')
+        name = 'irods' if client == 'native' else 'swestore'
+    return BACKENDS[name](collection)
@@ -0,0 +1,258 @@
+""" Run archives compressed in independent blocks, with an index for random access
+
+The tar stream of a run is cut into blocks of a fixed (uncompressed) size and
+every block is compressed on its own. Compressed blocks are simply concatenated,
+which is still a valid bzip2, gzip or zstd file, so the archive can be
+decompressed as usual. Next to it, an index maps every member of the tar
+archive to its position in the uncompressed stream, and every block to its
+position in both streams. With it, a single file is restored by fetching and
+decompressing only the blocks it spans.
+"""
+import itertools
+import logging
+import os
+import subprocess
+import tarfile
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from taca.storage import codecs
+from taca.utils import filesystem
+
+logger = logging.getLogger(__name__)
+
+# Suffix of the index written next to each block compressed archive
+INDEX_SUFFIX = '.index.json'
+# Default size of the blocks, before compression
+BLOCK_SIZE = 16 * 1024 * 1024
+# Blocks compressed at the same time, so that reading tar and compressing overlap
+BLOCK_WORKERS = 2
+
+
+def _padded(size):
+    """ Size rounded up to whole tar records """
+    return (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+
+class TarIndexer(object):
+    """ Incremental parser of a tar stream, recording where the data of every
+        regular file starts. Data is fed as it flows, never buffering more than
+        a header (or a long name/pax extended header).
+    """
+    def __init__(self):
+        self.members = OrderedDict()
+        self.offset = 0
+        self.done = False
+        self._need = tarfile.BLOCKSIZE
+        self._buffer = ''
+        self._skip = 0
+        self._extended = None
+        self._longname = None
+        self._pax = {}
+
+    def feed(self, data):
+        pos = 0
+        while pos < len(data) and not self.done:
+            if self._skip:
+                n = min(self._skip, len(data) - pos)
+                self._skip -= n
+            else:
+                n = min(self._need - len(self._buffer), len(data) - pos)
+                self._buffer += data[pos:pos + n]
+            pos += n
+            self.offset += n
+            if not self._skip and len(self._buffer) == self._need:
+                buf, self._buffer = self._buffer, ''
+                if self._extended:
+                    self._process_extended(buf)
+                else:
+                    self._process_header(buf)
+
+    def _process_header(self, buf):
+        if buf.count(tarfile.NUL) == tarfile.BLOCKSIZE:
+            # End of archive
+            self.done = True
+            return
+        info = tarfile.TarInfo.frombuf(buf)
+        if info.type in [tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK,
+                         tarfile.XHDTYPE, tarfile.XGLTYPE]:
+            self._extended = (info.type, info.size)
+            self._need = _padded(info.size)
+            if not self._need:
+                self._extended = None
+                self._need = tarfile.BLOCKSIZE
+            return
+        name = self._pax.get('path') or self._longname or info.name
+        size = int(self._pax.get('size', info.size))
+        if info.isreg():
+            self.members[name] = [self.offset, size]
+        self._longname = None
+        self._pax = {}
+        self._skip = _padded(size) if info.isreg() else 0
+
+    def _process_extended(self, buf):
+        kind, size = self._extended
+        data = buf[:size]
+        if kind == tarfile.GNUTYPE_LONGNAME:
+            self._longname = data.rstrip(tarfile.NUL)
+        elif kind == tarfile.XHDTYPE:
+            # Records are "<length> <keyword>=<value>\n"
+            pos = 0
+            while pos < len(data):
+                length = int(data[pos:data.index(' ', pos)])
+                keyword, value = data[data.index(' ', pos) + 1:pos + length - 1].split('=', 1)
+                self._pax[keyword] = value
+                pos += length
+        self._extended = None
+        self._need = tarfile.BLOCKSIZE
+
+
+def _read_full(stream, size):
+    """ Read exactly size bytes from a stream, less only at its end """
+    chunks = []
+    while size > 0:
+        data = stream.read(size)
+        if not data:
+            break
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+
+def _run(command, data):
+    """ Pipe data through a command
+
+    :returns: The output of the command
+    :raises subprocess.CalledProcessError: If the command fails
+    """
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output, _ = proc.communicate(data)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, ' '.join(command))
+    return output
+
+
+class BlockCompressor(object):
+    """ File-like object giving a tar stream compressed in independent blocks,
+        building its index as it is read
+    """
+    def __init__(self, source, compressor, block_size=BLOCK_SIZE, workers=BLOCK_WORKERS):
+        """ :param source: uncompressed tar stream, object with a read() method
+            :param list compressor: compression command, or None to keep blocks as they are
+            :param int block_size: size of the blocks before compression
+            :param int workers: blocks compressed at the same time
+        """
+        self.source = source
+        self.compressor = compressor
+        self.block_size = block_size
+        self.workers = workers
+        self.indexer = TarIndexer()
+        self.index = {'block_size': block_size, 'blocks': [], 'members': self.indexer.members}
+        self._blocks = self._compressed_blocks()
+        self._buffer = ''
+
+    def _raw_blocks(self):
+        for block in iter(lambda: _read_full(self.source, self.block_size), ''):
+            self.indexer.feed(block)
+            yield block
+
+    def _compress(self, block):
+        return _run(self.compressor, block) if self.compressor else block
+
+    def _compressed_blocks(self):
+        pool = ThreadPool(self.workers)
+        try:
+            raw = self._raw_blocks()
+            uoffset = coffset = 0
+            for batch in iter(lambda: list(itertools.islice(raw, self.workers)), []):
+                for block, compressed in zip(batch, pool.map(self._compress, batch)):
+                    # [offset, size] uncompressed followed by [offset, size] compressed
+                    self.index['blocks'].append([uoffset, len(block), coffset, len(compressed)])
+                    uoffset += len(block)
+                    coffset += len(compressed)
+                    yield compressed
+        finally:
+            pool.close()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._blocks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def select_members(index, members):
+    """ Members of an archive matching the names given, either exactly or as
+    a directory containing them
+
+    :param dict index: Archive index
+    :param list members: Member names or directories
+    :returns: List of (name, offset, size), in archive order
+    """
+    prefixes = tuple(m.rstrip('/') + '/' for m in members)
+    return [(name, offset, size) for name, (offset, size) in index['members'].items()
+            if name in members or name.startswith(prefixes)]
+
+
+def read_member(backend, archive, index, offset, size):
+    """ Read the data of a member of an archive from a storage backend, fetching
+    and decompressing only the blocks it spans
+
+    :param backend: taca.storage.backends.StorageBackend holding the archive
+    :param str archive: Archive name in the backend
+    :param dict index: Archive index
+    :param int offset: Offset of the member data in the uncompressed stream
+    :param int size: Size of the member
+    :returns: Generator of data chunks, at most one block each
+    """
+    codec = codecs.get_codec(index['codec'])
+    decompressor = codec.decompress_command()
+    end = offset + size
+    for uoffset, usize, coffset, csize in index['blocks']:
+        if uoffset + usize <= offset:
+            continue
+        if uoffset >= end:
+            break
+        block = backend.read_range(archive, coffset, csize)
+        if decompressor:
+            block = _run(decompressor, block)
+        yield block[max(0, offset - uoffset):end - uoffset]
+
+
+def read_index(backend, archive):
+    """ Fetch the index of an archive from a storage backend
+
+    :returns: The index, or None if the archive has none
+    """
+    return backend.read_json(archive + INDEX_SUFFIX)
+
+
+def extract(backend, archive, members, dest):
+    """ Extract some files from a block compressed archive
+
+    :param backend: taca.storage.backends.StorageBackend holding the archive
+    :param str archive: Archive name in the backend
+    :param list members: Files or directories to extract, as named in the archive
+    :param str dest: Directory to extract them to
+    :returns: List of the paths extracted
+    :raises ValueError: If the archive has no index
+    """
+    index = read_index(backend, archive)
+    if index is None:
+        raise ValueError("Archive {} has no index, it was not written in blocks".format(archive))
+    extracted = []
+    for name, offset, size in select_members(index, members):
+        path = os.path.join(dest, name)
+        filesystem.create_folder(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            for data in read_member(backend, archive, index, offset, size):
+                f.write(data)
+        logger.info("Extracted {} from {}".format(name, archive))
+        extracted.append(path)
+    return extracted
@@ -1,6 +1,9 @@
 """ CLI for the storage subcommand
 """
 import click
+import json
+
+from taca.storage import backends, codecs
 from taca.storage import storage as st
 
 
@@ -33,17 +36,72 @@ def archive(ctx, backend, max_runs, force, compress_only):
 @storage.command()
 @click.option('-s','--site', type=click.Choice(['swestore','archive','illumina','analysis','nas','processing-server']),
               required=True, help='Site to perform cleanup')
-@click.option('-n','--dry-run', is_flag=True, help='Perform dry run i.e. Executes nothing but log')
+@click.option('-n','--dry-run', is_flag=True, help=("Perform dry run i.e. Executes nothing but log, and "
+                                                   "print the plan of what would be moved or removed "
+                                                   "with the space it frees, as JSON"))
+@click.option('-f','--free-space', help=("Remove the oldest items only until the site has this much "
+                                         "free space, in GB or as a percentage i.e 20%, instead of "
+                                         "everything older than the days threshold"))
 @click.pass_context
-def cleanup(ctx, site, dry_run):
+def cleanup(ctx, site, dry_run, free_space):
     """ Do appropriate cleanup on the given site i.e. NAS/processing servers/UPPMAX """
     params = ctx.parent.params
     days = params.get('days')
+    if free_space and site in ['nas', 'swestore']:
+        raise click.BadParameter("site {} does not free space on a local volume".format(site),
+                                 param_hint='--free-space')
     if site == 'nas':
-        st.cleanup_nas(days)
+        plan = st.cleanup_nas(days, dry_run)
     if site == 'processing-server':
-        st.cleanup_processing(days)
+        plan = st.cleanup_processing(days, free_space, dry_run)
     if site == 'swestore':
-        st.cleanup_swestore(days, dry_run)
+        plan = st.cleanup_swestore(days, dry_run)
     if site in ['illumina','analysis','archive']:
-        st.cleanup_uppmax(site, days, dry_run)
+        plan = st.cleanup_uppmax(site, days, dry_run, free_space)
+    if dry_run:
+        click.echo(json.dumps(plan.summary(), indent=2, sort_keys=True))
+
+
+@storage.command(name='benchmark-codecs')
+@click.option('-c', '--codec', 'codec_names', multiple=True, type=click.Choice(sorted(codecs.CODECS)),
+              help='Codec to benchmark, can be given several times. Default: all installed')
+@click.option('-s', '--sample-size', type=click.INT, default=1024,
+              help='MB of the run to compress, picked at random. Default: 1024')
+@click.option('-t', '--threads', type=click.INT, help='Threads for each codec. Default: all cores')
+@click.argument('rundir', type=click.Path(exists=True, file_okay=False))
+def benchmark_codecs(codec_names, sample_size, threads, rundir):
+    """ Compare the compression codecs on a sample of a run """
+    results = codecs.benchmark_codecs(rundir, sample_size * 1024 * 1024, codec_names, threads)
+    click.echo('{:<8} {:>7} {:>16} {:>18}'.format('codec', 'ratio', 'compress MB/s', 'decompress MB/s'))
+    for r in sorted(results, key=lambda r: r['compress'], reverse=True):
+        click.echo('{codec:<8} {ratio:>7.2f} {compress:>16.1f} {decompress:>18.1f}'.format(**r))
+
+
+@storage.command()
+@click.option('--backend', type=click.Choice(sorted(backends.BACKENDS)),
+              help='Storage backend holding the archive. Default: the one in the configuration')
+@click.option('-o', '--output', type=click.Path(file_okay=False), default='.',
+              help='Directory to extract the files to. Default: current directory')
+@click.argument('archive')
+@click.argument('members', nargs=-1, required=True)
+def extract(backend, output, archive, members):
+    """ Extract files or directories from an archived run without restoring all of it """
+    st.extract(archive, list(members), output, backend)
+
+
+@storage.command()
+@click.option('--backend', type=click.Choice(sorted(backends.BACKENDS)),
+              help='Storage backend holding the archives. Default: the one in the configuration')
+@click.option('-o', '--output', type=click.Path(file_okay=False), default='.',
+              help='Directory to restore the runs into. Default: current directory')
+@click.option('-m', '--max-runs', type=click.INT, help='Limit the number of runs restored simultaneously')
+@click.option('-b', '--bandwidth', type=click.INT, help='Bandwidth for all the restores together, in KB/s')
+@click.option('-p', '--part', 'parts', multiple=True,
+              help='Only restore this part of split archives, i.e lane1. Can be given several times')
+@click.argument('runs', nargs=-1, required=True)
+@click.pass_context
+def restore(ctx, backend, output, max_runs, bandwidth, parts, runs):
+    """ Restore archived runs, streaming them from long term storage """
+    restored = st.restore_runs(list(runs), output, backend, max_runs, bandwidth, list(parts))
+    if not all(restored.values()):
+        ctx.exit(1)
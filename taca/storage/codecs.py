@@ -0,0 +1,225 @@
+""" Compression programs that can be used to archive runs
+"""
+import logging
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+from distutils.spawn import find_executable
+
+from taca.utils import filesystem
+
+logger = logging.getLogger(__name__)
+
+
+class Codec(object):
+    """ A (multithreaded) compression program reading from stdin and writing to stdout
+    """
+    def __init__(self, name, extension, command, threads_option=None, decompress_option='-d'):
+        """ Creates a codec
+            :param string name: name of the codec, as used in the configuration file
+            :param string extension: extension of the compressed files, without dot
+            :param list command: command line compressing stdin to stdout, or None
+                to store the data uncompressed
+            :param string threads_option: option setting the number of threads,
+                formatted with the number of threads
+            :param string decompress_option: option switching the program to decompression
+        """
+        self.name = name
+        self.extension = extension
+        self.command = command
+        self.threads_option = threads_option
+        self.decompress_option = decompress_option
+
+    def __str__(self):
+        return self.name
+
+    def _with_threads(self, command, threads):
+        if threads and self.threads_option:
+            command = command + [self.threads_option.format(threads)]
+        return command
+
+    def compress_command(self, threads=None):
+        """ :returns: the compression command line as a list, or None if the
+                codec stores the data as-is
+        """
+        if self.command is None:
+            return None
+        return self._with_threads(list(self.command), threads)
+
+    def decompress_command(self, threads=None):
+        """ :returns: the decompression command line as a list, or None if the
+                codec stores the data as-is
+        """
+        if self.command is None:
+            return None
+        return self._with_threads(list(self.command) + [self.decompress_option], threads)
+
+    def archive_name(self, run):
+        """ :returns: the name of the tar archive of a run compressed with this codec """
+        return '{}.tar{}'.format(run, '.{}'.format(self.extension) if self.extension else '')
+
+    def is_available(self):
+        return self.command is None or find_executable(self.command[0]) is not None
+
+
+CODECS = {
+    'pbzip2': Codec('pbzip2', 'bz2', ['pbzip2', '-c'], threads_option='-p{}'),
+    'pigz': Codec('pigz', 'gz', ['pigz', '-c'], threads_option='-p{}'),
+    'zstd': Codec('zstd', 'zst', ['zstd', '-c', '-q'], threads_option='-T{}'),
+    'store': Codec('store', None, None),
+}
+
+# Files that are compressed already and gain almost nothing from going through a codec
+PRECOMPRESSED_RE = re.compile(r'\.(gz|bgzf|bz2|zst|xz|zip|cbcl|png|jpe?g)$', re.IGNORECASE)
+
+
+def get_codec(name='pbzip2'):
+    """ Get a codec by name
+
+    :param str name: One of the keys in CODECS
+    :raises KeyError: If there is no codec with that name
+    """
+    return CODECS[name]
+
+
+def archive_names(run):
+    """ All the possible archive names of a run, one per codec
+
+    :param str run: Run name
+    :returns: List of archive names
+    """
+    return [codec.archive_name(run) for codec in CODECS.values()]
+
+
+def is_archive(path):
+    """ Checks if a path is a run archive made with any of the codecs
+
+    :param str path: Path to check
+    """
+    return any(path.endswith(codec.archive_name('')) for codec in CODECS.values())
+
+
+def run_name(archive):
+    """ Strip the archive extensions from an archive name
+
+    :param str archive: Archive file name
+    :returns: The run name
+    """
+    for codec in sorted(CODECS.values(), key=lambda c: len(c.archive_name('')), reverse=True):
+        if archive.endswith(codec.archive_name('')):
+            return archive[:-len(codec.archive_name(''))]
+    return archive
+
+
+def is_precompressed(path):
+    """ Checks if a file is already compressed, judging by its extension
+
+    :param str path: File path
+    """
+    return PRECOMPRESSED_RE.search(path) is not None
+
+
+def classify_run(run):
+    """ Split the contents of a run by whether they are worth compressing
+
+    Directories are always part of the compressible list, so that archiving it
+    keeps the whole tree (including empty directories).
+
+    :param str run: Run directory
+    :returns: A tuple (compressible paths, already compressed paths)
+    """
+    compressible = [run]
+    precompressed = []
+
+    def _directory(path):
+        compressible.append(path)
+        return False
+
+    files = []
+    for path, _ in filesystem.scan_tree(run, prune=_directory):
+        (precompressed if is_precompressed(path) else files).append(path)
+    return compressible + files, precompressed
+
+
+def sample_run(run, sample_size, seed=0):
+    """ Pick a random sample of the files of a run
+
+    :param str run: Run directory
+    :param int sample_size: Approximate size of the sample in bytes
+    :param int seed: Seed for the random choice, so that samples can be repeated
+    :returns: List of file paths relative to the parent directory of the run
+    """
+    run = os.path.abspath(run)
+    files = sorted(filesystem.scan_tree(run))
+    random.Random(seed).shuffle(files)
+    sample = []
+    total = 0
+    for path, size in files:
+        if total >= sample_size:
+            break
+        sample.append(os.path.relpath(path, os.path.dirname(run)))
+        total += size
+    return sample
+
+
+def _timed_pipe(command, stdin, stdout):
+    """ Run a command reading and writing the given files, and time it
+
+    :returns: Time taken, in seconds
+    """
+    started = time.time()
+    subprocess.check_call(command, stdin=stdin, stdout=stdout)
+    return time.time() - started
+
+
+def benchmark_codecs(run, sample_size=1024 * 1024 * 1024, codecs=None, threads=None):
+    """ Measure the compression ratio and speed of the codecs on a sample of a run
+
+    A tar archive of a random sample of the run files is written to a
+    temporary directory, and then compressed and decompressed with every codec.
+
+    :param str run: Run directory
+    :param int sample_size: Approximate size of the sample in bytes
+    :param list codecs: Names of the codecs to try, by default all the installed ones
+    :param int threads: Number of threads for the codecs, by default one per core
+    :returns: List of dictionaries with keys codec, ratio, compress and
+        decompress (throughputs in MB/s of uncompressed data)
+    """
+    threads = threads or multiprocessing.cpu_count()
+    codecs = [get_codec(c) for c in codecs] if codecs else \
+        [c for c in CODECS.values() if c.command is not None]
+    tmp_dir = tempfile.mkdtemp(prefix='taca_benchmark_')
+    try:
+        file_list = os.path.join(tmp_dir, 'files')
+        with open(file_list, 'w') as f:
+            f.write('\n'.join(sample_run(run, sample_size)) + '\n')
+        sample = os.path.join(tmp_dir, 'sample.tar')
+        subprocess.check_call(['tar', '-cf', sample, '-C', os.path.dirname(os.path.abspath(run)),
+                               '-T', file_list])
+        size = os.path.getsize(sample)
+        results = []
+        for codec in codecs:
+            if not codec.is_available():
+                logger.warn('{} is not installed, skipping it'.format(codec))
+                continue
+            compressed = os.path.join(tmp_dir, codec.archive_name('sample'))
+            with open(sample, 'rb') as src, open(compressed, 'wb') as dest:
+                c_time = _timed_pipe(codec.compress_command(threads), src, dest)
+            with open(compressed, 'rb') as src, open(os.devnull, 'wb') as dest:
+                d_time = _timed_pipe(codec.decompress_command(threads), src, dest)
+            mb = size / (1024.0 * 1024.0)
+            results.append({
+                'codec': codec.name,
+                'ratio': float(size) / max(1, os.path.getsize(compressed)),
+                'compress': mb / max(c_time, 1e-6),
+                'decompress': mb / max(d_time, 1e-6)})
+            os.remove(compressed)
+        return results
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,163 @@
+""" Cleanup driven by the free space of a volume, and plans of what a cleanup does
+
+Instead of removing everything older than a number of days, the items that are
+safe to remove (transferred, archived, from a closed project...) are ranked
+oldest first and removed only until their volume has the free space wanted.
+"""
+import json
+import logging
+import os
+
+from multiprocessing.pool import ThreadPool
+
+from taca.utils import filesystem
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+
+def free_bytes(path):
+    """ Space available to users on the volume of a path, in bytes """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def target_bytes(path, target):
+    """ Free space wanted on the volume of a path
+
+    :param str path: Any path on the volume
+    :param target: GB as a number, or a percentage of the volume size as a
+        string, i.e '20%'
+    :returns: The free space wanted, in bytes
+    :raises ValueError: If the target is not a number or a percentage
+    """
+    if isinstance(target, basestring) and target.strip().endswith('%'):
+        st = os.statvfs(path)
+        return int(st.f_blocks * st.f_frsize * float(target.strip()[:-1]) / 100)
+    return int(float(target) * GB)
+
+
+def select_evictions(candidates, volume, target, workers=8):
+    """ Pick the items to remove so that a volume reaches its free space target
+
+    Items are taken oldest first and sized in parallel, a batch at a time, so
+    that only about as many items as needed are ever sized.
+
+    :param list candidates: (path, age in days) of the items that are safe to remove
+    :param str volume: Any path on the volume to free space on
+    :param target: Free space wanted, see target_bytes
+    :param int workers: Items sized simultaneously
+    :returns: List of (path, bytes used) to remove, oldest first
+    """
+    needed = target_bytes(volume, target) - free_bytes(volume)
+    if needed <= 0:
+        logger.info('{} has more than {} free already, nothing to remove'.format(volume, target))
+        return []
+    # Items on another filesystem would free nothing on this one
+    ranked = [path for path, age in sorted(candidates, key=lambda c: c[1], reverse=True)
+              if filesystem.same_device(path, volume)]
+    selected = []
+    pool = ThreadPool(workers)
+    try:
+        for i in range(0, len(ranked), workers):
+            batch = ranked[i:i + workers]
+            for path, (used, _) in zip(batch, pool.map(
+                    lambda p: filesystem.tree_usage(p, workers), batch)):
+                selected.append((path, used))
+                needed -= used
+                if needed <= 0:
+                    return selected
+    finally:
+        pool.close()
+        pool.join()
+    logger.warn('Removing all the {} items that can be removed still leaves {:.1f} GB '
+                'less free than wanted on {}'.format(len(selected), float(needed) / GB, volume))
+    return selected
+
+
+class CleanupPlan(object):
+    """ The items a cleanup moves or removes, and the space that frees on
+        each volume
+
+        Items are only sized when the plan is summarized, all of them in
+        parallel, reusing the sizes of the directories that have not changed
+        since the last plan if a cache file is given.
+    """
+    def __init__(self, site, cache_file=None, workers=8):
+        """ :param str site: cleanup site
+            :param str cache_file: json file keeping the usage of scanned
+                directories between plans
+            :param int workers: items sized simultaneously
+        """
+        self.site = site
+        self.cache_file = cache_file
+        self.workers = workers
+        self.items = []
+
+    def add(self, path, action, volume, sizer=None):
+        """ Add an item to the plan
+
+        :param str path: item path
+        :param str action: 'move' or 'remove'
+        :param str volume: where the item is, i.e the directory cleaned up
+        :param sizer: function giving the (bytes, inodes) of the path, by
+            default its disk usage
+        """
+        if not sizer:
+            path = os.path.abspath(path)
+        self.items.append({'path': path, 'action': action, 'volume': volume, 'sizer': sizer})
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (IOError, ValueError, TypeError):
+            return {}
+
+    def _save_cache(self, cache):
+        # Only items in this plan are kept, the others are gone or not cleaned up anymore
+        cache = dict((i['path'], cache.get(i['path'], {})) for i in self.items if not i['sizer'])
+        with open(self.cache_file + '.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.rename(self.cache_file + '.tmp', self.cache_file)
+
+    def _size(self, item, cache):
+        if item['sizer']:
+            return item['sizer'](item['path'])
+        return filesystem.tree_usage(item['path'], self.workers, cache.setdefault(item['path'], {}))
+
+    def summary(self):
+        """ The plan with the size of every item and the totals per volume
+
+        :returns: dictionary with the site, the items (path, action, volume,
+            bytes and inodes) and, for every volume, the number of items, the
+            bytes and inodes removed and moved, and its current free space if
+            it is a local directory
+        """
+        cache = self._load_cache() if self.cache_file else {}
+        pool = ThreadPool(self.workers)
+        try:
+            sizes = pool.map(lambda i: self._size(i, cache), self.items)
+        finally:
+            pool.close()
+            pool.join()
+        if self.cache_file:
+            self._save_cache(cache)
+        items = []
+        volumes = {}
+        for item, (used, inodes) in zip(self.items, sizes):
+            items.append({'path': item['path'], 'action': item['action'], 'volume': item['volume'],
+                          'bytes': used, 'inodes': inodes})
+            volume = volumes.get(item['volume'])
+            if volume is None:
+                volume = volumes[item['volume']] = {
+                    'items': 0, 'removed_bytes': 0, 'removed_inodes': 0,
+                    'moved_bytes': 0, 'moved_inodes': 0}
+                if os.path.isdir(item['volume']):
+                    volume['free_bytes'] = free_bytes(item['volume'])
+            volume['items'] += 1
+            prefix = 'moved' if item['action'] == 'move' else 'removed'
+            volume[prefix + '_bytes'] += used
+            volume[prefix + '_inodes'] += inodes
+        return {'site': self.site, 'items': items, 'volumes': volumes}
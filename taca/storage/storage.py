@@ -1,26 +1,40 @@
 """Storage methods and utilities"""
+import contextlib
+import errno
 import getpass
+import hashlib
+import json
+import multiprocessing
 import os
 import logging
 import re
 import shutil
+import socket
+import subprocess
+import tempfile
 import time
 
+from cStringIO import StringIO
+from collections import OrderedDict
 from datetime import datetime
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
-from statusdb.db import connections as statusdb
+from taca.storage import backends, blocks, codecs, policy
 from taca.utils.config import CONFIG
-from taca.utils import filesystem, misc
+from taca.utils import connections, filesystem, misc, transfer
 
 logger = logging.getLogger(__name__)
 
 
-def cleanup_nas(days):
+def cleanup_nas(days, dry_run=False):
     """Will move the finished runs in NASes to nosync directory.
 
     :param int days: Number of days to consider a run to be old
+    :param bool dry_run: Only plan the cleanup, without moving anything
+    :returns: taca.storage.policy.CleanupPlan of the runs moved
     """
+    plan = _cleanup_plan('nas')
     for data_dir in CONFIG.get('storage').get('data_dirs'):
         logger.info('Moving old runs in {}'.format(data_dir))
         with filesystem.chdir(data_dir):
@@ -29,21 +43,32 @@ def cleanup_nas(days):
                 if os.path.exists(rta_file):
                     # 1 day == 60*60*24 seconds --> 86400
                     if os.stat(rta_file).st_mtime < time.time() - (86400 * days):
+                        plan.add(run, 'move', data_dir)
+                        if dry_run:
+                            logger.info('Will move run {} to nosync directory'.format(run))
+                            continue
                         logger.info('Moving run {} to nosync directory'
                                     .format(os.path.basename(run)))
                         shutil.move(run, 'nosync')
                     else:
                         logger.info('RTAComplete.txt file exists but is not older than {} day(s), skipping run {}'.format(str(days), run))
+    return plan
 
 
-def cleanup_processing(days):
+def cleanup_processing(days, free_space=None, dry_run=False):
     """Cleanup runs in processing server.
 
     :param int days: Number of days to consider a run to be old
+    :param free_space: Free space to reach in the archive directories instead
+        of removing every run older than days, see taca.storage.policy.target_bytes
+    :param bool dry_run: Only plan the cleanup, without moving or removing anything
+    :returns: taca.storage.policy.CleanupPlan of the runs moved and removed
     """
+    plan = _cleanup_plan('processing-server')
     transfer_file = os.path.join(CONFIG.get('preprocessing', {}).get('status_dir'), 'transfer.tsv')
     if not days:
         days = CONFIG.get('cleanup', {}).get('processing-server', {}).get('days', 10)
+    target = _free_space_target('processing-server', free_space)
     try:
         #Move finished runs to nosync
         for data_dir in CONFIG.get('storage').get('data_dirs'):
@@ -51,6 +76,10 @@ def cleanup_processing(days):
             with filesystem.chdir(data_dir):
                 for run in [r for r in os.listdir(data_dir) if re.match(filesystem.RUN_RE, r)]:
                     if filesystem.is_in_file(transfer_file, run):
+                        plan.add(run, 'move', data_dir)
+                        if dry_run:
+                            logger.info('Will move run {} to nosync directory'.format(run))
+                            continue
                         logger.info('Moving run {} to nosync directory'
                                     .format(os.path.basename(run)))
                         shutil.move(run, 'nosync')
@@ -58,20 +87,35 @@ def cleanup_processing(days):
                         logger.info(("Run {} has not been transferred to the analysis "
                             "server yet, not archiving".format(run)))
         #Remove old runs from archiving dirs
+        # No run is taken as archived if swestore cannot be listed
+        archived = set(_runs_in_swestore(backends.swestore_backend(
+            CONFIG.get('storage').get('irods').get('irodsHome')).catalog))
         for archive_dir in CONFIG.get('storage').get('archive_dirs').values():
             logger.info('Removing old runs in {}'.format(archive_dir))
             with filesystem.chdir(archive_dir):
+                to_remove = []
                 for run in [r for r in os.listdir(archive_dir) if re.match(filesystem.RUN_RE, r)]:
                     rta_file = os.path.join(run, 'RTAComplete.txt')
                     if os.path.exists(rta_file):
                         # 1 day == 60*60*24 seconds --> 86400
-                        if os.stat(rta_file).st_mtime < time.time() - (86400 * days) and \
-                                filesystem.is_in_swestore("{}.tar.bz2".format(run)):
-                            logger.info('Removing run {} to nosync directory'
-                                        .format(os.path.basename(run)))
-                            shutil.rmtree(run)
+                        age = (time.time() - os.stat(rta_file).st_mtime) / 86400
+                        if (target or age > days) and \
+                                any(a in archived for a in codecs.archive_names(run) +
+                                    [run + RUN_MANIFEST_SUFFIX]):
+                            to_remove.append((run, age))
                         else:
                             logger.info('RTAComplete.txt file exists but is not older than {} day(s), skipping run {}'.format(str(days), run))
+                if target:
+                    to_remove = policy.select_evictions(to_remove, archive_dir, target)
+                for run, _ in to_remove:
+                    plan.add(run, 'remove', archive_dir)
+                    if dry_run:
+                        logger.info('Will remove run {} from {}'.format(run, archive_dir))
+                        continue
+                    logger.info('Removing run {} to nosync directory'
+                                .format(os.path.basename(run)))
+                    _deletion_queue().delete(run)
+        _deletion_queue().wait()
 
     except IOError:
         sbj = "Cannot archive old runs in processing server"
@@ -82,6 +126,7 @@ def cleanup_processing(days):
             cnt = "{}@localhost".format(getpass.getuser())
         logger.error(msg)
         misc.send_mail(sbj, msg, cnt)
+    return plan
 
 
 def archive_to_swestore(days, run=None, max_runs=None, force=False, compress_only=False):
@@ -108,6 +153,8 @@ def archive_to_swestore(days, run=None, max_runs=None, force=False, compress_onl
                               "the absolute path or relative path being in "
                               "the correct directory.".format(run)))
             else:
+                processes, threads, uploads = archive_workers(1, max_runs)
+                _init_archive_worker(threads, None)
                 with filesystem.chdir(base_dir):
                     _archive_run((run, days, force, compress_only))
         else:
@@ -119,11 +166,26 @@ def archive_to_swestore(days, run=None, max_runs=None, force=False, compress_onl
         for to_send_dir in CONFIG.get('storage').get('archive_dirs'):
             logger.info('Checking {} directory'.format(to_send_dir))
             with filesystem.chdir(to_send_dir):
-                to_be_archived = [r for r in os.listdir(to_send_dir)
-                                  if re.match(filesystem.RUN_RE, r)
-                                  and not os.path.exists("{}.archiving".format(r.split('.')[0]))]
+                candidates = [r for r in sorted(os.listdir(to_send_dir))
+                              if re.match(filesystem.RUN_RE, r)
+                              and (os.path.isdir(r) or codecs.is_archive(r))
+                              and not _is_being_archived(r)]
+                # All the archives of a run (split by file type or by lane and
+                # project) are sent together by one task. Run names have no dots.
+                # A run still on disk was not fully compressed, so it is archived
+                # again rather than sending the archives written so far
+                to_be_archived = OrderedDict()
+                for r in candidates:
+                    if r.split('.')[0] not in to_be_archived or os.path.isdir(r):
+                        to_be_archived[r.split('.')[0]] = r
+                to_be_archived = to_be_archived.values()
                 if to_be_archived:
-                    pool = Pool(processes=len(to_be_archived) if not max_runs else max_runs)
+                    processes, threads, uploads = archive_workers(len(to_be_archived), max_runs)
+                    logger.info(("Archiving {} runs, {} at a time with {} compression "
+                                 "threads each and at most {} simultaneous uploads"
+                                 .format(len(to_be_archived), processes, threads, uploads)))
+                    pool = Pool(processes=processes, initializer=_init_archive_worker,
+                                initargs=(threads, multiprocessing.BoundedSemaphore(uploads)))
                     pool.map_async(_archive_run, ((run, days, force, compress_only) for run in to_be_archived))
                     pool.close()
                     pool.join()
@@ -131,52 +193,132 @@ def archive_to_swestore(days, run=None, max_runs=None, force=False, compress_onl
                     logger.info('No old runs to be archived')
 
 
+def restore_runs(runs, dest, backend=None, max_runs=None, bandwidth=None, parts=None):
+    """ Restore archived runs from long term storage
+
+    Archives are streamed from the backend through the (multithreaded)
+    decompressor into tar, so no archive is written to disk, and their checksum
+    is verified on the way. Runs are extracted to a hidden directory and only
+    moved into place once all their archives are restored and verified.
+
+    :param list runs: Names of the runs to restore
+    :param str dest: Directory to restore the runs into
+    :param str backend: Storage backend, by default 'storage.archive.backend'
+    :param int max_runs: Runs restored at the same time, by default 'storage.restore.max_runs'
+    :param int bandwidth: Total bandwidth for all the restores in KB/s, if limited
+    :param list parts: Parts of split archives to restore, i.e lane1, by default all of them
+    :returns: Dictionary of run name to True if it was restored
+    """
+    backend = backends.get_backend(backend)
+    max_runs = max_runs or CONFIG.get('storage', {}).get('restore', {}).get('max_runs', 2)
+    workers = max(1, min(len(runs), max_runs))
+    threads = max(1, multiprocessing.cpu_count() // workers)
+    bwlimit = bandwidth // workers if bandwidth else None
+    logger.info("Restoring {} runs from {}, {} at a time".format(len(runs), backend, workers))
+    pool = ThreadPool(workers)
+    try:
+        restored = pool.map(lambda run: _restore_run(run, dest, backend, threads, bwlimit, parts), runs)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(runs, restored))
+
+
 def cleanup_swestore(days, dry_run=False):
     """Remove archived runs from swestore
 
+    Archives are removed in batches of 'cleanup.swestore.batch_size', several
+    batches at a time ('cleanup.swestore.workers'), and every archive removed
+    is logged in 'cleanup.swestore.deleted_log'. Archives that could not be
+    removed are still in swestore, so the next cleanup tries them again.
+
     :param int days: Threshold days to check and remove
+    :param bool dry_run: Only plan the cleanup, without removing anything
+    :returns: taca.storage.policy.CleanupPlan of the archives removed
     """
-    days = check_days('swestore', days, config)
+    plan = _cleanup_plan('swestore')
+    days = check_days('swestore', days, CONFIG)
     if not days:
-        return
-    runs = filesystem.list_runs_in_swestore(path=CONFIG.get('cleanup').get('swestore').get('root'))
-    for run in runs:
-        date = run.split('_')[0]
-        if misc.days_old(date) > days:
-            if dry_run:
-                logger.info('Will remove file {} from swestore'.format(run))
-                continue
-            misc.call_external_command('irm -f {}'.format(run))
-            logger.info('Removed file {} from swestore'.format(run))
-
-
-def cleanup_uppmax(site, days, dry_run=False):
+        return plan
+    config = CONFIG.get('cleanup').get('swestore')
+    root = config.get('root')
+    backend = backends.swestore_backend(root)
+    expired = [run for run in _runs_in_swestore(backend.catalog)
+               if misc.days_old(run.split('_')[0]) > days]
+    for run in expired:
+        # Data objects are single inodes on the storage side
+        plan.add(run, 'remove', root, sizer=lambda r: (backend.size(r) or 0, 1))
+        if dry_run:
+            logger.info('Will remove file {} from swestore'.format(run))
+    if dry_run or not expired:
+        return plan
+    batch_size = config.get('batch_size', 100)
+    batches = [expired[i:i + batch_size] for i in range(0, len(expired), batch_size)]
+    failed = []
+    pool = ThreadPool(min(config.get('workers', 4), len(batches)))
+    try:
+        # The log is written as batches finish, so it is complete even if the cleanup is interrupted
+        for batch, batch_failed in pool.imap_unordered(
+                lambda batch: (batch, backend.remove_many(batch)), batches):
+            removed = [run for run in batch if run not in batch_failed]
+            for run in removed:
+                logger.info('Removed file {} from swestore'.format(run))
+            if removed and config.get('deleted_log'):
+                with open(config.get('deleted_log'), 'a') as to_log:
+                    now = datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M')
+                    to_log.write(''.join("{}\t{}\n".format(run, now) for run in removed))
+            failed.extend(batch_failed)
+    finally:
+        pool.close()
+        pool.join()
+    if failed:
+        logger.error("Could not remove {} of {} files from swestore, they will be tried again on "
+                     "the next cleanup: {}".format(len(failed), len(expired), ', '.join(sorted(failed))))
+    return plan
+
+
+def cleanup_uppmax(site, days, dry_run=False, free_space=None):
     """Remove project/run that have been closed more than 'days'
     from the given 'site' on uppmax
 
     :param str site: site where the cleanup should be performed
     :param int days: number of days to check for closed projects
+    :param free_space: Free space to reach on the site instead of removing
+        everything older than days, see taca.storage.policy.target_bytes
+    :returns: taca.storage.policy.CleanupPlan of the projects or runs removed
     """
-    days = check_days(site, days, config)
-    if not days:
-        return
+    plan = _cleanup_plan(site)
+    target = _free_space_target(site, free_space)
+    if target:
+        # Any closed project or archived run can go, oldest first
+        days = 0
+    else:
+        days = check_days(site, days, CONFIG)
+        if not days:
+            return plan
     root_dir = CONFIG.get('cleanup').get(site).get('root')
     deleted_log = CONFIG.get('cleanup').get('deleted_log')
     assert os.path.exists(os.path.join(root_dir,deleted_log)), "Log directory {} doesn't exist in {}".format(deleted_log,root_dir)
     log_file = os.path.join(root_dir,"{fl}/{fl}.log".format(fl=deleted_log))
 
     # make a connection for project db #
-    pcon = statusdb.ProjectSummaryConnection()
+    pcon = connections.get_project_connection()
     assert pcon, "Could not connect to project database in StatusDB"
 
     if site != "archive":
         ## work flow for cleaning up illumina/analysis ##
         projects = [ p for p in os.listdir(root_dir) if re.match(filesystem.PROJECT_RE,p) ]
-        list_to_delete = get_closed_projects(projects, pcon, days)
+        if target:
+            ages = [(p, misc.days_old(d, date_format='%Y-%m-%d'))
+                    for p, d in _project_close_dates(projects, pcon).items()]
+        else:
+            list_to_delete = get_closed_projects(projects, pcon, days)
     else:
         ##work flow for cleaning archive ##
         list_to_delete = []
-        archived_in_swestore = filesystem.list_runs_in_swestore(path=CONFIG.get('cleanup').get('swestore').get('root'), no_ext=True)
+        ages = []
+        archived_in_swestore = set(_runs_in_swestore(backends.swestore_backend(
+            CONFIG.get('cleanup').get('swestore').get('root')).catalog, no_ext=True))
         runs = [ r for r in os.listdir(root_dir) if re.match(filesystem.RUN_RE,r) ]
         with filesystem.chdir(root_dir):
             for run in runs:
@@ -184,17 +326,23 @@ def cleanup_uppmax(site, days, dry_run=False):
                 if misc.days_old(fc_date) > days:
                     if run in archived_in_swestore:
                         list_to_delete.append(run)
+                        ages.append((run, misc.days_old(fc_date)))
                     else:
                         logger.warn("Run {} is older than {} days but not in "
                                     "swestore, so SKIPPING".format(run, days))
 
+    if target:
+        list_to_delete = [os.path.basename(path) for path, _ in policy.select_evictions(
+            [(os.path.join(root_dir, item), age) for item, age in ages], root_dir, target)]
+
     ## delete and log
     for item in list_to_delete:
+        plan.add(os.path.join(root_dir,item), 'remove', root_dir)
         if dry_run:
             logger.info('Will remove {} from {}'.format(item,root_dir))
             continue
         try:
-            shutil.rmtree(os.path.join(root_dir,item))
+            _deletion_queue().delete(os.path.join(root_dir,item))
             logger.info('Removed project {} from {}'.format(item,root_dir))
             with open(log_file,'a') as to_log:
                 to_log.write("{}\t{}\n".format(item,datetime.strftime(datetime.now(),'%Y-%m-%d %H:%M')))
@@ -202,11 +350,86 @@ def cleanup_uppmax(site, days, dry_run=False):
             logger.warn("Could not remove path {} from {}"
                         .format(item,root_dir))
             continue
+    _deletion_queue().wait()
+    return plan
 
 
 #############################################################
 # Class helper methods, not exposed as commands/subcommands #
 #############################################################
+# Top level manifest listing the archives of a run, when there are several
+RUN_MANIFEST_SUFFIX = '.manifest.json'
+# Lane directories, i.e Data/Intensities/BaseCalls/L001
+LANE_RE = r'^L(\d{3})$'
+# Directories in Demultiplexing that are not projects
+DEMULTIPLEXING_METADATA = ['Reports', 'Stats', 'Temp']
+# Journal of the chunks of an archive confirmed in the storage backend, see _put_in_chunks
+UPLOAD_JOURNAL_SUFFIX = '.upload.json'
+# Seconds the close dates of projects fetched from StatusDB are reused, kept
+# in 'cleanup.close_date_cache' if set so that the next cleanups reuse them too
+CLOSE_DATE_TTL = 600
+_CLOSE_DATES = {}
+# Limits of the current archiving worker, see _init_archive_worker
+_ARCHIVE_LIMITS = {'compress_threads': None, 'upload_slots': None}
+
+
+def archive_workers(n_runs, max_runs=None):
+    """ Decide how many runs to archive at the same time, and with how many
+    compression threads each, from the host resources and the 'storage.archive'
+    section of the configuration file.
+
+    The number of simultaneous runs is bounded by the number of cores (each run
+    needs at least 'min_threads' compression threads), the available memory
+    ('memory_per_run', in MB) and the number of runs the disks can feed at
+    full speed ('max_io_runs'). Uploads are limited separately by 'upload_streams'.
+
+    :param int n_runs: Number of runs to archive
+    :param int max_runs: Maximum number of runs to archive simultaneously, if given
+    :returns: A tuple (simultaneous runs, compression threads per run, simultaneous uploads)
+    :rtype: tuple
+    """
+    conf = CONFIG.get('storage', {}).get('archive', {})
+    cpus = multiprocessing.cpu_count()
+    limits = [n_runs,
+              max(1, cpus // conf.get('min_threads', 4)),
+              conf.get('max_io_runs', 2)]
+    if max_runs:
+        limits.append(max_runs)
+    memory = misc.available_memory()
+    if memory:
+        limits.append(max(1, memory // (conf.get('memory_per_run', 2048) * 1024 * 1024)))
+    processes = max(1, min(limits))
+    threads = max(1, cpus // processes)
+    return processes, threads, conf.get('upload_streams', 2)
+
+
+def _runs_in_swestore(catalog, no_ext=False):
+    """ Runs (archives or collections) in a swestore collection
+
+    :param catalog: taca.storage.backends.SwestoreCatalog of the collection
+    :param bool no_ext: Remove the extensions, giving run names
+    :returns: List of names, empty if the collection could not be listed
+    """
+    try:
+        runs = sorted(r for r in catalog.names() if re.match(filesystem.RUN_RE, r))
+    except Exception as e:
+        # ils failing, or any error of the native iRODS client
+        logger.error("Could not list {} in swestore: {}".format(catalog.collection, e))
+        return []
+    if no_ext:
+        runs = [r.split('.')[0] for r in runs]
+    return runs
+
+
+def _init_archive_worker(compress_threads, upload_slots):
+    """ Set the limits of an archiving worker process
+
+    :param int compress_threads: Number of threads for the compression program
+    :param upload_slots: Semaphore shared by the workers to limit simultaneous uploads, or None
+    """
+    _ARCHIVE_LIMITS['compress_threads'] = compress_threads
+    _ARCHIVE_LIMITS['upload_slots'] = upload_slots
+
 def _archive_run((run, days, force, compress_only)):
     """ Archive a specific run to swestore
 
@@ -223,41 +446,816 @@ def _archive_run((run, days, force, compress_only)):
         :param str f: File to remove
         :param str dest: Destination directory in Swestore
         :param bool remove: If True, remove original file from source
+        :returns: True if the file is in swestore
         """
-        if not filesystem.is_in_swestore(f):
+        backend = backends.swestore_backend(dest)
+        # An interrupted upload leaves a partial object behind, and its journal
+        if not backend.exists(os.path.basename(f)) or os.path.exists(f + UPLOAD_JOURNAL_SUFFIX):
             logger.info("Sending {} to swestore".format(f))
-            misc.call_external_command('iput -K -P {file} {dest}'.format(file=f, dest=dest),
-                    with_log_files=True)
+            checksums = backends.read_checksum_manifest(f)
+            with _upload_slot() as bwlimit:
+                if checksums:
+                    sent = _send_with_manifest(f, backend, checksums, bwlimit)
+                else:
+                    # iput has no bandwidth limit, only the number of transfers is governed
+                    backend.put(f)
+                    sent = True
+            if not sent:
+                return False
             logger.info('Run {} sent correctly and checksum was okay.'.format(f))
             if remove:
                 logger.info('Removing run'.format(f))
                 os.remove(f)
+                for sidecar in [f + backends.CHECKSUM_SUFFIX, f + blocks.INDEX_SUFFIX]:
+                    if os.path.exists(sidecar):
+                        os.remove(sidecar)
         else:
             logger.warn('Run {} is already in Swestore, not sending it again nor removing from the disk'.format(f))
+        return True
+
+    def _send_run(archives, workers=1):
+        """ Send the archives of a run to swestore, and its manifest only once
+        all of them are there, since the manifest tells that the run is archived
+        (see cleanup_processing)
 
-    # Create state file to say that the run is being archived
-    open("{}.archiving".format(run.split('.')[0]), 'w').close()
-    if run.endswith('bz2'):
-        if os.stat(run).st_mtime < time.time() - (86400 * days):
-            _send_to_swestore(run, CONFIG.get('storage').get('irods').get('irodsHome'))
+        :param list archives: Archives of the run, and its manifest if split
+        :param int workers: Archives sent at the same time
+        """
+        dest = CONFIG.get('storage').get('irods').get('irodsHome')
+        manifests = [a for a in archives if a.endswith(RUN_MANIFEST_SUFFIX)]
+        pool = ThreadPool(workers)
+        try:
+            sent = pool.map(lambda archive: _send_to_swestore(archive, dest),
+                            [a for a in archives if a not in manifests])
+        finally:
+            pool.close()
+            pool.join()
+        if not all(sent):
+            logger.warn("Not all the archives of run {} were sent, not sending its manifest".format(run))
+            return
+        for manifest in manifests:
+            _send_to_swestore(manifest, dest)
+
+    # Create state file to say that the run is being archived, removed even if archiving fails
+    marker = _create_archiving_marker(run)
+    try:
+        if codecs.is_archive(run):
+            if os.stat(run).st_mtime < time.time() - (86400 * days):
+                # All the archives of the run (split by file type or by lane and
+                # project) and its manifest are sent together
+                run_name = run.split('.')[0]
+                _send_run([a for a in sorted(os.listdir('.')) if a.split('.')[0] == run_name and
+                           (codecs.is_archive(a) or a.endswith(RUN_MANIFEST_SUFFIX))])
+            else:
+                logger.info("Run {} is not {} days old yet. Not archiving".format(run, str(days)))
         else:
-            logger.info("Run {} is not {} days old yet. Not archiving".format(run, str(days)))
+            rta_file = os.path.join(run, 'RTAComplete.txt')
+            if not os.path.exists(rta_file) and not force:
+                logger.warn(("Run {} doesn't seem to be completed and --force option was "
+                          "not enabled, not archiving the run".format(run)))
+            streaming = CONFIG.get('storage', {}).get('archive', {}).get('streaming', False)
+            old_enough = os.path.exists(rta_file) and os.stat(rta_file).st_mtime < time.time() - (86400 * days)
+            if (force or old_enough) and streaming and not compress_only:
+                # No archive on disk, the run is only removed once its checksum is confirmed
+                if _stream_run(run, backends.get_backend()):
+                    logger.info('Run {} archived and checksum was okay. Removing from disk...'.format(run))
+                    _deletion_queue().delete(run)
+            elif force or old_enough:
+                codec = _archive_codec()
+                logger.info("Compressing run {} with {}".format(run, codec))
+                parts = _archive_parts(run, codec)
+                workers = _part_workers(parts)
+                threads = _ARCHIVE_LIMITS['compress_threads']
+                threads = max(1, threads // workers) if threads else None
+                pool = ThreadPool(workers)
+                try:
+                    pool.map(lambda (archive, part_codec, files, part):
+                             _write_archive(run, archive, _compress_command(part_codec, threads),
+                                            files, _new_index(part_codec)),
+                             parts)
+                finally:
+                    pool.close()
+                archives = [archive for archive, _, _, _ in parts]
+                if len(parts) > 1 or parts[0][3]:
+                    archives.append(_write_run_manifest(run, codec, parts))
+                logger.info('Run {} successfully compressed! Removing from disk...'.format(run))
+                _deletion_queue().delete(run)
+                if not compress_only:
+                    _send_run(archives, workers)
+            else:
+                logger.info("Run {} is not completed or is not {} days old yet. Not archiving".format(run, str(days)))
+    finally:
+        os.remove(marker)
+    # The run is out of the way already, but the worker must not exit before it is deleted
+    _deletion_queue().wait()
+
+
+def _free_space_target(site, free_space=None):
+    """ Free space wanted on a cleanup site, given on the command line or in
+    'cleanup.<site>.free_space'
+
+    :returns: The target, see taca.storage.policy.target_bytes, or None to
+        clean up by age
+    """
+    return free_space or CONFIG.get('cleanup', {}).get(site, {}).get('free_space')
+
+
+def _cleanup_plan(site):
+    """ An empty plan for a cleanup site, keeping its usage cache in the
+    file 'cleanup.usage_cache' if set
+
+    :returns: A taca.storage.policy.CleanupPlan
+    """
+    return policy.CleanupPlan(site, CONFIG.get('cleanup', {}).get('usage_cache'))
+
+
+def _deletion_queue():
+    """ The deletion queue of this process, see taca.utils.filesystem.DeletionQueue
+
+    :returns: A taca.utils.filesystem.DeletionQueue set up from 'storage.deletion'
+    """
+    config = CONFIG.get('storage', {}).get('deletion', {})
+    return filesystem.deletion_queue(config.get('workers', 8), config.get('trash_dirs', []))
+
+
+def _archive_codec():
+    """ The codec set in 'storage.archive.codec', pbzip2 by default
+
+    :returns: A taca.storage.codecs.Codec
+    """
+    return codecs.get_codec(CONFIG.get('storage', {}).get('archive', {}).get('codec', 'pbzip2'))
+
+
+def _compress_command(codec, threads=None):
+    """ Command line of the compression program, reading stdin and writing stdout
+
+    :param codec: taca.storage.codecs.Codec to compress with
+    :param int threads: Compression threads, by default the ones of the archiving worker
+    :returns: The command as a list, or None if the codec does not compress
+    """
+    return codec.compress_command(threads or _ARCHIVE_LIMITS['compress_threads'])
+
+
+def _digest_algorithms():
+    """ Digests to compute while archiving, 'storage.archive.digests', always
+    including the one compared with the storage backend
+
+    :returns: List of algorithm names
+    """
+    conf = CONFIG.get('storage', {}).get('archive', {})
+    algorithms = list(conf.get('digests', backends.DIGESTS))
+    if conf.get('checksum', 'md5') not in algorithms:
+        algorithms.append(conf.get('checksum', 'md5'))
+    return algorithms
+
+
+def _send_with_manifest(f, backend, checksums, bwlimit=None):
+    """ Upload an archive and its checksum manifest, comparing the checksum
+    computed by the backend with the one in the manifest instead of reading
+    the archive again locally. Archives larger than 'storage.archive.chunk_size'
+    (in MB) are uploaded in resumable chunks.
+
+    :param str f: Archive to upload
+    :param backend: taca.storage.backends.StorageBackend to upload to
+    :param dict checksums: Checksum manifest of the archive
+    :param int bwlimit: Bandwidth limit in KB/s, or None
+    :returns: True if the archive was uploaded and its checksum matches
+    :raises ValueError: If the backend does not compute 'storage.archive.checksum'
+    """
+    conf = CONFIG.get('storage', {}).get('archive', {})
+    algorithm = conf.get('checksum', 'md5')
+    chunk_size = int(conf.get('chunk_size', 1024) * 1024 * 1024)
+    name = os.path.basename(f)
+    if os.path.getsize(f) > chunk_size:
+        _put_in_chunks(f, backend, name, chunk_size, bwlimit)
+    elif bwlimit:
+        # iput has no bandwidth limit, the file is streamed instead
+        with open(f, 'rb') as src:
+            backend.put_stream(_throttled(src, bwlimit), name)
+    else:
+        backend.put(f, name, verify=False)
+    try:
+        remote = _remote_checksum(backend, name, algorithm)
+    except ValueError as e:
+        logger.error("Could not verify {}: {}".format(name, e))
+        _discard_upload(f, backend, name)
+        raise
+    if remote != checksums['digests'].get(algorithm):
+        logger.error("Checksum of {} in {} ({}) does not match the one in its manifest ({})"
+                     .format(name, backend, remote, checksums['digests'].get(algorithm)))
+        _discard_upload(f, backend, name)
+        return False
+    backend.put(f + backends.CHECKSUM_SUFFIX, verify=False)
+    if os.path.exists(f + blocks.INDEX_SUFFIX):
+        backend.put(f + blocks.INDEX_SUFFIX, verify=False)
+    if os.path.exists(f + UPLOAD_JOURNAL_SUFFIX):
+        os.remove(f + UPLOAD_JOURNAL_SUFFIX)
+    return True
+
+
+def _remote_checksum(backend, name, algorithm):
+    """ Checksum of an object, as computed by a storage backend
+
+    :param backend: taca.storage.backends.StorageBackend holding the object
+    :param str name: Object name in the backend
+    :param str algorithm: Checksum algorithm, 'storage.archive.checksum'
+    :returns: The hexadecimal digest
+    :raises ValueError: If the backend computes its checksums with another algorithm
+    """
+    remote = backend.checksum(name, algorithm)
+    if remote is None:
+        raise ValueError("{} does not compute {} checksums, set 'storage.archive.checksum' "
+                         "to the algorithm it uses".format(backend, algorithm))
+    return remote
+
+
+def _discard_upload(f, backend, name):
+    """ Remove an archive that could not be verified from a storage backend,
+    otherwise the next pass would take it as archived, and its upload journal
+
+    :param str f: Archive uploaded
+    :param backend: taca.storage.backends.StorageBackend it was uploaded to
+    :param str name: Object name in the backend
+    """
+    _remove_from_backend(backend, name)
+    # Do not resume from chunks that ended up wrong
+    if os.path.exists(f + UPLOAD_JOURNAL_SUFFIX):
+        os.remove(f + UPLOAD_JOURNAL_SUFFIX)
+
+
+def _put_in_chunks(f, backend, name, chunk_size, bwlimit=None):
+    """ Upload a file in fixed-size chunks, recording every chunk written in a
+    journal next to it (<file>.upload.json) with its size and md5. If the
+    journal is there and still matches the file, the upload resumes after the
+    last chunk the backend holds whose md5 is still the one in the journal.
+
+    :param str f: File to upload
+    :param backend: taca.storage.backends.StorageBackend to upload to
+    :param str name: Object name in the backend
+    :param int chunk_size: Size of the chunks in bytes
+    :param int bwlimit: Bandwidth limit in KB/s, or None
+    """
+    journal_file = f + UPLOAD_JOURNAL_SUFFIX
+    st = os.stat(f)
+    journal = {'name': name, 'size': st.st_size, 'mtime': st.st_mtime,
+               'chunk_size': chunk_size, 'chunks': []}
+    try:
+        with open(journal_file) as jf:
+            previous = json.load(jf)
+        if all(previous.get(k) == journal[k] for k in ['name', 'size', 'mtime', 'chunk_size']):
+            remote_size = backend.size(name) or 0
+            # Chunks are written in order, keep the ones the backend has completely
+            journal['chunks'] = [c for c in previous['chunks']
+                                 if c['offset'] + c['length'] <= remote_size]
+            # The last chunk is the one an interruption could have left wrong
+            while journal['chunks'] and \
+                    _remote_md5(backend, name, journal['chunks'][-1]) != journal['chunks'][-1]['md5']:
+                logger.warn("Chunk at byte {} of {} in {} does not match the journal, sending it again"
+                            .format(journal['chunks'][-1]['offset'], name, backend))
+                journal['chunks'].pop()
+    except (IOError, ValueError):
+        pass
+    offset = sum(c['length'] for c in journal['chunks'])
+    if offset:
+        logger.info("Resuming upload of {} from byte {}".format(f, offset))
+    with open(f, 'rb') as src:
+        src.seek(offset)
+        reader = _throttled(src, bwlimit)
+        while offset < st.st_size:
+            chunk = backends.ChecksumReader(backends.LimitedReader(reader, chunk_size), 'md5')
+            backend.write_chunk(name, offset, chunk)
+            journal['chunks'].append({'offset': offset, 'length': chunk.size,
+                                      'md5': chunk.hexdigest()})
+            _write_json(journal_file, journal)
+            offset += chunk.size
+
+
+def _remote_md5(backend, name, chunk):
+    """ md5 of a chunk of an object, as held by a storage backend
+
+    :param backend: taca.storage.backends.StorageBackend holding the object
+    :param str name: Object name in the backend
+    :param dict chunk: Chunk from an upload journal, with its offset and length
+    :returns: The hexadecimal md5 of the chunk
+    """
+    md5 = hashlib.md5()
+    for offset in range(chunk['offset'], chunk['offset'] + chunk['length'], backends.CHUNK_SIZE):
+        md5.update(backend.read_range(name, offset, min(backends.CHUNK_SIZE,
+                                                        chunk['offset'] + chunk['length'] - offset)))
+    return md5.hexdigest()
+
+
+def _write_json(path, data):
+    """ Replace a JSON file atomically, so that it is never left half written """
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def _create_archiving_marker(run):
+    """ Create the file telling that a run is being archived, saying by which process
+
+    :param str run: Run directory or archive
+    :returns: Path to the marker
+    """
+    marker = "{}.archiving".format(run.split('.')[0])
+    with open(marker, 'w') as f:
+        json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'started': time.time()}, f)
+    return marker
+
+
+def _is_being_archived(run):
+    """ Check if a run is being archived. Markers left behind by a process that
+    is gone (when written on this host), or older than 'storage.archive.marker_ttl'
+    hours (when written on another host), are stale and removed.
+
+    :param str run: Run directory or archive
+    :returns: True if another process is archiving the run
+    """
+    marker = "{}.archiving".format(run.split('.')[0])
+    if not os.path.exists(marker):
+        return False
+    ttl = CONFIG.get('storage', {}).get('archive', {}).get('marker_ttl', 72)
+    try:
+        with open(marker) as f:
+            owner = json.load(f)
+    except (IOError, ValueError):
+        # Written by an older version, only its age tells
+        owner = {}
+    if owner.get('host') == socket.gethostname():
+        # Markers from this host are stale once their process is gone
+        try:
+            os.kill(owner['pid'], 0)
+            stale = False
+        except OSError as e:
+            stale = e.errno == errno.ESRCH
+    else:
+        stale = os.stat(marker).st_mtime < time.time() - ttl * 3600
+    if stale:
+        logger.warn("Removing stale archiving marker {} ({})".format(marker, owner or 'no owner'))
+        os.remove(marker)
+    return not stale
+
+
+def _archive_parts(run, codec):
+    """ The archives a run is stored as. Normally the whole run goes into a
+    single archive, but:
+
+    - with 'storage.archive.layout: split' there is one archive per lane, per
+      project and for the undetermined reads, plus one for everything else
+      (the metadata), see _run_part
+    - with 'storage.archive.store_compressed' the files that are already
+      compressed (see taca.storage.codecs.PRECOMPRESSED_RE) are put in
+      separate, uncompressed tar archives so that the compressor only gets
+      the data it can actually shrink
+
+    :param str run: Run directory
+    :param codec: taca.storage.codecs.Codec for the compressible data
+    :returns: List of (archive name, codec, paths to archive or None for the
+        whole run, part name or None for the whole run)
+    """
+    conf = CONFIG.get('storage', {}).get('archive', {})
+    store_compressed = codec.command is not None and conf.get('store_compressed', False)
+    if conf.get('layout', 'single') == 'split':
+        groups = _split_run(run)
+    elif store_compressed:
+        compressible, precompressed = codecs.classify_run(run)
+        groups = OrderedDict([(None, compressible + precompressed)])
     else:
-        rta_file = os.path.join(run, 'RTAComplete.txt')
-        if not os.path.exists(rta_file) and not force:
-            logger.warn(("Run {} doesn't seem to be completed and --force option was "
-                      "not enabled, not archiving the run".format(run)))
-        if force or (os.path.exists(rta_file) and os.stat(rta_file).st_mtime < time.time() - (86400 * days)):
-            logger.info("Compressing run {}".format(run))
-            # Compress with pbzip2
-            misc.call_external_command('tar --use-compress-program=pbzip2 -cf {run}.tar.bz2 {run}'.format(run=run))
-            logger.info('Run {} successfully compressed! Removing from disk...'.format(run))
-            shutil.rmtree(run)
-            if not compress_only:
-                _send_to_swestore('{}.tar.bz2'.format(run), CONFIG.get('storage').get('irods').get('irodsHome'))
+        return [(codec.archive_name(run), codec, None, None)]
+    store = codecs.get_codec('store')
+    parts = []
+    for part, files in groups.items():
+        base = '{}.{}'.format(run, part) if part else run
+        if store_compressed:
+            compressible = [f for f in files if not codecs.is_precompressed(f)]
+            precompressed = [f for f in files if codecs.is_precompressed(f)]
+            parts.append((codec.archive_name(base), codec, compressible, part))
+            if precompressed:
+                parts.append((store.archive_name(base), store, precompressed, part))
         else:
-            logger.info("Run {} is not completed or is not {} days old yet. Not archiving".format(run, str(days)))
-    os.remove("{}.archiving".format(run.split('.')[0]))
+            parts.append((codec.archive_name(base), codec, files, part))
+    return parts
+
+
+def _run_part(path, is_dir):
+    """ Name of the archive a path of a run goes to in the split layout
+
+    :param str path: Path relative to the run directory
+    :param bool is_dir: If the path is a directory
+    :returns: 'lane<N>', 'project_<project>', 'undetermined' or 'metadata'
+    """
+    components = path.split(os.sep)
+    if components[0] in ['Data', 'Thumbnail_Images']:
+        for component in components:
+            lane = re.match(LANE_RE, component)
+            if lane:
+                return 'lane{}'.format(int(lane.group(1)))
+    elif components[0] == 'Demultiplexing' and len(components) > 1:
+        if len(components) == 2 and not is_dir:
+            if components[1].startswith('Undetermined'):
+                return 'undetermined'
+        elif components[1] not in DEMULTIPLEXING_METADATA:
+            return 'project_{}'.format(components[1])
+    return 'metadata'
+
+
+def _split_run(run):
+    """ Group the paths of a run by the archive they go to in the split layout.
+    Directories go with the files under them, so that every archive is complete.
+
+    :param str run: Run directory
+    :returns: OrderedDict of part name to list of paths, metadata first
+    """
+    groups = OrderedDict([('metadata', [run])])
+
+    def _directory(path):
+        groups.setdefault(_run_part(os.path.relpath(path, run), True), []).append(path)
+        return False
+
+    for path, _ in filesystem.scan_tree(run, prune=_directory):
+        groups.setdefault(_run_part(os.path.relpath(path, run), False), []).append(path)
+    return groups
+
+
+def _part_workers(parts):
+    """ Number of archives of a run written and uploaded at the same time,
+    'storage.archive.part_workers'
+    """
+    return max(1, min(len(parts), CONFIG.get('storage', {}).get('archive', {}).get('part_workers', 4)))
+
+
+def _run_manifest(run, codec, parts):
+    """ Top level manifest of the archives of a run
+
+    :returns: The manifest as a JSON string
+    """
+    return json.dumps({'run': run, 'codec': codec.name,
+                       'archives': [{'name': name, 'part': part, 'codec': part_codec.name}
+                                    for name, part_codec, _, part in parts]},
+                      indent=2, sort_keys=True)
+
+
+def _write_run_manifest(run, codec, parts):
+    """ Write the top level manifest of the archives of a run next to them
+
+    :returns: Path to the manifest
+    """
+    manifest = run + RUN_MANIFEST_SUFFIX
+    with open(manifest, 'w') as f:
+        f.write(_run_manifest(run, codec, parts))
+    return manifest
+
+
+@contextlib.contextmanager
+def _tar_members(run, files):
+    """ Arguments for tar selecting the members of an archive
+
+    :param str run: Run directory
+    :param list files: Paths to archive, without recursing into directories,
+        or None to archive the whole run
+    """
+    if files is None:
+        yield [run]
+        return
+    with tempfile.NamedTemporaryFile(prefix='taca_tar_') as file_list:
+        file_list.write('\0'.join(files))
+        file_list.flush()
+        yield ['--no-recursion', '--null', '-T', file_list.name]
+
+
+def _stream_run(run, backend):
+    """ Archive a run straight into a storage backend, piping tar through the
+    compressor into the upload without writing the archive to disk. The checksum
+    is computed on the way and compared to the one computed by the backend.
+
+    :param str run: Run directory
+    :param backend: taca.storage.backends.StorageBackend to upload to
+    :returns: True if all the archives of the run are in the backend and their
+        checksums match
+    """
+    codec = _archive_codec()
+    parts = _archive_parts(run, codec)
+    if any(backend.exists(name) for name, _, _, _ in parts):
+        logger.warn('Run {} is already in {}, not sending it again nor removing from the disk'
+                    .format(run, backend))
+        return False
+    algorithm = CONFIG.get('storage', {}).get('archive', {}).get('checksum', 'md5')
+    logger.info("Streaming run {} to {} with {}".format(run, backend, codec))
+    workers = _part_workers(parts)
+    threads = _ARCHIVE_LIMITS['compress_threads']
+    threads = max(1, threads // workers) if threads else None
+
+    def _stream_in_slot((name, part_codec, files, part)):
+        # Every part is an upload of its own, counted against the limits
+        with _upload_slot() as bwlimit:
+            return _stream_part(run, name, _compress_command(part_codec, threads),
+                                files, backend, algorithm, _new_index(part_codec), bwlimit)
+
+    pool = ThreadPool(workers)
+    try:
+        sent = pool.map(_stream_in_slot, parts)
+    finally:
+        pool.close()
+        pool.join()
+    if all(sent) and (len(parts) > 1 or parts[0][3]):
+        try:
+            with _upload_slot():
+                backend.put_stream(StringIO(_run_manifest(run, codec, parts)),
+                                   run + RUN_MANIFEST_SUFFIX)
+        except Exception as e:
+            logger.error("Could not upload the manifest of {}: {}".format(run, e))
+            _remove_from_backend(backend, run + RUN_MANIFEST_SUFFIX)
+            sent = [False]
+    if not all(sent):
+        # Parts already sent would make the next attempt think the run is archived
+        for name, _, _, _ in parts:
+            _remove_from_backend(backend, name)
+    return all(sent)
+
+
+@contextlib.contextmanager
+def _upload_slot():
+    """ Wait for one of the uploads allowed to the archiving workers and for a
+    transfer slot on the host, and hold them for the duration of the context
+
+    :returns: The bandwidth limit of the upload in KB/s, or None
+    """
+    upload_slots = _ARCHIVE_LIMITS['upload_slots']
+    if upload_slots:
+        upload_slots.acquire()
+    try:
+        with transfer.TransferGovernor().slot('archive') as bwlimit:
+            yield bwlimit
+    finally:
+        if upload_slots:
+            upload_slots.release()
+
+
+def _throttled(stream, bwlimit):
+    """ Limit the bandwidth of an upload holding an _upload_slot, taking its
+    share of the budget again as other transfers start and end
+
+    :param stream: Object with a read() method
+    :param int bwlimit: Bandwidth limit in KB/s, or None
+    :returns: The stream, throttled if there is a limit
+    """
+    if not bwlimit:
+        return stream
+    return transfer.ThrottledReader(stream, bwlimit, refresh=lambda: transfer.TransferGovernor().share('archive'))
+
+
+def _remove_from_backend(backend, name):
+    """ Remove an archive, with its checksum manifest and index, from a storage
+    backend, so that a failed upload leaves nothing behind
+
+    :param backend: taca.storage.backends.StorageBackend
+    :param str name: Archive name in the backend
+    """
+    for obj in [name, name + backends.CHECKSUM_SUFFIX, name + blocks.INDEX_SUFFIX]:
+        try:
+            if backend.size(obj) is not None:
+                backend.remove(obj)
+        except Exception as e:
+            logger.error("Could not remove {} from {}: {}".format(obj, backend, e))
+
+
+@contextlib.contextmanager
+def _archive_stream(run, compressor, files, algorithms, index=None):
+    """ Run tar, piped through the compressor, on a run and give its output as
+    a ChecksumReader, so that the digests are computed while the data flows
+
+    :param str run: Run directory
+    :param list compressor: Compression command, or None for a plain tar
+    :param list files: Paths to archive, or None for the whole run
+    :param list algorithms: Digests to compute
+    :param dict index: If given, compress in independent blocks (see
+        taca.storage.blocks) and fill it with the blocks and members
+    :raises subprocess.CalledProcessError: If tar or the compressor fail
+    """
+    with _tar_members(run, files) as members:
+        commands = [['tar', '-cf', '-'] + members]
+        procs = [subprocess.Popen(commands[0], stdout=subprocess.PIPE)]
+        if index is not None:
+            block_size = CONFIG.get('storage', {}).get('archive', {}).get('block_size', 16)
+            output = blocks.BlockCompressor(procs[0].stdout, compressor, int(block_size * 1024 * 1024))
+        elif compressor:
+            commands.insert(0, compressor)
+            procs.insert(0, subprocess.Popen(compressor, stdin=procs[0].stdout, stdout=subprocess.PIPE))
+            # Let tar get a SIGPIPE if the compressor dies
+            procs[1].stdout.close()
+            output = procs[0].stdout
+        else:
+            output = procs[0].stdout
+        try:
+            yield backends.ChecksumReader(output, algorithms)
+        finally:
+            procs[0].stdout.close()
+            returncodes = [p.wait() for p in procs]
+        for command, returncode in zip(commands, returncodes):
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, ' '.join(command))
+        if index is not None:
+            index.update(output.index)
+
+
+def _new_index(codec):
+    """ Index to fill when archiving in blocks, if 'storage.archive.indexed' is set
+
+    :param codec: taca.storage.codecs.Codec of the archive
+    :returns: A dictionary, or None if archives are not indexed
+    """
+    if CONFIG.get('storage', {}).get('archive', {}).get('indexed', False):
+        return {'codec': codec.name}
+    return None
+
+
+def _write_archive(run, archive, compressor, files, index=None):
+    """ Write an archive of a run to disk, together with its checksum manifest
+    and, if written in blocks, its index
+
+    :param str run: Run directory
+    :param str archive: Archive path
+    :param list compressor: Compression command, or None for a plain tar
+    :param list files: Paths to archive, or None for the whole run
+    :param dict index: If given, compress in blocks and fill it, see _archive_stream
+    :raises subprocess.CalledProcessError: If tar or the compressor fail
+    """
+    # Written under a temporary name, so that a failed archive is never taken
+    # for a complete one, and only renamed once its manifest is written
+    tmp_archive = archive + '.tmp'
+    try:
+        with _archive_stream(run, compressor, files, _digest_algorithms(), index) as stream, \
+                open(tmp_archive, 'wb') as dest:
+            for chunk in iter(lambda: stream.read(backends.CHUNK_SIZE), ''):
+                dest.write(chunk)
+        with open(archive + backends.CHECKSUM_SUFFIX, 'w') as manifest:
+            manifest.write(backends.checksum_manifest(os.path.basename(archive), stream))
+        if index is not None:
+            with open(archive + blocks.INDEX_SUFFIX, 'w') as f:
+                json.dump(index, f)
+        os.rename(tmp_archive, archive)
+    except:
+        for path in [tmp_archive, archive + backends.CHECKSUM_SUFFIX, archive + blocks.INDEX_SUFFIX]:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+
+def _stream_part(run, name, compressor, files, backend, algorithm, index=None, bwlimit=None):
+    """ Stream one archive of a run into a storage backend, see _stream_run.
+    Its checksum manifest, and index if written in blocks, are uploaded next to it.
+
+    :param str run: Run directory
+    :param str name: Archive name in the backend
+    :param list compressor: Compression command, or None to upload the plain tar
+    :param list files: Paths to archive, or None for the whole run
+    :param backend: taca.storage.backends.StorageBackend to upload to
+    :param str algorithm: Checksum algorithm compared with the backend
+    :param dict index: If given, compress in blocks and fill it, see _archive_stream
+    :param int bwlimit: Bandwidth limit in KB/s, or None
+    :returns: True if the archive is in the backend and its checksum matches
+    """
+    try:
+        with _archive_stream(run, compressor, files, _digest_algorithms(), index) as stream:
+            backend.put_stream(_throttled(stream, bwlimit), name)
+        remote = _remote_checksum(backend, name, algorithm)
+        if remote != stream.hexdigest(algorithm):
+            logger.error("Checksum of {} in {} ({}) does not match the one of the data sent ({})"
+                         .format(name, backend, remote, stream.hexdigest(algorithm)))
+            _remove_from_backend(backend, name)
+            return False
+        backend.put_stream(StringIO(backends.checksum_manifest(name, stream)),
+                           name + backends.CHECKSUM_SUFFIX)
+        if index is not None:
+            backend.put_stream(StringIO(json.dumps(index)), name + blocks.INDEX_SUFFIX)
+    except Exception as e:
+        # tar or the compressor failing, or any error of the backend
+        logger.error("Could not archive {}: {}".format(name, e))
+        _remove_from_backend(backend, name)
+        return False
+    return True
+
+
+def extract(archive, members, dest, backend=None):
+    """ Extract some files from an archive written in blocks, fetching only
+    the blocks they are in
+
+    :param str archive: Archive name in the storage backend
+    :param list members: Files or directories to extract, as named in the archive
+    :param str dest: Directory to extract them to
+    :param str backend: Storage backend, by default 'storage.archive.backend'
+    :returns: List of the paths extracted
+    """
+    extracted = blocks.extract(backends.get_backend(backend), archive, members, dest)
+    if not extracted:
+        logger.warn("Nothing in {} matches {}".format(archive, ', '.join(members)))
+    return extracted
+
+
+def _restore_run(run, dest, backend, threads, bwlimit=None, parts=None):
+    """ Restore all (or some parts of) the archives of a run, see restore_runs
+
+    :param str run: Run name
+    :param str dest: Directory to restore the run into
+    :param backend: taca.storage.backends.StorageBackend holding the archives
+    :param int threads: Decompression threads
+    :param int bwlimit: Bandwidth limit in KB/s, or None
+    :param list parts: Parts of split archives to restore, or None for all of them
+    :returns: True if the run was restored and all checksums matched
+    """
+    run = os.path.basename(run.rstrip('/'))
+    target = os.path.join(dest, run)
+    if os.path.exists(target):
+        logger.error("{} already exists, not restoring run {} over it".format(target, run))
+        return False
+    # An error of the backend only fails this run, not the others restored with it
+    try:
+        manifest = backend.read_json(run + RUN_MANIFEST_SUFFIX)
+        if manifest:
+            archives = [(a['name'], codecs.get_codec(a['codec'])) for a in manifest['archives']
+                        if not parts or a['part'] in parts]
+        else:
+            archives = [(codec.archive_name(run), codec) for codec in codecs.CODECS.values()
+                        if backend.exists(codec.archive_name(run))]
+        if not archives:
+            logger.error("No archives of run {} found in {}".format(run, backend))
+            return False
+        tmp_dir = os.path.join(dest, '.{}.restoring'.format(run))
+        filesystem.create_folder(tmp_dir)
+        try:
+            governor = transfer.TransferGovernor()
+            with governor.slot('restore') as share:
+                limits = [l for l in [share, bwlimit] if l]
+                # The share of the budget changes as other transfers start and end
+                refresh = lambda: min(l for l in [governor.share('restore'), bwlimit] if l)
+                for name, codec in archives:
+                    if not _restore_archive(backend, name, codec, tmp_dir, threads,
+                                            min(limits) if limits else None,
+                                            refresh if share else None):
+                        return False
+            os.rename(os.path.join(tmp_dir, run), target)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except Exception as e:
+        logger.error("Could not restore run {}: {}".format(run, e))
+        return False
+    logger.info("Run {} restored to {}".format(run, target))
+    return True
+
+
+def _restore_archive(backend, name, codec, dest, threads, bwlimit=None, refresh=None):
+    """ Stream an archive from a storage backend into tar, verifying its checksum
+
+    The checksum is compared with the one in the checksum manifest of the
+    archive or, for archives without one, with the one computed by the backend.
+
+    :param backend: taca.storage.backends.StorageBackend holding the archive
+    :param str name: Archive name
+    :param codec: taca.storage.codecs.Codec the archive was compressed with
+    :param str dest: Directory to extract the archive in
+    :param int threads: Decompression threads
+    :param int bwlimit: Bandwidth limit in KB/s, or None
+    :param refresh: Function giving the current bandwidth limit, see
+        taca.utils.transfer.ThrottledReader
+    :returns: True if the archive was extracted and its checksum matches
+    """
+    checksums = backend.read_json(name + backends.CHECKSUM_SUFFIX)
+    if checksums:
+        algorithm = 'sha256' if 'sha256' in checksums['digests'] else 'md5'
+        expected = checksums['digests'].get(algorithm)
+    else:
+        algorithm = CONFIG.get('storage', {}).get('archive', {}).get('checksum', 'md5')
+        expected = backend.checksum(name, algorithm)
+    logger.info("Restoring {} from {}".format(name, backend))
+    decompressor = codec.decompress_command(threads)
+    tar_command = ['tar', '-xf', '-', '-C', dest]
+    if decompressor:
+        procs = [subprocess.Popen(decompressor, stdin=subprocess.PIPE, stdout=subprocess.PIPE)]
+        procs.append(subprocess.Popen(tar_command, stdin=procs[0].stdout))
+        procs[0].stdout.close()
+    else:
+        procs = [subprocess.Popen(tar_command, stdin=subprocess.PIPE)]
+    try:
+        with backend.open_stream(name) as src:
+            stream = backends.ChecksumReader(src, algorithm)
+            reader = transfer.ThrottledReader(stream, bwlimit, refresh) if bwlimit else stream
+            for chunk in iter(lambda: reader.read(backends.CHUNK_SIZE), ''):
+                procs[0].stdin.write(chunk)
+    except (IOError, subprocess.CalledProcessError) as e:
+        logger.error("Could not restore {}: {}".format(name, e))
+        return False
+    finally:
+        procs[0].stdin.close()
+        failed = [p for p in procs if p.wait() != 0]
+    if failed:
+        logger.error("Restoring {} failed, the decompressor or tar exited with an error".format(name))
+        return False
+    if stream.hexdigest() != expected:
+        logger.error("Checksum of {} ({}) does not match the expected one ({})"
+                     .format(name, stream.hexdigest(), expected))
+        return False
+    return True
 
 
 def get_closed_projects(projs, pj_con, days):
@@ -268,21 +1266,53 @@ def get_closed_projects(projs, pj_con, days):
     :param obj pj_con: connection object to project database
     :param int days: number of days to check
     """
-    closed_projs = []
+    return [proj for proj, close_date in _project_close_dates(projs, pj_con).items()
+            if misc.days_old(close_date,date_format='%Y-%m-%d') > days]
+
+
+def _project_close_dates(projs, pj_con):
+    """Close dates of the closed projects among the given ones
+
+    The projects are fetched from StatusDB in a single view request, and their
+    close dates reused for 'cleanup.close_date_ttl' seconds, also by the next
+    processes if 'cleanup.close_date_cache' is set.
+
+    :param list projs: list of projects to check
+    :param obj pj_con: connection object to project database
+    :returns: dictionary of project name to close date, as '%Y-%m-%d'
+    """
+    ttl = CONFIG.get('cleanup', {}).get('close_date_ttl', CLOSE_DATE_TTL)
+    cache_file = CONFIG.get('cleanup', {}).get('close_date_cache')
+    now = time.time()
+    if cache_file:
+        try:
+            with open(cache_file) as f:
+                for proj, (fetched, in_db, close_date) in json.load(f).items():
+                    if proj not in _CLOSE_DATES or _CLOSE_DATES[proj][0] < fetched:
+                        _CLOSE_DATES[proj] = (fetched, in_db, close_date)
+        except (IOError, ValueError, TypeError):
+            pass
+    missing = [p for p in projs if p not in _CLOSE_DATES or _CLOSE_DATES[p][0] < now - ttl]
+    if missing:
+        found = {}
+        for row in pj_con.db.view('project/project_name', keys=missing,
+                                  include_docs=True, reduce=False):
+            found[row.key] = (row.doc or {}).get('close_date')
+        for proj in missing:
+            _CLOSE_DATES[proj] = (now, proj in found, found.get(proj))
+        if cache_file:
+            _write_json(cache_file, dict((p, d) for p, d in _CLOSE_DATES.items() if d[0] >= now - ttl))
+    close_dates = OrderedDict()
     for proj in projs:
-        if proj not in pj_con.name_view.keys():
+        _, in_db, close_date = _CLOSE_DATES[proj]
+        if not in_db:
             logger.warn("Project {} is not in database, so SKIPPING it.."
                         .format(proj))
-            continue
-        proj_db_obj = pj_con.get_entry(proj)
-        try:
-            proj_close_date = proj_db_obj['close_date']
-        except KeyError:
+        elif not close_date:
             logger.warn("Project {} is either open or too old, so SKIPPING it..".format(proj))
-            continue
-        if misc.days_old(proj_close_date,date_format='%Y-%m-%d') > days:
-            closed_projs.append(proj)
-    return closed_projs
+        else:
+            close_dates[proj] = close_date
+    return close_dates
 
 
 def check_days(site, days, config):
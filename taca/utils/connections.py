@@ -0,0 +1,146 @@
+""" Pooled connections to the external services used by TACA
+
+Connections are created lazily the first time they are requested and are then
+reused for the whole lifetime of the process, so that processing many runs in
+a single invocation does not pay a TCP (and authentication) handshake per run.
+"""
+import logging
+import os
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from taca.utils.config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+# HTTP status codes that are worth retrying, usually a proxy or CouchDB restarting
+RETRY_STATUS = [500, 502, 503, 504]
+
+_SESSIONS = {}
+_COUCH_SERVERS = {}
+_PROJECT_CONNECTIONS = {}
+_IRODS_SESSIONS = {}
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """ HTTPAdapter that applies a default timeout to every request sent
+    through it, unless one is explicitly given.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, *args, **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+def connection_settings():
+    """ Read timeout and retry settings from the configuration file
+
+    :returns: A tuple (timeout, retries, backoff_factor)
+    :rtype: tuple
+    """
+    conf = CONFIG.get('connections', {})
+    return (conf.get('timeout', DEFAULT_TIMEOUT),
+            conf.get('retries', DEFAULT_RETRIES),
+            conf.get('backoff_factor', DEFAULT_BACKOFF))
+
+
+def get_session(name='default'):
+    """ Return a keep-alive HTTP session, shared by every caller using the same name
+
+    :param str name: Name of the session, i.e the service it talks to
+    :returns: A session with retries, backoff and a default timeout
+    :rtype: requests.Session
+    """
+    if name not in _SESSIONS:
+        timeout, retries, backoff = connection_settings()
+        # Once retries are exhausted, hand back the last response instead of raising
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=RETRY_STATUS, raise_on_status=False)
+        adapter = TimeoutHTTPAdapter(timeout=timeout, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        logger.debug('Created HTTP session {}'.format(name))
+        _SESSIONS[name] = session
+    return _SESSIONS[name]
+
+
+def get_statusdb_server():
+    """ Return a CouchDB server for StatusDB, shared by the whole process
+
+    The server is built from the ``statusdb`` section of the configuration file
+    (url, port, username and password).
+
+    :returns: The CouchDB server
+    :rtype: couchdb.Server
+    """
+    if 'statusdb' not in _COUCH_SERVERS:
+        import couchdb
+        db_conf = CONFIG['statusdb']
+        timeout, retries, backoff = connection_settings()
+        url = "http://{}:{}@{}:{}".format(db_conf['username'], db_conf['password'],
+                                          db_conf['url'], db_conf['port'])
+        session = couchdb.http.Session(timeout=timeout,
+                                       retry_delays=[backoff * 2 ** i for i in range(retries)])
+        _COUCH_SERVERS['statusdb'] = couchdb.Server(url, session=session)
+    return _COUCH_SERVERS['statusdb']
+
+
+def get_project_connection():
+    """ Return a connection to the projects database in StatusDB, shared by
+    the whole process
+
+    :returns: The projects database connection
+    :rtype: statusdb.db.connections.ProjectSummaryConnection
+    """
+    if 'projects' not in _PROJECT_CONNECTIONS:
+        from statusdb.db import connections as statusdb
+        _PROJECT_CONNECTIONS['projects'] = statusdb.ProjectSummaryConnection()
+    return _PROJECT_CONNECTIONS['projects']
+
+
+def get_irods_session():
+    """ Return an authenticated iRODS session, shared by the whole process
+
+    The session keeps its own pool of connections to the server, so puts,
+    listings and deletes reuse them instead of authenticating every time.
+    It is built from the iRODS environment file, 'storage.irods.environment_file'
+    or ~/.irods/irods_environment.json. Sessions are not shared with forked
+    processes, each process gets its own.
+
+    :returns: The iRODS session
+    :rtype: irods.session.iRODSSession
+    :raises ImportError: If python-irodsclient is not installed
+    """
+    pid = os.getpid()
+    if pid not in _IRODS_SESSIONS:
+        from irods.session import iRODSSession
+        env_file = CONFIG.get('storage', {}).get('irods', {}).get(
+            'environment_file', os.path.expanduser('~/.irods/irods_environment.json'))
+        _IRODS_SESSIONS[pid] = iRODSSession(irods_env_file=env_file)
+        logger.debug('Created iRODS session from {}'.format(env_file))
+    return _IRODS_SESSIONS[pid]
+
+
+def reset():
+    """ Close and forget all the pooled connections
+    """
+    for session in _SESSIONS.values():
+        session.close()
+    _SESSIONS.clear()
+    _COUCH_SERVERS.clear()
+    _PROJECT_CONNECTIONS.clear()
+    session = _IRODS_SESSIONS.pop(os.getpid(), None)
+    if session:
+        session.cleanup()
+    _IRODS_SESSIONS.clear()
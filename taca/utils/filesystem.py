@@ -1,13 +1,36 @@
 """ Filesystem utilities
 """
 import contextlib
+import errno
+import fcntl
+import heapq
+import json
+import logging
 import os
+import Queue
 import re
 import shutil
+import stat
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 from subprocess import check_call, CalledProcessError, Popen, PIPE
 
+try:
+    from os import scandir
+except ImportError:
+    # Python 2, use the backport if installed
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logger = logging.getLogger(__name__)
+
 RUN_RE = '\d{6}_[a-zA-Z\d\-]+_\d{4}_[AB0][A-Z\d]'
 PROJECT_RE = '[a-zA-Z]+\.[a-zA-Z]+_\d{2}_\d{2}'
+# FASTQ files with a hyphen in the sample name, renamed by control_fastq_filename
+HYPHEN_FASTQ_RE = '^(P[0-9]+)-([0-9]{3,4}).+fastq.*$'
 
 @contextlib.contextmanager
 def chdir(new_dir):
@@ -82,18 +105,586 @@ def is_in_file(file_path, text):
         content = f.read()
     return text in content
 
-def control_fastq_filename(demux_folder):
+def control_fastq_filename(demux_folder, manifest=None, workers=8):
     """Looks for fastq files with a hyphen in the sample nsame
     and turns it in an underscore.
 
+    Directories are listed in parallel, one level of the tree at a time. The
+    renames made and the modification time and subdirectories of every
+    directory are recorded in a manifest, so that directories that have not
+    changed since the previous call are not listed again. Directories removed
+    while they are listed are skipped.
+
     :param str demux_folder: path to the demultiplexed folder
+    :param str manifest: path to the manifest, by default a hidden file next
+        to the demultiplexed folder
+    :param int workers: number of directories to list simultaneously
     """
-    pattern=re.compile("^(P[0-9]+)-([0-9]{3,4}).+fastq.*$")
-    for root, dirs, files in os.walk(demux_folder):
-        for f in files:
-            matches=pattern.search(f)
+    demux_folder = os.path.normpath(demux_folder)
+    if not manifest:
+        manifest = os.path.join(os.path.dirname(demux_folder),
+                                '.{}_renames.json'.format(os.path.basename(demux_folder)))
+    try:
+        with open(manifest, 'r') as f:
+            previous = json.load(f)
+    except (IOError, ValueError):
+        previous = {'dirs': {}, 'renamed': []}
+    pattern=re.compile(HYPHEN_FASTQ_RE)
+
+    def _process(rel_dir):
+        path = os.path.join(demux_folder, rel_dir)
+        try:
+            cached = previous['dirs'].get(rel_dir)
+            if cached and cached['mtime'] == os.stat(path).st_mtime:
+                return rel_dir, cached, []
+            subdirs, files = _list_dir(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            logger.warn("{} was removed while looking for FASTQ files to rename, skipping it".format(path))
+            return rel_dir, None, []
+        renamed = []
+        for name in files:
+            matches=pattern.search(name)
             if matches:
-                new_name=f.replace("{}-{}".format(matches.group(1), matches.group(2)), "{}_{}".format(matches.group(1), matches.group(2)))
-                os.rename(os.path.join(root, f), os.path.join(root, new_name))
-            
+                new_name=name.replace("{}-{}".format(matches.group(1), matches.group(2)), "{}_{}".format(matches.group(1), matches.group(2)))
+                os.rename(os.path.join(path, name), os.path.join(path, new_name))
+                renamed.append([os.path.join(rel_dir, name), os.path.join(rel_dir, new_name)])
+        mtime = os.stat(path).st_mtime
+        # A directory modified right now could still change within the same
+        # timestamp, so don't trust its mtime on the next pass
+        if time.time() - mtime < 2:
+            mtime = None
+        return rel_dir, {'mtime': mtime, 'subdirs': subdirs}, renamed
+
+    current = {'dirs': {}, 'renamed': previous['renamed']}
+    pool = ThreadPool(workers)
+    try:
+        pending = ['']
+        while pending:
+            results = pool.map(_process, pending)
+            pending = []
+            for rel_dir, info, renamed in results:
+                if info is None:
+                    continue
+                current['dirs'][rel_dir] = info
+                current['renamed'].extend(renamed)
+                pending.extend(os.path.join(rel_dir, d) for d in info['subdirs'])
+    finally:
+        pool.close()
+        pool.join()
+    tmp_manifest = '{}.tmp'.format(manifest)
+    with open(tmp_manifest, 'w') as f:
+        json.dump(current, f)
+    os.rename(tmp_manifest, manifest)
+
+
+def same_device(path1, path2):
+    """ Checks if two paths are on the same filesystem
+
+    :param str path1: Existing path
+    :param str path2: Existing path
+    :returns bool: True if both paths are on the same device
+    """
+    return os.stat(path1).st_dev == os.stat(path2).st_dev
+
+
+def copy_file(src, dest, blocksize=16 * 1024 * 1024):
+    """ Copy a file's contents and metadata, in kernel space if possible
+
+    Uses ``os.sendfile`` when available (Python 3), a regular buffered copy otherwise.
+
+    :param str src: Source file
+    :param str dest: Destination file
+    :param int blocksize: Bytes to copy per call
+    """
+    if hasattr(os, 'sendfile'):
+        with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+            offset = 0
+            while True:
+                sent = os.sendfile(fdest.fileno(), fsrc.fileno(), offset, blocksize)
+                if sent == 0:
+                    break
+                offset += sent
+    else:
+        shutil.copyfile(src, dest)
+    shutil.copystat(src, dest)
+
+
+def move_tree(src, dest, workers=8):
+    """ Move a directory tree, as fast as the source and destination allow
+
+    If both are on the same filesystem, the directory is simply renamed.
+    Otherwise files are copied in parallel to a hidden directory next to the
+    destination and their sizes verified, then the copy is renamed to its
+    final name and only then the source is moved to the trash, to be deleted
+    in the background by the deletion_queue of the process.
+
+    :param str src: Directory to move
+    :param str dest: Destination path, must not exist
+    :param int workers: Number of files to copy simultaneously
+    :raises OSError: If the destination already exists or the copy does not verify
+    """
+    src = os.path.abspath(src)
+    dest = os.path.abspath(dest)
+    if os.path.exists(dest):
+        raise OSError("Destination {} already exists".format(dest))
+    if same_device(src, os.path.dirname(dest)):
+        os.rename(src, dest)
+        return
+    tmp_dest = os.path.join(os.path.dirname(dest), '.{}.moving'.format(os.path.basename(dest)))
+    if os.path.exists(tmp_dest):
+        # Left behind by an interrupted move
+        shutil.rmtree(tmp_dest)
+    to_copy = []
+    copied_dirs = []
+    for root, dirs, files in os.walk(src):
+        target_root = os.path.normpath(os.path.join(tmp_dest, os.path.relpath(root, src)))
+        os.mkdir(target_root)
+        copied_dirs.append((root, target_root))
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target_root, name))
+                if name in dirs:
+                    dirs.remove(name)
+            elif name in files:
+                to_copy.append((path, os.path.join(target_root, name)))
+    pool = ThreadPool(workers)
+    try:
+        pool.map(lambda paths: copy_file(*paths), to_copy)
+    finally:
+        pool.close()
+        pool.join()
+    for s, d in to_copy:
+        if os.path.getsize(s) != os.path.getsize(d):
+            raise OSError("Copy of {} to {} does not match the original".format(s, d))
+    # Directory times change while their contents are copied, so set them last
+    for s, d in reversed(copied_dirs):
+        shutil.copystat(s, d)
+    os.rename(tmp_dest, dest)
+    # The copy is in place, the source is deleted in the background
+    deletion_queue(workers).delete(src)
 
+
+# Name of the trash directory deleted trees are renamed into, see DeletionQueue
+TRASH_DIR = '.taca_trash'
+# Progress of the deletions in a trash directory
+TRASH_PROGRESS = 'progress.json'
+
+
+def trash_dir(path, trash_dirs=()):
+    """ Trash directory for a path, which must be on the same filesystem so
+    that the path can be renamed into it
+
+    :param str path: Path to be deleted
+    :param list trash_dirs: Trash directories to choose from, one per filesystem
+    :returns: The first of trash_dirs on the same filesystem as the path, or a
+        hidden directory next to the path if there is none
+    """
+    parent = os.path.dirname(os.path.abspath(path.rstrip('/')))
+    for trash in trash_dirs:
+        if os.path.isdir(trash) and same_device(trash, parent):
+            return trash
+    return os.path.join(parent, TRASH_DIR)
+
+
+def _lock_tree(path):
+    """ Lock a tree in the trash, so that only one process deletes it
+
+    The lock is an flock on the tree itself, released when its process closes
+    the file descriptor or dies. Symbolic links cannot be locked, but
+    unlinking them twice is harmless.
+
+    :returns: A tuple (locked, file descriptor holding the lock or None)
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError as e:
+        if e.errno == errno.ELOOP:
+            return True, None
+        if e.errno == errno.ENOENT:
+            return False, None
+        raise
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        os.close(fd)
+        if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+            return False, None
+        raise
+    return True, fd
+
+
+def _empty_directory(path):
+    """ Remove everything but the subdirectories in a directory
+
+    :returns: A tuple (files removed, subdirectories, errors)
+    """
+    removed, subdirs, errors = 0, [], 0
+    for name in os.listdir(path):
+        child = os.path.join(path, name)
+        try:
+            if os.path.isdir(child) and not os.path.islink(child):
+                subdirs.append(child)
+            else:
+                os.unlink(child)
+                removed += 1
+        except OSError as e:
+            logger.warn("Could not remove {}: {}".format(child, e))
+            errors += 1
+    return removed, subdirs, errors
+
+
+class DeletionQueue(object):
+    """ Deletes directory trees in the background
+
+    A tree is first renamed into the trash directory of its filesystem (see
+    trash_dir), so it is gone from its original place at once, and then
+    deleted by a background thread, which removes the files of a whole level
+    of directories in parallel. Whatever is in a trash is still to be deleted,
+    so deletions interrupted by a restart are taken up again the next time that
+    trash is used. Every tree is locked by the process deleting it, so that
+    several processes can share a trash. The progress is kept in the trash, in
+    progress.json.
+    """
+    def __init__(self, workers=8, trash_dirs=()):
+        """ :param int workers: directories emptied at the same time
+            :param list trash_dirs: trash directories, see trash_dir
+        """
+        self.workers = workers
+        self.trash_dirs = trash_dirs
+        self._queue = Queue.Queue()
+        self._trashes = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def delete(self, path):
+        """ Move a directory tree into the trash and queue it for deletion
+
+        :param str path: Directory to delete
+        :returns: Path of the tree in the trash
+        :raises OSError: If it cannot be moved to the trash
+        """
+        trash = trash_dir(path, self.trash_dirs)
+        create_folder(trash)
+        target = os.path.join(trash, '{}.{}.{}'.format(
+            os.path.basename(path.rstrip('/')), int(time.time()), os.getpid()))
+        # Locked before it is in the trash, so no other process takes it up
+        _, fd = _lock_tree(path)
+        try:
+            os.rename(path, target)
+        except OSError:
+            if fd is not None:
+                os.close(fd)
+            raise
+        self._use_trash(trash)
+        self._put(target, fd)
+        return target
+
+    def _use_trash(self, trash):
+        """ Take up the deletions left in a trash by earlier runs """
+        with self._lock:
+            if trash in self._trashes:
+                return
+            self._trashes.add(trash)
+        for name in sorted(os.listdir(trash)):
+            if name != TRASH_PROGRESS and not name.endswith('.tmp'):
+                # Trees locked are being deleted by another process (or this one)
+                locked, fd = _lock_tree(os.path.join(trash, name))
+                if locked:
+                    logger.info("Resuming deletion of {}".format(os.path.join(trash, name)))
+                    self._put(os.path.join(trash, name), fd)
+
+    def _put(self, target, fd=None):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work)
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put((target, fd))
+
+    def _work(self):
+        pool = ThreadPool(self.workers)
+        try:
+            while True:
+                target, fd = self._queue.get()
+                try:
+                    self._delete_tree(target, pool)
+                except Exception as e:
+                    # i.e no space left for the progress file, the next trees are still deleted
+                    logger.error("Could not delete {}, it stays in the trash: {}".format(target, e))
+                finally:
+                    if fd is not None:
+                        os.close(fd)
+                    self._queue.task_done()
+        finally:
+            pool.close()
+
+    def _delete_tree(self, target, pool):
+        if not os.path.lexists(target):
+            # Queued twice, or deleted by another process
+            return
+        if not os.path.isdir(target) or os.path.islink(target):
+            os.unlink(target)
+            return
+        started = time.time()
+        removed = 0
+        levels = []
+        level = [target]
+        while level:
+            levels.append(level)
+            results = pool.map(_empty_directory, level)
+            removed += sum(r[0] for r in results)
+            level = [d for r in results for d in r[1]]
+            self._save_progress(target, removed)
+        for level in reversed(levels):
+            pool.map(os.rmdir, level)
+        self._save_progress(target, None)
+        logger.info("Deleted {} ({} files in {:.0f} seconds)".format(
+            target, removed, time.time() - started))
+
+    def _save_progress(self, target, removed):
+        """ Record the files removed from a tree so far, None once it is gone """
+        trash = os.path.dirname(target)
+        progress_file = os.path.join(trash, TRASH_PROGRESS)
+        tmp_file = '{}.{}.tmp'.format(progress_file, os.getpid())
+        with self._lock:
+            # Other processes update the same file, so the trash is locked too
+            trash_fd = os.open(trash, os.O_RDONLY)
+            try:
+                fcntl.flock(trash_fd, fcntl.LOCK_EX)
+                try:
+                    with open(progress_file) as f:
+                        progress = json.load(f)
+                except (IOError, ValueError):
+                    progress = {}
+                if removed is None:
+                    progress.pop(os.path.basename(target), None)
+                else:
+                    entry = progress.setdefault(os.path.basename(target), {'removed': 0})
+                    entry['removed'] = max(entry['removed'], removed)
+                    entry['updated'] = time.time()
+                with open(tmp_file, 'w') as f:
+                    json.dump(progress, f, indent=2, sort_keys=True)
+                os.rename(tmp_file, progress_file)
+            finally:
+                os.close(trash_fd)
+
+    def wait(self):
+        """ Block until every queued deletion is done """
+        self._queue.join()
+
+
+_DELETION_QUEUES = {}
+
+
+def deletion_queue(workers=8, trash_dirs=()):
+    """ The DeletionQueue of the current process, the arguments are only used
+    when it is created
+    """
+    pid = os.getpid()
+    if pid not in _DELETION_QUEUES:
+        _DELETION_QUEUES[pid] = DeletionQueue(workers, trash_dirs)
+    return _DELETION_QUEUES[pid]
+
+
+def rsync_pattern_to_re(pattern):
+    """ Translate an rsync include/exclude pattern into a regular expression
+    matching paths relative to the transfer root.
+
+    Follows rsync rules: a pattern without a slash matches the file name, a
+    pattern with a leading slash is anchored at the transfer root, a single
+    ``*`` does not cross directory boundaries while ``**`` does.
+
+    :param str pattern: rsync pattern, i.e "*.fastq.gz" or "Demultiplexing/**"
+    :returns: Compiled regular expression to use with ``search``
+    """
+    anchored = pattern.startswith('/')
+    pattern = pattern.lstrip('/')
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        elif c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                regex += re.escape(c)
+            else:
+                regex += pattern[i:end + 1]
+                i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+    return re.compile(('^' if anchored else '(?:^|/)') + regex + r'\Z')
+
+
+def scan_tree(top, prune=None):
+    """ Recursively list the files under a directory in a single pass
+
+    Uses ``scandir`` when available, so that file types and sizes come from the
+    directory listing itself. Symbolic links are listed but never followed.
+
+    :param str top: Directory to scan
+    :param prune: Function taking a directory path and returning True if the
+        directory should not be descended into
+    :returns: Generator of (path, size in bytes) tuples
+    """
+    dirs = [top]
+    while dirs:
+        current = dirs.pop()
+        if scandir is not None:
+            for entry in scandir(current):
+                if entry.is_dir(follow_symlinks=False):
+                    if not (prune and prune(entry.path)):
+                        dirs.append(entry.path)
+                else:
+                    yield entry.path, entry.stat(follow_symlinks=False).st_size
+        else:
+            for name in os.listdir(current):
+                path = os.path.join(current, name)
+                st = os.lstat(path)
+                if stat.S_ISDIR(st.st_mode):
+                    if not (prune and prune(path)):
+                        dirs.append(path)
+                else:
+                    yield path, st.st_size
+
+
+def _list_usage(path):
+    """ Disk usage of the entries of a directory, without descending into it
+
+    :returns: A tuple (bytes, inodes, subdirectories)
+    """
+    used, inodes, subdirs = 0, 0, []
+    if scandir is not None:
+        for entry in scandir(path):
+            st = entry.stat(follow_symlinks=False)
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            used += st.st_blocks * 512
+            inodes += 1
+    else:
+        for name in os.listdir(path):
+            child = os.path.join(path, name)
+            st = os.lstat(child)
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(child)
+            used += st.st_blocks * 512
+            inodes += 1
+    return used, inodes, subdirs
+
+
+def _list_dir(path):
+    """ Names of the entries of a directory, without following symbolic links
+
+    :returns: A tuple (subdirectories, other entries)
+    """
+    subdirs, others = [], []
+    if scandir is not None:
+        for entry in scandir(path):
+            (subdirs if entry.is_dir(follow_symlinks=False) else others).append(entry.name)
+    else:
+        for name in os.listdir(path):
+            if stat.S_ISDIR(os.lstat(os.path.join(path, name)).st_mode):
+                subdirs.append(name)
+            else:
+                others.append(name)
+    return subdirs, others
+
+
+def tree_usage(top, workers=8, cache=None):
+    """ Disk usage of a directory tree, like ``du``, listing the directories
+    of each level of the tree in parallel
+
+    :param str top: Directory or file
+    :param int workers: number of directories to list simultaneously
+    :param dict cache: usage of the directories listed by earlier calls,
+        updated in place. Directories with the same modification time are not
+        listed again, so files rewritten in place without being renamed are
+        not noticed, which is fine for finished runs
+    :returns: A tuple (bytes used, inodes), including top itself
+    """
+    st = os.lstat(top)
+    used, inodes = st.st_blocks * 512, 1
+    if not stat.S_ISDIR(st.st_mode):
+        return used, inodes
+
+    def _usage(path):
+        mtime = os.lstat(path).st_mtime
+        cached = cache.get(path) if cache is not None else None
+        if cached and cached[0] == mtime:
+            return cached[1:]
+        result = _list_usage(path)
+        # A directory modified right now could still change within the same
+        # timestamp, so don't cache it yet
+        if cache is not None and time.time() - mtime >= 2:
+            cache[path] = [mtime] + list(result)
+        return result
+
+    pool = ThreadPool(workers)
+    try:
+        level = [top]
+        while level:
+            results = pool.map(_usage, level)
+            used += sum(r[0] for r in results)
+            inodes += sum(r[1] for r in results)
+            level = [d for r in results for d in r[2]]
+    finally:
+        pool.close()
+        pool.join()
+    return used, inodes
+
+
+def list_files_to_sync(run, patterns, skip=None):
+    """ List the files of a run that match any of the given rsync include patterns
+
+    Paths are returned relative to the parent directory of the run, so that
+    they can be given to rsync with ``--files-from`` and still end up in a
+    directory named as the run on the destination.
+
+    :param str run: Run directory
+    :param list patterns: rsync include patterns
+    :param list skip: rsync patterns of directories not to descend into,
+        i.e "Data/Intensities"
+    :returns: List of (relative path, size in bytes) tuples
+    :rtype: list
+    """
+    run = os.path.abspath(run)
+    parent = os.path.dirname(run)
+    regexes = [rsync_pattern_to_re(p) for p in patterns if not p.endswith('/')]
+    skip_regexes = [rsync_pattern_to_re(p.rstrip('/')) for p in skip or []]
+    prune = lambda d: any(r.search(os.path.relpath(d, parent)) for r in skip_regexes)
+    files = []
+    for path, size in scan_tree(run, prune=prune if skip_regexes else None):
+        rel_path = os.path.relpath(path, parent)
+        if any(r.search(rel_path) for r in regexes):
+            files.append((rel_path, size))
+    return files
+
+
+def split_by_size(files, n):
+    """ Split a list of files into n groups of roughly the same total size
+
+    Files are handed out largest first, each one to the currently smallest group.
+
+    :param list files: List of (path, size) tuples
+    :param int n: Number of groups
+    :returns: List of n lists of paths
+    :rtype: list
+    """
+    groups = [[] for i in range(n)]
+    heap = [(0, i) for i in range(n)]
+    for path, size in sorted(files, key=lambda f: f[1], reverse=True):
+        total, i = heapq.heappop(heap)
+        groups[i].append(path)
+        heapq.heappush(heap, (total + size, i))
+    return groups
@@ -91,6 +91,20 @@ def call_external_command_detached(cl, with_log_files=False, prefix=None):
             stderr.close()
     return p_handle
 
+def available_memory():
+    """ Return the memory available for new processes, as reported by the kernel
+
+    :returns: available memory in bytes, or None if it cannot be determined
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError, IndexError):
+        pass
+    return None
+
 def days_old(date, date_format="%y%m%d"):
     """ Return the number days between today and given date
 
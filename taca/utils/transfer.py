@@ -1,17 +1,223 @@
 """
     Helper classes for handling file trasfers
 """
+import contextlib
+import errno
+import fcntl
 import logging
 import os
 import shutil
 import subprocess
+import tempfile
+import time
 
+from taca.utils.config import CONFIG
 from taca.utils.filesystem import create_folder
 from taca.utils.misc import hashfile, call_external_command
 
 logger = logging.getLogger(__name__)
 
 
+class TransferGovernor(object):
+    """ Host-wide limit on the number of simultaneous transfers and on their
+        total bandwidth, shared by all TACA processes through lock files.
+
+        Each running transfer holds an exclusive lock on one of the slot files
+        in the lock directory and writes its priority weight into it. A new
+        transfer gets a share of the bandwidth budget proportional to its
+        weight, and lower priority transfers leave the reserved slots free for
+        analysis transfers. Locks are released by the OS if a process dies.
+
+        Shares are computed from the transfers running, so a transfer alone
+        gets the whole budget. Streamed transfers (see ThrottledReader) take
+        their share again every REFRESH_INTERVAL seconds, giving way to the
+        transfers started after them. rsync keeps the share it started with,
+        so until the transfers running take their share again or end, the
+        budget can be exceeded.
+    """
+    PRIORITIES = {
+        'analysis': 3,
+        'restore': 2,
+        'archive': 1,
+    }
+    # Number of slots used when only the bandwidth is limited
+    MAX_SLOTS = 32
+    # Seconds after which streamed transfers take their share again
+    REFRESH_INTERVAL = 30
+
+    def __init__(
+        self,
+        lock_dir=None,
+        max_transfers=None,
+        bandwidth=None,
+        reserved=None,
+        poll_interval=None):
+        """ Creates a governor, taking the defaults from the 'transfer' section
+            of the configuration file
+            :param string lock_dir: directory holding the slot lock files
+            :param int max_transfers: maximum number of simultaneous transfers,
+                None for no limit
+            :param int bandwidth: total bandwidth budget in KB/s, None for no limit
+            :param int reserved: number of slots only usable by the highest priority
+            :param int poll_interval: seconds to wait between attempts to get a slot
+        """
+        conf = CONFIG.get('transfer', {})
+        self.lock_dir = lock_dir or conf.get(
+            'lock_dir', os.path.join(tempfile.gettempdir(), 'taca_transfers'))
+        self.max_transfers = max_transfers or conf.get('max_transfers')
+        self.bandwidth = bandwidth or conf.get('bandwidth')
+        self.reserved = reserved if reserved is not None else conf.get('reserved', 0)
+        self.poll_interval = poll_interval or conf.get('poll_interval', 30)
+
+    @property
+    def enabled(self):
+        return bool(self.max_transfers or self.bandwidth)
+
+    def _slot_files(self):
+        create_folder(self.lock_dir)
+        n = self.max_transfers or self.MAX_SLOTS
+        return [os.path.join(self.lock_dir, 'slot{}'.format(i)) for i in range(n)]
+
+    def _try_lock(self, slot_file):
+        """ Try to lock a slot file without blocking
+            :returns: the open file object if the lock was acquired, None otherwise
+        """
+        fh = open(slot_file, 'a+')
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            fh.close()
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                return None
+            raise
+        return fh
+
+    def active_weights(self):
+        """ Read the priority weights of the transfers currently running
+            :returns: list of weights, one per busy slot
+        """
+        weights = []
+        for slot_file in self._slot_files():
+            fh = self._try_lock(slot_file)
+            if fh is not None:
+                # Nobody holds this slot
+                fcntl.flock(fh, fcntl.LOCK_UN)
+                fh.close()
+                continue
+            try:
+                with open(slot_file) as f:
+                    weights.append(int(f.read().strip() or 1))
+            except (IOError, ValueError):
+                weights.append(1)
+        return weights
+
+    def _acquire(self, weight, top_priority):
+        """ Lock a free slot, respecting the slots reserved to the top priority
+            :returns: the locked file object, or None if no slot is available
+        """
+        slot_files = self._slot_files()
+        if not top_priority and self.max_transfers:
+            busy = len(self.active_weights())
+            if busy >= self.max_transfers - self.reserved:
+                return None
+        for slot_file in slot_files:
+            fh = self._try_lock(slot_file)
+            if fh is not None:
+                fh.seek(0)
+                fh.truncate()
+                fh.write(str(weight))
+                fh.flush()
+                return fh
+        return None
+
+    def bandwidth_share(self, weight):
+        """ Share of the bandwidth budget for a transfer with the given weight,
+            considering the transfers running now (including itself)
+            :returns: bandwidth limit in KB/s, or None if there is no budget
+        """
+        if not self.bandwidth:
+            return None
+        weights = self.active_weights()
+        total = sum(weights) if weights else weight
+        return max(1, int(self.bandwidth * weight / total))
+
+    def share(self, priority='analysis'):
+        """ Current share of a transfer holding a slot, to refresh the limit
+            of a ThrottledReader
+            :param string priority: one of the keys in PRIORITIES
+            :returns: bandwidth limit in KB/s, or None if there is no budget
+        """
+        return self.bandwidth_share(self.PRIORITIES.get(priority, 1))
+
+    @contextlib.contextmanager
+    def slot(self, priority='analysis'):
+        """ Wait for a free transfer slot and hold it for the duration of
+            the context
+            :param string priority: one of the keys in PRIORITIES
+            :returns: the bandwidth limit for this transfer in KB/s, or None
+                if there is no bandwidth budget
+        """
+        if not self.enabled:
+            yield None
+            return
+        weight = self.PRIORITIES.get(priority, 1)
+        top_priority = weight == max(self.PRIORITIES.values())
+        fh = self._acquire(weight, top_priority)
+        while fh is None:
+            logger.info("All transfer slots are busy, waiting {} seconds "
+                        "for a free one".format(self.poll_interval))
+            time.sleep(self.poll_interval)
+            fh = self._acquire(weight, top_priority)
+        try:
+            bwlimit = self.bandwidth_share(weight)
+            if bwlimit:
+                logger.debug("Transfer limited to {} KB/s".format(bwlimit))
+            yield bwlimit
+        finally:
+            fh.seek(0)
+            fh.truncate()
+            fcntl.flock(fh, fcntl.LOCK_UN)
+            fh.close()
+
+
+class ThrottledReader(object):
+    """ Wraps a file-like object, keeping the average read rate under a limit,
+        for transfers that are not done by rsync (and its --bwlimit)
+    """
+    def __init__(self, stream, bwlimit, refresh=None,
+                 refresh_interval=TransferGovernor.REFRESH_INTERVAL):
+        """ :param stream: object with a read() method
+            :param int bwlimit: bandwidth limit in KB/s
+            :param refresh: function giving the current limit in KB/s, called
+                every refresh_interval seconds, i.e TransferGovernor.share
+            :param int refresh_interval: seconds between calls to refresh
+        """
+        self.stream = stream
+        self.rate = bwlimit * 1024.0
+        self.refresh = refresh
+        self.refresh_interval = refresh_interval
+        self.started = None
+        self.transferred = 0
+
+    def read(self, size=-1):
+        now = time.time()
+        if self.started is None:
+            self.started = now
+        elif self.refresh and now - self.started >= self.refresh_interval:
+            bwlimit = self.refresh()
+            if bwlimit:
+                # The average is only kept from now on, at the new rate
+                self.rate = bwlimit * 1024.0
+                self.started = now
+                self.transferred = 0
+        data = self.stream.read(size)
+        self.transferred += len(data)
+        ahead = self.transferred / self.rate - (time.time() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+        return data
+
+
 class TransferAgent(object):
     """
         (Abstract) superclass representing an Agent that performs file transfers. 
@@ -121,6 +327,7 @@ class RsyncAgent(TransferAgent):
         validate=True,
         digestfile=None,
         opts=None, 
+        priority='analysis',
         **kwargs):
         """ Creates an RsyncAgent instance 
             :param string src_path: the file or folder that should be transferred
@@ -135,6 +342,8 @@ class RsyncAgent(TransferAgent):
                 transferred. Must be specified if validate is True. The checksum
                 algorithm will be inferred from the extension of the digest file
             :param opts: options that will be passed to the rsync command
+            :param string priority: priority of the transfer for the
+                TransferGovernor, 'analysis' or 'archive'
         """
         super(RsyncAgent, self).__init__(
             src_path=src_path,
@@ -144,6 +353,7 @@ class RsyncAgent(TransferAgent):
         self.remote_host = remote_host
         self.remote_user = remote_user
         self.digestfile = digestfile
+        self.priority = priority
 
     def transfer(self, transfer_log=None):
         """ 
@@ -157,14 +367,18 @@ class RsyncAgent(TransferAgent):
         """
         self.validate_src_path()
         self.validate_dest_path()
-        command = [self.CMD] + self.format_options() + [self.src_path,self.remote_path()]
-        try:
-            call_external_command(
-                command,
-                with_log_files=(transfer_log is not None),
-                prefix=transfer_log)
-        except subprocess.CalledProcessError as e:
-            raise RsyncError(e)
+        with TransferGovernor().slot(self.priority) as bwlimit:
+            command = [self.CMD] + self.format_options()
+            if bwlimit:
+                command.append("--bwlimit={}".format(bwlimit))
+            command.extend([self.src_path,self.remote_path()])
+            try:
+                call_external_command(
+                    command,
+                    with_log_files=(transfer_log is not None),
+                    prefix=transfer_log)
+            except subprocess.CalledProcessError as e:
+                raise RsyncError(e)
         return (not self.validate) or self.validate_transfer()
         
     def remote_path(self):
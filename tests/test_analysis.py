@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 
+import BaseHTTPServer
+import json
+import mock
 import os
 import shutil
+import tempfile
+import threading
 import unittest
 
 from datetime import datetime
 
 from taca.analysis.analysis import *
 from taca.illumina import Run
+from taca.utils import connections, misc
 
 def processing_status(run_dir):
     demux_dir = os.path.join(run_dir, 'Demultiplexing')
@@ -108,3 +114,229 @@ class TestTracker(unittest.TestCase):
         self.assertFalse(is_transferred(self.running.id, self.transfer_file))
         self.assertFalse(is_transferred(self.to_start.id, self.transfer_file))
         self.assertFalse(is_transferred(self.in_progress.id, self.transfer_file))
+
+
+class TestTransferLanes(unittest.TestCase):
+    """ Tests for the transfer of finished lanes during demultiplexing
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_taca_lanes')
+        self.run = os.path.join(self.tmp_dir, '141124_ST-E00201_0001_AFCIDXX')
+        sample_dir = os.path.join(self.run, 'Demultiplexing', 'P1', 'Sample_P1_101')
+        os.makedirs(sample_dir)
+        for f in [os.path.join(sample_dir, 'P1_101_S1_L001_R1_001.fastq.gz'),
+                  os.path.join(sample_dir, 'P1_101_S1_L002_R1_001.fastq.gz'),
+                  os.path.join(sample_dir, 'P1-102_S2_L001_R1_001.fastq.gz'),
+                  os.path.join(self.run, 'Demultiplexing', 'Undetermined_S0_L001_R1_001.fastq.gz')]:
+            open(f, 'w').close()
+        self.config = {'analysis': {'analysis_server': {
+            'user': 'user', 'host': 'host',
+            'sync': {'data_archive': '/data', 'include': ['*.fastq.gz']}}}}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_transfer_lanes(self):
+        """ Only the final files of the finished lanes should be sent, and only once
+        """
+        sent = []
+        def rsync(command_line, **kwargs):
+            manifest = [o for o in command_line if o.startswith('--files-from=')][0]
+            with open(manifest.split('=', 1)[1]) as f:
+                sent.extend(f.read().split())
+        with mock.patch.dict(CONFIG, self.config), \
+                mock.patch('taca.analysis.analysis.misc.call_external_command', side_effect=rsync):
+            transfer_lanes(self.run, [1])
+            self.assertEqual(
+                [os.path.join(os.path.basename(self.run), 'Demultiplexing', 'P1',
+                              'Sample_P1_101', 'P1_101_S1_L001_R1_001.fastq.gz')],
+                sent)
+            transfer_lanes(self.run, [1])
+            self.assertEqual(1, len(sent))
+
+    def test_transfer_run_error(self):
+        """ The transferring marker should be removed whatever makes the transfer fail
+        """
+        with mock.patch.dict(CONFIG, self.config), \
+                mock.patch('taca.analysis.analysis.filesystem.list_files_to_sync',
+                           side_effect=OSError(2, 'No such file or directory')):
+            with self.assertRaises(OSError):
+                transfer_run(self.run)
+        self.assertFalse(os.path.exists(os.path.join(self.run, 'transferring')))
+
+
+class AnalysisServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Local stand-in for the analysis server, answering with the status
+    code set in the server
+    """
+    def _answer(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.received.append((self.command, self.path, body))
+        self.send_response(self.server.status)
+        self.end_headers()
+
+    do_GET = do_POST = _answer
+
+    def log_message(self, *args):
+        pass
+
+
+class TestTriggerAnalysis(unittest.TestCase):
+    """ Tests for the analysis trigger queue, against a local HTTP server
+    """
+    def setUp(self):
+        self.status_dir = tempfile.mkdtemp(prefix='test_taca_trigger')
+        self.server = BaseHTTPServer.HTTPServer(('localhost', 0), AnalysisServerHandler)
+        self.server.received = []
+        self.server.status = 200
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.config = {
+            'connections': {'retries': 0},
+            'analysis': {
+                'status_dir': self.status_dir,
+                'analysis_server': {
+                    'host': 'localhost', 'port': self.server.server_address[1],
+                    'sync': {'data_archive': '/data'},
+                    'trigger': {'backoff': 60}}}}
+        connections.reset()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        connections.reset()
+        shutil.rmtree(self.status_dir)
+
+    def _read_tsv(self, name):
+        try:
+            with open(os.path.join(self.status_dir, name)) as f:
+                return list(csv.reader(f, delimiter='\t'))
+        except IOError:
+            return []
+
+    def test_trigger_acknowledged(self):
+        """ An acknowledged trigger should be recorded in analysis.tsv and leave the queue
+        """
+        with mock.patch.dict(CONFIG, self.config):
+            trigger_analysis('/data/141124_ST-E00201_0001_AFCIDXX')
+        self.assertEqual('/flowcell_analysis/141124_ST-E00201_0001_AFCIDXX?path=%2Fdata',
+                         self.server.received[0][1])
+        self.assertEqual(['141124_ST-E00201_0001_AFCIDXX'],
+                         [r[0] for r in self._read_tsv('analysis.tsv')])
+        self.assertEqual([], self._read_tsv(TRIGGER_QUEUE))
+        self.assertEqual('OK', self._read_tsv(TRIGGER_LOG)[0][2])
+
+    def test_trigger_retried(self):
+        """ A failed trigger should stay in the queue and be retried once due
+        """
+        self.server.status = 500
+        with mock.patch.dict(CONFIG, self.config):
+            trigger_analysis('141124_ST-E00201_0001_AFCIDXX')
+            self.assertEqual([], self._read_tsv('analysis.tsv'))
+            queue = self._read_tsv(TRIGGER_QUEUE)
+            self.assertEqual('1', queue[0][1])
+            # Not due yet, nothing should be sent
+            process_trigger_queue()
+            self.assertEqual(1, len(self.server.received))
+            self.server.status = 200
+            with mock.patch('taca.analysis.analysis.time.time',
+                            return_value=float(queue[0][2]) + 1):
+                process_trigger_queue()
+        self.assertEqual(2, len(self.server.received))
+        self.assertEqual([], self._read_tsv(TRIGGER_QUEUE))
+        self.assertEqual(['FAILED', 'OK'], [r[2] for r in self._read_tsv(TRIGGER_LOG)])
+
+    def test_trigger_batched(self):
+        """ Pending triggers should be sent in one request if the server allows it
+        """
+        self.config['analysis']['analysis_server']['trigger']['batch_path'] = 'flowcells_analysis'
+        with mock.patch.dict(CONFIG, self.config):
+            with mock.patch('taca.analysis.analysis.process_trigger_queue'):
+                trigger_analysis('141124_ST-E00201_0001_AFCIDXX')
+                trigger_analysis('141124_ST-E00201_0002_BFCIDXX')
+            process_trigger_queue()
+        self.assertEqual(1, len(self.server.received))
+        method, path, body = self.server.received[0]
+        self.assertEqual(('POST', '/flowcells_analysis'), (method, path))
+        self.assertEqual(['141124_ST-E00201_0001_AFCIDXX', '141124_ST-E00201_0002_BFCIDXX'],
+                         json.loads(body)['flowcells'])
+        self.assertEqual(2, len(self._read_tsv('analysis.tsv')))
+
+    def test_trigger_queue_kept_on_error(self):
+        """ Triggers acknowledged before an error should not stay in the queue
+        """
+        self.config['analysis']['analysis_server']['trigger']['max_attempts'] = 1
+        self.config['mail'] = {'recipients': 'someone@example.com'}
+        with mock.patch.dict(CONFIG, self.config):
+            with mock.patch('taca.analysis.analysis.process_trigger_queue'):
+                trigger_analysis('141124_ST-E00201_0001_AFCIDXX')
+                trigger_analysis('141124_ST-E00201_0002_BFCIDXX')
+            with mock.patch('taca.analysis.analysis._send_triggers',
+                            return_value=set(['141124_ST-E00201_0001_AFCIDXX'])), \
+                    mock.patch.object(misc, 'send_mail', side_effect=IOError('no mail server')):
+                with self.assertRaises(IOError):
+                    process_trigger_queue()
+        self.assertEqual(['141124_ST-E00201_0001_AFCIDXX'],
+                         [r[0] for r in self._read_tsv('analysis.tsv')])
+        self.assertEqual([], self._read_tsv(TRIGGER_QUEUE))
+
+
+class TestSampleSheetIndex(unittest.TestCase):
+    """ Tests for the index of LIMS samplesheets
+    """
+    def setUp(self):
+        self.status_dir = tempfile.mkdtemp(prefix='test_taca_samplesheets')
+        self.run = os.path.join(self.status_dir, '141124_ST-E00201_0001_ACIDXXX')
+        os.mkdir(self.run)
+        self.config = {'analysis': {'status_dir': self.status_dir,
+                                    'samplesheets_dir': 'data'}}
+
+    def tearDown(self):
+        shutil.rmtree(self.status_dir)
+
+    def test_samplesheet_index(self):
+        """ Samplesheets should be indexed by flowcell id, and only hashed again if changed
+        """
+        with mock.patch.dict(CONFIG, self.config):
+            index = update_samplesheet_index()
+            self.assertEqual(os.path.join('data', '2014', 'CIDXXX.csv'),
+                             index['sheets']['CIDXXX']['path'])
+            with mock.patch('taca.analysis.analysis.misc.hashfile') as hashfile:
+                update_samplesheet_index('CIDXXX')
+            self.assertFalse(hashfile.called)
+
+    def test_samplesheet_rewritten_in_place(self):
+        """ A samplesheet rewritten in place should be hashed again, even when
+        another directory is listed again in the same update
+        """
+        ss_dir = os.path.join(self.status_dir, 'samplesheets')
+        for year, fcid in [('2014', 'CIDXXX'), ('2015', 'OTHERXX')]:
+            os.makedirs(os.path.join(ss_dir, year))
+            with open(os.path.join(ss_dir, year, fcid + '.csv'), 'w') as f:
+                f.write('original')
+            os.utime(os.path.join(ss_dir, year), (1000000000, 1000000000))
+        config = {'analysis': {'status_dir': self.status_dir, 'samplesheets_dir': ss_dir}}
+        with mock.patch.dict(CONFIG, config):
+            update_samplesheet_index()
+            sheet = os.path.join(ss_dir, '2014', 'CIDXXX.csv')
+            with open(sheet, 'w') as f:
+                f.write('edited')
+            os.utime(sheet, (1000000000, 1000000000))
+            os.utime(os.path.join(ss_dir, '2014'), (1000000000, 1000000000))
+            os.utime(os.path.join(ss_dir, '2015'), (1100000000, 1100000000))
+            index = update_samplesheet_index('CIDXXX')
+        self.assertEqual(index['sheets']['CIDXXX']['sha1'], misc.hashfile(sheet, hasher='sha1'))
+
+    def test_prepare_sample_sheet(self):
+        """ The samplesheet should be generated once, without parsing if already present
+        """
+        with mock.patch.dict(CONFIG, self.config), \
+                mock.patch('taca.analysis.analysis.XTenSampleSheetParser') as parser:
+            parser.return_value.generate_clean_samplesheet.return_value = 'clean samplesheet'
+            self.assertTrue(prepare_sample_sheet(self.run))
+            self.assertEqual(1, parser.call_count)
+            self.assertFalse(prepare_sample_sheet(self.run))
+            self.assertEqual(1, parser.call_count)
+        with open(os.path.join(self.run, 'SampleSheet.csv')) as f:
+            self.assertEqual('clean samplesheet', f.read())
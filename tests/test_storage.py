@@ -0,0 +1,898 @@
+""" Unit tests for the storage methods """
+
+import hashlib
+import json
+import mock
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+import zlib
+
+from cStringIO import StringIO
+
+from taca.storage import backends, blocks, codecs, policy, storage
+from taca.utils import filesystem, misc
+
+
+class TestStreamRun(unittest.TestCase):
+    """ Tests for archiving runs straight into a storage backend """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_storage")
+        self.run = '141124_ST-E00201_0001_AFCIDXX'
+        os.makedirs(os.path.join(self.rootdir, self.run, 'InterOp'))
+        with open(os.path.join(self.rootdir, self.run, 'RunInfo.xml'), 'w') as f:
+            f.write('<RunInfo/>')
+        self.backend = backends.LocalBackend(os.path.join(self.rootdir, 'backend'))
+        # pbzip2 might not be installed, bzip2 writes the same format
+        self.compress = mock.patch.object(storage, '_compress_command',
+                                          side_effect=lambda c, t=None: ['bzip2', '-c'] if c.command else None)
+        self.compress.start()
+
+    def tearDown(self):
+        self.compress.stop()
+        shutil.rmtree(self.rootdir)
+
+    def test_stream_run(self):
+        """ The archive should end up in the backend without being written locally """
+        with filesystem.chdir(self.rootdir):
+            self.assertTrue(storage._stream_run(self.run, self.backend))
+            self.assertFalse(os.path.exists('{}.tar.bz2'.format(self.run)))
+        archive = self.backend.path('{}.tar.bz2'.format(self.run))
+        with tarfile.open(archive, 'r:bz2') as tar:
+            self.assertIn('{}/RunInfo.xml'.format(self.run), tar.getnames())
+        with open(archive + backends.CHECKSUM_SUFFIX) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest['digests']['sha256'], self.backend.checksum(
+            '{}.tar.bz2'.format(self.run), 'sha256'))
+        self.assertEqual(manifest['size'], os.path.getsize(archive))
+
+    def test_write_archive(self):
+        """ The archive should be written with a manifest matching its contents """
+        with filesystem.chdir(self.rootdir):
+            storage._write_archive(self.run, 'archive.tar.bz2', ['bzip2', '-c'], None)
+            with open('archive.tar.bz2' + backends.CHECKSUM_SUFFIX) as f:
+                manifest = json.load(f)
+            self.assertEqual(manifest['name'], 'archive.tar.bz2')
+            self.assertEqual(manifest['digests']['md5'], misc.hashfile('archive.tar.bz2', 'md5'))
+
+    def test_write_archive_failed(self):
+        """ A failing compressor should be reported and leave nothing behind """
+        with filesystem.chdir(self.rootdir):
+            with self.assertRaises(subprocess.CalledProcessError):
+                storage._write_archive(self.run, 'archive.tar.bz2', ['false'], None)
+        self.assertEqual(sorted(os.listdir(self.rootdir)), [self.run])
+
+    def test_send_with_manifest(self):
+        """ The uploaded archive should be checked against its manifest """
+        with filesystem.chdir(self.rootdir):
+            storage._write_archive(self.run, 'archive.tar.bz2', ['bzip2', '-c'], None)
+            checksums = backends.read_checksum_manifest('archive.tar.bz2')
+            self.assertTrue(storage._send_with_manifest('archive.tar.bz2', self.backend, checksums))
+            self.assertTrue(self.backend.exists('archive.tar.bz2' + backends.CHECKSUM_SUFFIX))
+            checksums['digests']['md5'] = '0'
+            self.assertFalse(storage._send_with_manifest('archive.tar.bz2', self.backend, checksums))
+            # A corrupted copy would be taken as archived on the next pass
+            self.assertFalse(self.backend.exists('archive.tar.bz2'))
+
+    def test_uploads_throttled(self):
+        """ Uploads should be limited to their share of the bandwidth budget """
+        lock_dir = os.path.join(self.rootdir, 'locks')
+        throttled = []
+        def _throttled_reader(stream, bwlimit, refresh=None):
+            throttled.append(bwlimit)
+            return stream
+        with filesystem.chdir(self.rootdir), \
+                mock.patch.dict(storage.CONFIG, {'transfer': {'lock_dir': lock_dir, 'bandwidth': 900}}), \
+                mock.patch.object(storage.transfer, 'ThrottledReader', side_effect=_throttled_reader):
+            storage._write_archive(self.run, 'archive.tar.bz2', ['bzip2', '-c'], None)
+            checksums = backends.read_checksum_manifest('archive.tar.bz2')
+            with storage._upload_slot() as bwlimit:
+                self.assertTrue(storage._send_with_manifest('archive.tar.bz2', self.backend, checksums, bwlimit))
+            self.assertTrue(storage._stream_run(self.run, self.backend))
+        self.assertEqual(throttled, [900, 900])
+
+    def test_send_with_manifest_unsupported_checksum(self):
+        """ A backend using another checksum algorithm should be a configuration error """
+        with filesystem.chdir(self.rootdir):
+            storage._write_archive(self.run, 'archive.tar.bz2', ['bzip2', '-c'], None)
+            checksums = backends.read_checksum_manifest('archive.tar.bz2')
+            with mock.patch.object(self.backend, 'checksum', return_value=None):
+                with self.assertRaises(ValueError):
+                    storage._send_with_manifest('archive.tar.bz2', self.backend, checksums)
+        self.assertFalse(self.backend.exists('archive.tar.bz2'))
+
+    def test_stream_run_bad_checksum(self):
+        """ A checksum mismatch in the backend should be reported and the object removed """
+        with filesystem.chdir(self.rootdir), \
+                mock.patch.object(self.backend, 'checksum', return_value='0'):
+            self.assertFalse(storage._stream_run(self.run, self.backend))
+        self.assertEqual(self.backend.list(), set())
+        with filesystem.chdir(self.rootdir):
+            self.assertTrue(storage._stream_run(self.run, self.backend))
+
+    def test_stream_run_backend_error(self):
+        """ A part failing in the backend should leave no part of the run behind """
+        put_stream = self.backend.put_stream
+
+        def _failing_put(stream, name):
+            if '.lane' in name:
+                stream.read(100)
+                raise IOError('Connection lost')
+            put_stream(stream, name)
+
+        filesystem.create_folder(os.path.join(self.rootdir, self.run, 'Data/Intensities/BaseCalls/L001'))
+        with filesystem.chdir(self.rootdir), \
+                mock.patch.dict(storage.CONFIG, {'storage': {'archive': {'layout': 'split'}}}):
+            with mock.patch.object(self.backend, 'put_stream', side_effect=_failing_put):
+                self.assertFalse(storage._stream_run(self.run, self.backend))
+            self.assertEqual(self.backend.list(), set())
+            self.assertTrue(storage._stream_run(self.run, self.backend))
+
+    def test_stream_run_already_archived(self):
+        """ A run already in the backend should not be sent again """
+        open(os.path.join(self.rootdir, 'archive'), 'w').close()
+        self.backend.put(os.path.join(self.rootdir, 'archive'), '{}.tar.bz2'.format(self.run))
+        with filesystem.chdir(self.rootdir), \
+                mock.patch.object(self.backend, 'put_stream') as put_stream:
+            self.assertFalse(storage._stream_run(self.run, self.backend))
+        self.assertFalse(put_stream.called)
+
+    def test_stream_run_store(self):
+        """ With the store codec the plain tar archive should be uploaded """
+        with filesystem.chdir(self.rootdir), \
+                mock.patch.object(storage, '_archive_codec', return_value=codecs.get_codec('store')):
+            self.assertTrue(storage._stream_run(self.run, self.backend))
+        with tarfile.open(self.backend.path('{}.tar'.format(self.run)), 'r:') as tar:
+            self.assertIn('{}/RunInfo.xml'.format(self.run), tar.getnames())
+
+    def test_stream_run_store_compressed(self):
+        """ Compressed files should go to a separate, uncompressed archive """
+        with open(os.path.join(self.rootdir, self.run, 'InterOp', 's_1.bcl.gz'), 'w') as f:
+            f.write('compressed')
+        with filesystem.chdir(self.rootdir), \
+                mock.patch.dict(storage.CONFIG, {'storage': {'archive': {'store_compressed': True}}}):
+            self.assertTrue(storage._stream_run(self.run, self.backend))
+        with tarfile.open(self.backend.path('{}.tar.bz2'.format(self.run)), 'r:bz2') as tar:
+            names = tar.getnames()
+        self.assertIn('{}/InterOp'.format(self.run), names)
+        self.assertIn('{}/RunInfo.xml'.format(self.run), names)
+        self.assertNotIn('{}/InterOp/s_1.bcl.gz'.format(self.run), names)
+        with tarfile.open(self.backend.path('{}.tar'.format(self.run)), 'r:') as tar:
+            self.assertEqual(tar.getnames(), ['{}/InterOp/s_1.bcl.gz'.format(self.run)])
+
+    def test_stream_run_split(self):
+        """ The split layout should give one archive per lane and project, and a manifest """
+        for path in ['Data/Intensities/BaseCalls/L001/C1.1/s_1_1101.bcl.gz',
+                     'Data/Intensities/BaseCalls/L002/s_2_1101.filter',
+                     'Demultiplexing/J.Doe_15_01/Sample_P1_101/P1_101_S1_L001_R1_001.fastq.gz',
+                     'Demultiplexing/Stats/DemultiplexingStats.xml',
+                     'Demultiplexing/Undetermined_S0_L001_R1_001.fastq.gz']:
+            filesystem.create_folder(os.path.join(self.rootdir, self.run, os.path.dirname(path)))
+            with open(os.path.join(self.rootdir, self.run, path), 'w') as f:
+                f.write(path)
+        with filesystem.chdir(self.rootdir), \
+                mock.patch.dict(storage.CONFIG, {'storage': {'archive': {'layout': 'split'}}}):
+            self.assertTrue(storage._stream_run(self.run, self.backend))
+        with open(self.backend.path(self.run + storage.RUN_MANIFEST_SUFFIX)) as f:
+            manifest = json.load(f)
+        self.assertEqual(sorted(a['part'] for a in manifest['archives']),
+                         ['lane1', 'lane2', 'metadata', 'project_J.Doe_15_01', 'undetermined'])
+        members = {}
+        for archive in manifest['archives']:
+            with tarfile.open(self.backend.path(archive['name']), 'r:bz2') as tar:
+                members[archive['part']] = [m.name for m in tar.getmembers() if m.isfile()]
+        self.assertEqual(members['lane2'],
+                         ['{}/Data/Intensities/BaseCalls/L002/s_2_1101.filter'.format(self.run)])
+        self.assertEqual(sorted(members['metadata']),
+                         ['{}/Demultiplexing/Stats/DemultiplexingStats.xml'.format(self.run),
+                          '{}/RunInfo.xml'.format(self.run)])
+        self.assertEqual(len(members['project_J.Doe_15_01']), 1)
+
+    def test_stream_run_split_upload_slots(self):
+        """ Every archive of a split run should be uploaded in an upload slot of its own """
+        for path in ['Data/Intensities/BaseCalls/L001/s_1_1101.filter',
+                     'Data/Intensities/BaseCalls/L002/s_2_1101.filter']:
+            filesystem.create_folder(os.path.join(self.rootdir, self.run, os.path.dirname(path)))
+            with open(os.path.join(self.rootdir, self.run, path), 'w') as f:
+                f.write(path)
+        upload_slots = mock.Mock()
+        with filesystem.chdir(self.rootdir), \
+                mock.patch.dict(storage.CONFIG, {'storage': {'archive': {'layout': 'split'}}}), \
+                mock.patch.dict(storage._ARCHIVE_LIMITS, {'upload_slots': upload_slots}):
+            self.assertTrue(storage._stream_run(self.run, self.backend))
+        # lane1, lane2 and metadata, then the manifest of the run
+        self.assertEqual(upload_slots.acquire.call_count, 4)
+        self.assertEqual(upload_slots.release.call_count, 4)
+
+
+class TestArchiveWorkers(unittest.TestCase):
+    """ Tests for the number of runs archived at the same time """
+
+    def setUp(self):
+        self.config = mock.patch.dict(storage.CONFIG, {'storage': {'archive': {
+            'min_threads': 4, 'memory_per_run': 1024, 'max_io_runs': 8, 'upload_streams': 3}}})
+        self.config.start()
+        self.cpu_count = mock.patch.object(storage.multiprocessing, 'cpu_count', return_value=32)
+        self.cpu_count.start()
+
+    def tearDown(self):
+        self.cpu_count.stop()
+        self.config.stop()
+
+    @mock.patch.object(storage.misc, 'available_memory', return_value=None)
+    def test_cores(self, memory):
+        """ Every run should get at least min_threads compression threads """
+        self.assertEqual(storage.archive_workers(20), (8, 4, 3))
+        self.assertEqual(storage.archive_workers(2), (2, 16, 3))
+
+    @mock.patch.object(storage.misc, 'available_memory', return_value=None)
+    def test_max_runs(self, memory):
+        """ The maximum given should cap the runs archived at the same time """
+        self.assertEqual(storage.archive_workers(20, max_runs=3), (3, 10, 3))
+
+    @mock.patch.object(storage.misc, 'available_memory', return_value=5 * 1024 ** 3)
+    def test_memory_per_run(self, memory):
+        """ Runs should only be archived at the same time if there is memory for all of them """
+        self.assertEqual(storage.archive_workers(20)[0], 5)
+
+    @mock.patch.object(storage.misc, 'available_memory', return_value=100 * 1024 ** 2)
+    def test_at_least_one_worker(self, memory):
+        """ A run should always be archived, even with too little memory or cores """
+        self.assertEqual(storage.archive_workers(20)[0], 1)
+        with mock.patch.object(storage.multiprocessing, 'cpu_count', return_value=2):
+            self.assertEqual(storage.archive_workers(20), (1, 2, 3))
+        self.assertEqual(storage.archive_workers(0)[0], 1)
+
+
+class TestCodecs(unittest.TestCase):
+    """ Tests for the compression codecs """
+
+    def test_archive_names(self):
+        """ Archive names should be recognised and mapped back to the run """
+        run = '141124_ST-E00201_0001_AFCIDXX'
+        zstd = codecs.get_codec('zstd')
+        self.assertEqual(zstd.archive_name(run), '{}.tar.zst'.format(run))
+        self.assertEqual(codecs.get_codec('store').archive_name(run), '{}.tar'.format(run))
+        self.assertTrue(codecs.is_archive(zstd.archive_name(run)))
+        self.assertFalse(codecs.is_archive(run))
+        for name in codecs.archive_names(run):
+            self.assertEqual(codecs.run_name(name), run)
+
+    def test_classify_run(self):
+        """ Files should be split by extension, directories kept with the compressible ones """
+        rootdir = tempfile.mkdtemp(prefix="test_taca_codecs")
+        try:
+            run = os.path.join(rootdir, 'run')
+            os.makedirs(os.path.join(run, 'Thumbnail_Images'))
+            for name in ['RunInfo.xml', 'Thumbnail_Images/a.png', 'L001.cbcl', 's_1.filter']:
+                open(os.path.join(run, name), 'w').close()
+            compressible, precompressed = codecs.classify_run(run)
+            self.assertEqual(sorted(os.path.relpath(p, run) for p in compressible),
+                             ['.', 'RunInfo.xml', 'Thumbnail_Images', 's_1.filter'])
+            self.assertEqual(sorted(os.path.relpath(p, run) for p in precompressed),
+                             ['L001.cbcl', 'Thumbnail_Images/a.png'])
+        finally:
+            shutil.rmtree(rootdir)
+
+    def test_commands(self):
+        """ Thread options should be added to both directions """
+        zstd = codecs.get_codec('zstd')
+        self.assertEqual(zstd.compress_command(8), ['zstd', '-c', '-q', '-T8'])
+        self.assertEqual(zstd.decompress_command(), ['zstd', '-c', '-q', '-d'])
+        self.assertIsNone(codecs.get_codec('store').compress_command(8))
+
+    def test_benchmark_codecs(self):
+        """ The benchmark should report every codec asked for """
+        rootdir = tempfile.mkdtemp(prefix="test_taca_codecs")
+        try:
+            run = os.path.join(rootdir, '141124_ST-E00201_0001_AFCIDXX')
+            os.makedirs(run)
+            for i in range(4):
+                with open(os.path.join(run, 'file{}'.format(i)), 'w') as f:
+                    f.write('ACGT' * 1024)
+            gzip = codecs.Codec('gzip', 'gz', ['gzip', '-c'])
+            with mock.patch.dict(codecs.CODECS, {'gzip': gzip}):
+                results = codecs.benchmark_codecs(run, 8 * 1024, ['gzip'])
+            self.assertEqual([r['codec'] for r in results], ['gzip'])
+            self.assertGreater(results[0]['ratio'], 1)
+        finally:
+            shutil.rmtree(rootdir)
+
+
+class TestChecksumReader(unittest.TestCase):
+    """ Tests for computing checksums on the fly """
+
+    def test_digests(self):
+        """ All the digests should match the ones computed on the whole data """
+        data = 'ACGT' * 100000
+        reader = backends.ChecksumReader(StringIO(data), backends.DIGESTS)
+        while reader.read(1000):
+            pass
+        self.assertEqual(reader.size, len(data))
+        self.assertEqual(reader.hexdigest(), '{:08x}'.format(zlib.adler32(data) & 0xffffffff))
+        self.assertEqual(reader.hexdigest('md5'), hashlib.md5(data).hexdigest())
+        self.assertEqual(reader.hexdigests()['sha256'], hashlib.sha256(data).hexdigest())
+
+
+class TestSwestoreCatalog(unittest.TestCase):
+    """ Tests for the cached listing of swestore collections """
+
+    ILS = ("/ssUppnexZone/proj/a2010002:\n"
+           "  141124_ST-E00201_0001_AFCIDXX.tar.bz2\n"
+           "  C- /ssUppnexZone/proj/a2010002/141125_ST-E00201_0002_BFCIDXX\n")
+
+    def setUp(self):
+        self.catalog = backends.SwestoreCatalog('/ssUppnexZone/proj/a2010002', ttl=60)
+
+    @mock.patch('taca.storage.backends.subprocess.check_output', return_value=ILS)
+    def test_single_listing(self, check_output):
+        """ Lookups should be answered from a single ils """
+        self.assertIn('141124_ST-E00201_0001_AFCIDXX.tar.bz2', self.catalog)
+        self.assertIn('141125_ST-E00201_0002_BFCIDXX', self.catalog)
+        self.assertNotIn('141126_ST-E00201_0003_AFCIDXX.tar.bz2', self.catalog)
+        check_output.assert_called_once_with(['ils', '/ssUppnexZone/proj/a2010002'])
+
+    @mock.patch('taca.storage.backends.subprocess.check_output', return_value=ILS)
+    def test_ttl(self, check_output):
+        """ The collection should be listed again once the TTL has passed """
+        self.catalog.names()
+        self.catalog._listed -= 61
+        self.catalog.names()
+        self.assertEqual(check_output.call_count, 2)
+
+    @mock.patch('taca.storage.backends.subprocess.check_output', return_value=ILS)
+    def test_add_discard(self, check_output):
+        """ Our own uploads and deletions should be seen without listing again """
+        self.catalog.add('new.tar.bz2')
+        self.assertFalse(check_output.called)
+        self.catalog.names()
+        self.catalog.add('new.tar.bz2')
+        self.catalog.discard('141124_ST-E00201_0001_AFCIDXX.tar.bz2')
+        self.assertEqual(self.catalog.names(), set(['new.tar.bz2', '141125_ST-E00201_0002_BFCIDXX']))
+        self.assertEqual(check_output.call_count, 1)
+
+
+class TestIRODSBackend(unittest.TestCase):
+    """ Tests for the backend using the native iRODS client """
+
+    def setUp(self):
+        self.session = mock.Mock()
+        collection = self.session.collections.get.return_value
+        collection.data_objects = [mock.Mock()]
+        collection.data_objects[0].name = '141124_ST-E00201_0001_AFCIDXX.tar.bz2'
+        collection.subcollections = []
+        self.backend = backends.IRODSBackend('/zone/test_irods_backend', session=self.session,
+                                             put_threads=8)
+
+    def tearDown(self):
+        backends._CATALOGS.clear()
+
+    def test_put(self):
+        """ Puts should be parallel and update the catalog """
+        self.assertFalse(self.backend.exists('run.tar.bz2'))
+        self.backend.put('/data/run.tar.bz2', verify=False)
+        self.session.data_objects.put.assert_called_once_with(
+            '/data/run.tar.bz2', '/zone/test_irods_backend/run.tar.bz2', num_threads=8)
+        self.assertTrue(self.backend.exists('run.tar.bz2'))
+        self.assertTrue(self.backend.exists('141124_ST-E00201_0001_AFCIDXX.tar.bz2'))
+        self.session.collections.get.assert_called_once_with('/zone/test_irods_backend')
+
+    def test_remove(self):
+        """ Removed objects should be gone from the catalog """
+        self.assertEqual(len(self.backend.list()), 1)
+        self.backend.remove('141124_ST-E00201_0001_AFCIDXX.tar.bz2')
+        self.session.data_objects.unlink.assert_called_once_with(
+            '/zone/test_irods_backend/141124_ST-E00201_0001_AFCIDXX.tar.bz2', force=True)
+        self.assertEqual(self.backend.list(), set())
+
+    def test_checksum(self):
+        """ SHA-256 checksums are reported base64 encoded by iRODS """
+        data = 'ACGT' * 1000
+        digest = 'sha2:' + hashlib.sha256(data).digest().encode('base64').strip()
+        self.session.data_objects.get.return_value.chksum.return_value = digest
+        self.assertEqual(self.backend.checksum('run.tar.bz2', 'sha256'), hashlib.sha256(data).hexdigest())
+        self.assertIsNone(self.backend.checksum('run.tar.bz2', 'md5'))
+
+    @mock.patch('taca.storage.backends.subprocess.check_output', return_value='')
+    def test_catalog_per_client(self, check_output):
+        """ Backends with another client should not share the catalog of a collection """
+        swestore = backends.SwestoreBackend('/zone/test_irods_backend')
+        self.assertIsNot(swestore.catalog, self.backend.catalog)
+        self.assertTrue(self.backend.exists('141124_ST-E00201_0001_AFCIDXX.tar.bz2'))
+        self.assertFalse(swestore.exists('141124_ST-E00201_0001_AFCIDXX.tar.bz2'))
+        self.assertIs(backends.SwestoreBackend('/zone/test_irods_backend').catalog, swestore.catalog)
+
+
+class TestResumableUpload(unittest.TestCase):
+    """ Tests for chunked uploads and archiving markers """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_upload")
+        self.archive = os.path.join(self.rootdir, 'run.tar.bz2')
+        with open(self.archive, 'wb') as f:
+            f.write(os.urandom(10000))
+        self.backend = backends.LocalBackend(os.path.join(self.rootdir, 'backend'))
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_resume(self):
+        """ An interrupted upload should continue after the last chunk written """
+        write_chunk = self.backend.write_chunk
+        offsets = []
+
+        def _failing_write(name, offset, stream):
+            offsets.append(offset)
+            if offset == 6000 and len(offsets) == 3:
+                stream.read(100)
+                raise IOError('Connection lost')
+            write_chunk(name, offset, stream)
+
+        with mock.patch.object(self.backend, 'write_chunk', side_effect=_failing_write):
+            with self.assertRaises(IOError):
+                storage._put_in_chunks(self.archive, self.backend, 'run.tar.bz2', 3000)
+            with open(self.archive + storage.UPLOAD_JOURNAL_SUFFIX) as f:
+                self.assertEqual(len(json.load(f)['chunks']), 2)
+            offsets[:] = []
+            storage._put_in_chunks(self.archive, self.backend, 'run.tar.bz2', 3000)
+        self.assertEqual(offsets, [6000, 9000])
+        self.assertEqual(self.backend.checksum('run.tar.bz2'), misc.hashfile(self.archive, 'md5'))
+
+    def test_resume_corrupted_chunk(self):
+        """ A kept chunk that does not match its md5 should be sent again """
+        storage._put_in_chunks(self.archive, self.backend, 'run.tar.bz2', 3000)
+        with open(self.archive + storage.UPLOAD_JOURNAL_SUFFIX) as f:
+            journal = json.load(f)
+        journal['chunks'] = journal['chunks'][:2]
+        with open(self.archive + storage.UPLOAD_JOURNAL_SUFFIX, 'w') as f:
+            json.dump(journal, f)
+        with open(self.backend.path('run.tar.bz2'), 'r+b') as f:
+            f.seek(3500)
+            f.write('x' * 10)
+        write_chunk = self.backend.write_chunk
+        offsets = []
+
+        def _write(name, offset, stream):
+            offsets.append(offset)
+            write_chunk(name, offset, stream)
+
+        with mock.patch.object(self.backend, 'write_chunk', side_effect=_write):
+            storage._put_in_chunks(self.archive, self.backend, 'run.tar.bz2', 3000)
+        self.assertEqual(offsets, [3000, 6000, 9000])
+        self.assertEqual(self.backend.checksum('run.tar.bz2'), misc.hashfile(self.archive, 'md5'))
+
+    def test_send_with_manifest_in_chunks(self):
+        """ Large archives should be sent in chunks and the journal removed once verified """
+        checksums = {'digests': {'md5': misc.hashfile(self.archive, 'md5')}}
+        open(self.archive + backends.CHECKSUM_SUFFIX, 'w').close()
+        with mock.patch.dict(storage.CONFIG, {'storage': {'archive': {'chunk_size': 0.004}}}), \
+                mock.patch.object(self.backend, 'put') as put:
+            self.assertTrue(storage._send_with_manifest(self.archive, self.backend, checksums))
+        put.assert_called_once_with(self.archive + backends.CHECKSUM_SUFFIX, verify=False)
+        self.assertFalse(os.path.exists(self.archive + storage.UPLOAD_JOURNAL_SUFFIX))
+        self.assertEqual(self.backend.size('run.tar.bz2'), 10000)
+
+    def test_stale_marker(self):
+        """ Markers of dead processes should be reclaimed, not the ones of live ones """
+        run = '141124_ST-E00201_0001_AFCIDXX'
+        with filesystem.chdir(self.rootdir):
+            marker = storage._create_archiving_marker(run)
+            self.assertTrue(storage._is_being_archived(run))
+            proc = subprocess.Popen(['true'])
+            proc.wait()
+            with open(marker, 'w') as f:
+                json.dump({'host': storage.socket.gethostname(), 'pid': proc.pid}, f)
+            self.assertFalse(storage._is_being_archived(run))
+            self.assertFalse(os.path.exists(marker))
+
+    def test_old_marker_other_host(self):
+        """ Markers of other hosts should only be reclaimed once too old """
+        run = '141124_ST-E00201_0001_AFCIDXX'
+        with filesystem.chdir(self.rootdir):
+            with open('{}.archiving'.format(run), 'w') as f:
+                json.dump({'host': 'elsewhere', 'pid': 1}, f)
+            self.assertTrue(storage._is_being_archived(run))
+            os.utime('{}.archiving'.format(run), (0, 0))
+            self.assertFalse(storage._is_being_archived(run))
+
+
+class TestSplitArchivesOnDisk(unittest.TestCase):
+    """ Tests for sending the archives of a split run left on disk """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_split_on_disk")
+        self.run = '141124_ST-E00201_0001_AFCIDXX'
+        self.files = ['{}.lane1.tar.bz2'.format(self.run), '{}.P123.tar.zst'.format(self.run),
+                      '{}.metadata.tar.bz2'.format(self.run), self.run + storage.RUN_MANIFEST_SUFFIX]
+        for name in self.files + ['150101_ST-E00201_0002_BFCIDXX.tar.bz2']:
+            with open(os.path.join(self.rootdir, name), 'w') as f:
+                f.write(name)
+            os.utime(os.path.join(self.rootdir, name), (0, 0))
+        self.config = {'storage': {'archive_dirs': [self.rootdir], 'irods': {'irodsHome': '/zone/home'}}}
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_one_task_per_run(self):
+        """ The archives of a run should be handed to a single archiving task """
+        with mock.patch.dict(storage.CONFIG, self.config), \
+                mock.patch.object(storage, 'Pool') as pool, \
+                mock.patch.object(storage, 'archive_workers', return_value=(2, 1, 1)):
+            storage.archive_to_swestore(1)
+        tasks = list(pool.return_value.map_async.call_args[0][1])
+        self.assertEqual(sorted(t[0].split('.')[0] for t in tasks),
+                         [self.run, '150101_ST-E00201_0002_BFCIDXX'])
+
+    def test_send_split_archives(self):
+        """ All the parts of a run and its manifest should be sent, then removed """
+        backend = mock.Mock()
+        backend.exists.return_value = False
+        with mock.patch.dict(storage.CONFIG, self.config), \
+                mock.patch.object(storage.backends, 'swestore_backend', return_value=backend), \
+                filesystem.chdir(self.rootdir):
+            storage._archive_run((self.files[0], 1, False, False))
+        self.assertEqual(sorted(c[0][0] for c in backend.put.call_args_list), sorted(self.files))
+        # The manifest tells that the run is archived, so it goes last
+        self.assertEqual(backend.put.call_args_list[-1][0][0], self.run + storage.RUN_MANIFEST_SUFFIX)
+        self.assertEqual(os.listdir(self.rootdir), ['150101_ST-E00201_0002_BFCIDXX.tar.bz2'])
+
+    def test_send_split_archives_failed(self):
+        """ The manifest should not be sent if a part could not be """
+        backend = mock.Mock()
+        backend.exists.return_value = False
+        def put(f):
+            if f == self.files[0]:
+                raise subprocess.CalledProcessError(3, 'iput')
+        backend.put.side_effect = put
+        with mock.patch.dict(storage.CONFIG, self.config), \
+                mock.patch.object(storage.backends, 'swestore_backend', return_value=backend), \
+                filesystem.chdir(self.rootdir):
+            with self.assertRaises(subprocess.CalledProcessError):
+                storage._archive_run((self.files[0], 1, False, False))
+        self.assertNotIn(self.run + storage.RUN_MANIFEST_SUFFIX, [c[0][0] for c in backend.put.call_args_list])
+        self.assertTrue(os.path.exists(os.path.join(self.rootdir, self.run + storage.RUN_MANIFEST_SUFFIX)))
+
+
+class TestBlocks(unittest.TestCase):
+    """ Tests for archives compressed in blocks and extracting single files """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_blocks")
+        self.run = '141124_ST-E00201_0001_AFCIDXX'
+        self.files = {
+            'RunInfo.xml': '<RunInfo/>',
+            'InterOp/QMetricsOut.bin': os.urandom(50000),
+            # Longer than the 100 characters of a plain tar header
+            'Demultiplexing/{}/Sample_P1_101/P1_101_S1_L001_R1_001.fastq'.format('J.Doe_15_01' * 10):
+                'ACGT' * 30000,
+        }
+        for name, data in self.files.items():
+            path = os.path.join(self.rootdir, self.run, name)
+            filesystem.create_folder(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+        self.backend = backends.LocalBackend(os.path.join(self.rootdir, 'backend'))
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_tar_indexer(self):
+        """ Member offsets should point at their data, also with long names and pax headers """
+        for tar_format in ['gnu', 'pax']:
+            with filesystem.chdir(self.rootdir):
+                data = subprocess.check_output(['tar', '-cf', '-', '--format', tar_format, self.run])
+            indexer = blocks.TarIndexer()
+            for i in range(0, len(data), 1000):
+                indexer.feed(data[i:i + 1000])
+            self.assertTrue(indexer.done)
+            self.assertEqual(len(indexer.members), 3)
+            for name, content in self.files.items():
+                offset, size = indexer.members['{}/{}'.format(self.run, name)]
+                self.assertEqual(data[offset:offset + size], content)
+
+    def test_extract(self):
+        """ Single files should be extracted from an archive written in blocks """
+        index = {'codec': 'pbzip2'}
+        with filesystem.chdir(self.rootdir), \
+                mock.patch.dict(storage.CONFIG, {'storage': {'archive': {'block_size': 0.05}}}):
+            storage._write_archive(self.run, 'archive.tar.bz2', ['bzip2', '-c'], None, index)
+            # Still a regular archive, made of several bzip2 streams
+            listing = subprocess.check_output(['tar', '-tjf', 'archive.tar.bz2'])
+            self.assertIn('{}/RunInfo.xml'.format(self.run), listing.split())
+            self.backend.put('archive.tar.bz2')
+            self.backend.put('archive.tar.bz2' + blocks.INDEX_SUFFIX)
+        self.assertGreater(len(index['blocks']), 2)
+        bzip2 = codecs.Codec('pbzip2', 'bz2', ['bzip2', '-c'])
+        dest = os.path.join(self.rootdir, 'extracted')
+        with mock.patch.dict(codecs.CODECS, {'pbzip2': bzip2}), \
+                mock.patch.object(self.backend, 'read_range', wraps=self.backend.read_range) as read_range:
+            extracted = blocks.extract(self.backend, 'archive.tar.bz2',
+                                       ['{}/InterOp'.format(self.run)], dest)
+        self.assertEqual(extracted, [os.path.join(dest, self.run, 'InterOp/QMetricsOut.bin')])
+        with open(extracted[0], 'rb') as f:
+            self.assertEqual(f.read(), self.files['InterOp/QMetricsOut.bin'])
+        # The index, and not every block of the archive
+        self.assertLess(read_range.call_count, len(index['blocks']) + 1)
+
+    def test_extract_no_index(self):
+        """ Archives not written in blocks cannot be extracted from """
+        with self.assertRaises(ValueError):
+            blocks.extract(self.backend, 'archive.tar.bz2', ['RunInfo.xml'], self.rootdir)
+
+
+class TestRestore(unittest.TestCase):
+    """ Tests for restoring archived runs """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_restore")
+        self.run = '141124_ST-E00201_0001_AFCIDXX'
+        for path in ['RunInfo.xml', 'Data/Intensities/BaseCalls/L001/s_1_1101.bcl',
+                     'Data/Intensities/BaseCalls/L002/s_2_1101.bcl']:
+            filesystem.create_folder(os.path.join(self.rootdir, self.run, os.path.dirname(path)))
+            with open(os.path.join(self.rootdir, self.run, path), 'w') as f:
+                f.write(path)
+        self.backend = backends.LocalBackend(os.path.join(self.rootdir, 'backend'))
+        self.dest = os.path.join(self.rootdir, 'restored')
+        os.makedirs(self.dest)
+        # pbzip2 might not be installed, bzip2 reads and writes the same format
+        self.codecs = mock.patch.dict(codecs.CODECS, {'pbzip2': codecs.Codec('pbzip2', 'bz2', ['bzip2', '-c'])})
+        self.codecs.start()
+        self.get_backend = mock.patch.object(storage.backends, 'get_backend', return_value=self.backend)
+        self.get_backend.start()
+
+    def tearDown(self):
+        self.get_backend.stop()
+        self.codecs.stop()
+        shutil.rmtree(self.rootdir)
+
+    def _archive(self, layout='single'):
+        with filesystem.chdir(self.rootdir), \
+                mock.patch.dict(storage.CONFIG, {'storage': {'archive': {'layout': layout}}}):
+            self.assertTrue(storage._stream_run(self.run, self.backend))
+
+    def test_restore(self):
+        """ A run should be restored as it was archived """
+        self._archive()
+        self.assertEqual(storage.restore_runs([self.run], self.dest), {self.run: True})
+        with open(os.path.join(self.dest, self.run, 'Data/Intensities/BaseCalls/L002/s_2_1101.bcl')) as f:
+            self.assertEqual(f.read(), 'Data/Intensities/BaseCalls/L002/s_2_1101.bcl')
+        self.assertEqual(os.listdir(self.dest), [self.run])
+
+    def test_restore_parts(self):
+        """ Only the parts asked for should be restored from split archives """
+        self._archive('split')
+        self.assertTrue(storage.restore_runs([self.run], self.dest, parts=['lane2'])[self.run])
+        self.assertTrue(os.path.exists(os.path.join(self.dest, self.run, 'Data/Intensities/BaseCalls/L002')))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, self.run, 'Data/Intensities/BaseCalls/L001')))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, self.run, 'RunInfo.xml')))
+
+    def test_restore_bad_checksum(self):
+        """ A corrupted archive should not end up as a restored run """
+        self._archive()
+        name = '{}.tar.bz2{}'.format(self.run, backends.CHECKSUM_SUFFIX)
+        with open(self.backend.path(name)) as f:
+            checksums = json.load(f)
+        checksums['digests']['sha256'] = '0'
+        with open(self.backend.path(name), 'w') as f:
+            json.dump(checksums, f)
+        self.assertEqual(storage.restore_runs([self.run], self.dest), {self.run: False})
+        self.assertEqual(os.listdir(self.dest), [])
+
+    def test_restore_existing(self):
+        """ Runs should never be restored over existing directories """
+        self._archive()
+        os.makedirs(os.path.join(self.dest, self.run))
+        self.assertFalse(storage.restore_runs([self.run], self.dest)[self.run])
+
+    def test_restore_missing(self):
+        """ Runs that are not archived should be reported """
+        self.assertFalse(storage.restore_runs([self.run], self.dest)[self.run])
+
+    def test_restore_backend_error(self):
+        """ An error of the backend should only fail the run it happened to """
+        self._archive()
+        other = '150424_ST-E00214_0031_BH2WY7CCXX'
+        read_json = self.backend.read_json
+        def _read_json(name):
+            if name.startswith(other):
+                raise IOError('connection lost')
+            return read_json(name)
+        with mock.patch.object(self.backend, 'read_json', side_effect=_read_json):
+            self.assertEqual(storage.restore_runs([other, self.run], self.dest),
+                             {other: False, self.run: True})
+        self.assertEqual(os.listdir(self.dest), [self.run])
+
+
+class TestCleanupPolicy(unittest.TestCase):
+    """ Tests for the free space driven cleanup """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_policy")
+        self.runs = []
+        for i, name in enumerate(['new', 'old', 'older']):
+            path = os.path.join(self.rootdir, name)
+            os.makedirs(path)
+            with open(os.path.join(path, 'data'), 'w') as f:
+                f.write('x' * 4096 * (i + 1))
+            self.runs.append((path, i * 10))
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_target_bytes(self):
+        """ Targets should be given in GB or as a percentage of the volume """
+        statvfs = mock.Mock(f_blocks=1000, f_frsize=4096)
+        with mock.patch.object(policy.os, 'statvfs', return_value=statvfs):
+            self.assertEqual(policy.target_bytes(self.rootdir, '25%'), 250 * 4096)
+        self.assertEqual(policy.target_bytes(self.rootdir, 2), 2 * policy.GB)
+        self.assertEqual(policy.target_bytes(self.rootdir, '0.5'), policy.GB / 2)
+
+    def test_select_evictions(self):
+        """ The oldest items should be removed, only as many as needed """
+        older = filesystem.tree_usage(self.runs[2][0])[0]
+        with mock.patch.object(policy, 'free_bytes', return_value=0), \
+                mock.patch.object(policy, 'target_bytes', return_value=older + 1):
+            selected = policy.select_evictions(self.runs, self.rootdir, '1', workers=1)
+        self.assertEqual([p for p, _ in selected], [self.runs[2][0], self.runs[1][0]])
+        self.assertEqual(selected[0][1], older)
+
+    def test_select_evictions_enough_space(self):
+        """ Nothing should be removed from a volume with enough free space """
+        with mock.patch.object(policy, 'free_bytes', return_value=policy.GB), \
+                mock.patch.object(filesystem, 'tree_usage') as tree_usage:
+            self.assertEqual(policy.select_evictions(self.runs, self.rootdir, '0.5'), [])
+        self.assertFalse(tree_usage.called)
+
+    def test_cleanup_plan(self):
+        """ Plans should size every item and sum them up per volume """
+        cache_file = os.path.join(self.rootdir, 'usage.json')
+        plan = policy.CleanupPlan('nas', cache_file)
+        plan.add(self.runs[0][0], 'move', self.rootdir)
+        plan.add(self.runs[1][0], 'remove', self.rootdir)
+        plan.add('remote_run', 'remove', 'swestore', sizer=lambda r: (10, 1))
+        summary = plan.summary()
+        moved = filesystem.tree_usage(self.runs[0][0])
+        removed = filesystem.tree_usage(self.runs[1][0])
+        self.assertEqual(summary['volumes'][self.rootdir]['moved_bytes'], moved[0])
+        self.assertEqual(summary['volumes'][self.rootdir]['removed_inodes'], removed[1])
+        self.assertEqual(summary['volumes'][self.rootdir]['items'], 2)
+        self.assertIn('free_bytes', summary['volumes'][self.rootdir])
+        self.assertEqual(summary['volumes']['swestore'],
+                         {'items': 1, 'removed_bytes': 10, 'removed_inodes': 1,
+                          'moved_bytes': 0, 'moved_inodes': 0})
+        with open(cache_file) as f:
+            self.assertEqual(sorted(json.load(f)), [self.runs[0][0], self.runs[1][0]])
+
+    def test_cleanup_processing_split_run(self):
+        """ Runs archived in several archives should be removed once their manifest is in swestore """
+        run = '141124_ST-E00201_0001_AFCIDXX'
+        os.makedirs(os.path.join(self.rootdir, run))
+        rta_file = os.path.join(self.rootdir, run, 'RTAComplete.txt')
+        open(rta_file, 'w').close()
+        os.utime(rta_file, (1000000000, 1000000000))
+        catalog = backends.SwestoreCatalog('/ssUppnexZone/proj/a2010002', 60, mock.Mock(
+            return_value=set([run + '.lane1.tar.bz2', run + storage.RUN_MANIFEST_SUFFIX])))
+        config = {'storage': {'data_dirs': [], 'archive_dirs': {'hiseq': self.rootdir},
+                              'irods': {'irodsHome': '/ssUppnexZone/proj/a2010002'}},
+                  'preprocessing': {'status_dir': self.rootdir}}
+        with mock.patch.dict(storage.CONFIG, config), \
+                mock.patch.object(storage.backends, 'swestore_backend', return_value=mock.Mock(catalog=catalog)):
+            plan = storage.cleanup_processing(10, dry_run=True)
+        self.assertEqual([i['path'] for i in plan.items], [os.path.join(self.rootdir, run)])
+
+    def test_cleanup_processing_swestore_error(self):
+        """ Runs should not be removed if swestore cannot be listed """
+        run = '141124_ST-E00201_0001_AFCIDXX'
+        os.makedirs(os.path.join(self.rootdir, run))
+        rta_file = os.path.join(self.rootdir, run, 'RTAComplete.txt')
+        open(rta_file, 'w').close()
+        os.utime(rta_file, (1000000000, 1000000000))
+        catalog = backends.SwestoreCatalog('/ssUppnexZone/proj/a2010002', 60,
+                                           mock.Mock(side_effect=subprocess.CalledProcessError(4, 'ils')))
+        config = {'storage': {'data_dirs': [], 'archive_dirs': {'hiseq': self.rootdir},
+                              'irods': {'irodsHome': '/ssUppnexZone/proj/a2010002'}},
+                  'preprocessing': {'status_dir': self.rootdir}}
+        with mock.patch.dict(storage.CONFIG, config), \
+                mock.patch.object(storage.backends, 'swestore_backend', return_value=mock.Mock(catalog=catalog)):
+            plan = storage.cleanup_processing(10)
+        self.assertEqual(plan.items, [])
+        self.assertTrue(os.path.exists(rta_file))
+
+
+class TestClosedProjects(unittest.TestCase):
+    """ Tests for the close dates of projects in StatusDB """
+
+    def setUp(self):
+        storage._CLOSE_DATES.clear()
+        self.pcon = mock.Mock()
+        self.pcon.db.view.return_value = [
+            mock.Mock(key='A.Closed_15_01', doc={'close_date': '2015-01-01'}),
+            mock.Mock(key='A.Open_15_02', doc={'project_name': 'A.Open_15_02'})]
+
+    def test_get_closed_projects(self):
+        """ All the projects should be looked up in a single request, then cached """
+        projects = ['A.Closed_15_01', 'A.Open_15_02', 'A.Unknown_15_03']
+        self.assertEqual(storage.get_closed_projects(projects, self.pcon, 30), ['A.Closed_15_01'])
+        self.assertEqual(storage.get_closed_projects(projects, self.pcon, 30), ['A.Closed_15_01'])
+        self.pcon.db.view.assert_called_once_with('project/project_name', keys=projects,
+                                                  include_docs=True, reduce=False)
+        self.assertFalse(self.pcon.get_entry.called)
+
+    def test_close_dates_ttl(self):
+        """ Close dates older than the ttl should be fetched again """
+        with mock.patch.dict(storage.CONFIG, {'cleanup': {'close_date_ttl': -1}}):
+            storage._project_close_dates(['A.Closed_15_01'], self.pcon)
+            storage._project_close_dates(['A.Closed_15_01'], self.pcon)
+        self.assertEqual(self.pcon.db.view.call_count, 2)
+
+    def test_close_dates_cache_file(self):
+        """ Close dates should be reused by the next processes through the cache file """
+        rootdir = tempfile.mkdtemp(prefix="test_taca_close_dates")
+        self.addCleanup(shutil.rmtree, rootdir)
+        cache_file = os.path.join(rootdir, 'close_dates.json')
+        projects = ['A.Closed_15_01', 'A.Unknown_15_03']
+        with mock.patch.dict(storage.CONFIG, {'cleanup': {'close_date_cache': cache_file}}):
+            self.assertEqual(storage._project_close_dates(projects, self.pcon),
+                             {'A.Closed_15_01': '2015-01-01'})
+            # As if in a new process
+            storage._CLOSE_DATES.clear()
+            self.assertEqual(storage._project_close_dates(projects, self.pcon),
+                             {'A.Closed_15_01': '2015-01-01'})
+        self.assertEqual(self.pcon.db.view.call_count, 1)
+
+
+class TestSwestoreCleanup(unittest.TestCase):
+    """ Tests for removing expired archives from swestore """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_swestore_cleanup")
+        self.backend = backends.LocalBackend(os.path.join(self.rootdir, 'swestore'))
+        os.makedirs(self.backend.root)
+        self.runs = ['14112{}_ST-E00201_0001_AFCIDXX.tar.bz2'.format(i) for i in range(5)]
+        for run in self.runs[:4]:
+            open(self.backend.path(run), 'w').close()
+        # A directory cannot be removed as a file
+        os.makedirs(self.backend.path(self.runs[4]))
+        self.backend.catalog = mock.Mock(collection=self.backend.root)
+        self.backend.catalog.names.return_value = set(self.runs + ['README'])
+        self.log = os.path.join(self.rootdir, 'deleted.log')
+        self.config = {'cleanup': {'swestore': {'root': self.backend.root, 'days': 30,
+                                                'batch_size': 2, 'workers': 2,
+                                                'deleted_log': self.log}}}
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_cleanup_swestore(self):
+        """ Expired archives should be removed in batches and logged """
+        with mock.patch.dict(storage.CONFIG, self.config), \
+                mock.patch.object(storage.backends, 'swestore_backend', return_value=self.backend):
+            storage.cleanup_swestore(None)
+        self.assertEqual(os.listdir(self.backend.root), [self.runs[4]])
+        with open(self.log) as f:
+            self.assertEqual(sorted(l.split('\t')[0] for l in f), self.runs[:4])
+
+    def test_cleanup_swestore_dry_run(self):
+        """ Nothing should be removed in a dry run """
+        with mock.patch.dict(storage.CONFIG, self.config), \
+                mock.patch.object(storage.backends, 'swestore_backend', return_value=self.backend):
+            plan = storage.cleanup_swestore(None, dry_run=True)
+        self.assertEqual(len(os.listdir(self.backend.root)), 5)
+        self.assertEqual(sorted(i['path'] for i in plan.items), self.runs)
+        self.assertFalse(os.path.exists(self.log))
+
+    @mock.patch.object(backends.misc, 'call_external_command')
+    def test_remove_many_fallback(self, call):
+        """ If a batch fails, objects should be removed one by one to find the failing ones """
+        call.side_effect = [subprocess.CalledProcessError(1, 'irm'), None,
+                            subprocess.CalledProcessError(1, 'irm')]
+        backend = backends.SwestoreBackend('/zone/test_remove_many')
+        with mock.patch.object(backend, 'size', return_value=10):
+            self.assertEqual(backend.remove_many(['a', 'b']), ['b'])
+        self.assertEqual(call.call_args_list[0][0][0],
+                         ['irm', '-f', '/zone/test_remove_many/a', '/zone/test_remove_many/b'])
+        self.assertEqual(call.call_count, 3)
@@ -1,13 +1,18 @@
 """ Unit tests for the utils helper functions """
 
+import fcntl
 import hashlib
+import io
+import json
 import mock
 import os
 import shutil
 import subprocess
 import tempfile
+import threading
 import unittest
-from taca.utils import misc, filesystem, transfer
+from cStringIO import StringIO
+from taca.utils import connections, misc, filesystem, transfer
 
 class TestMisc():  
     """ Test class for the misc functions """
@@ -46,6 +51,19 @@ class TestMisc():
         
     def check_hash(self, alg, exp):
         assert misc.hashfile(self.hashfile,hasher=alg) == exp
+
+    def test_available_memory(self):
+        """ Available memory should be read from /proc/meminfo, in bytes """
+        meminfo = "MemTotal:       16307260 kB\nMemAvailable:    8153630 kB\n"
+        with mock.patch('taca.utils.misc.open', create=True,
+                        side_effect=lambda path: io.BytesIO(meminfo)):
+            assert misc.available_memory() == 8153630 * 1024
+
+    def test_available_memory_unknown(self):
+        """ Without /proc/meminfo (i.e not on Linux) the memory should be unknown """
+        with mock.patch('taca.utils.misc.open', create=True,
+                        side_effect=IOError(2, 'No such file or directory')):
+            assert misc.available_memory() is None
         
 
 class TestFilesystem(unittest.TestCase):
@@ -98,6 +116,307 @@ class TestFilesystem(unittest.TestCase):
                     os.path.join(self.rootdir,"target-non-existing")),
                 "A raised exception was not handled properly")
 
+    def test_rsync_pattern_to_re(self):
+        """ rsync patterns should follow rsync matching rules """
+        by_name = filesystem.rsync_pattern_to_re("*.fastq.gz")
+        self.assertTrue(by_name.search("run/Demultiplexing/P1/S1_R1.fastq.gz"))
+        self.assertFalse(by_name.search("run/Demultiplexing/P1/S1_R1.fastq"))
+        by_path = filesystem.rsync_pattern_to_re("Stats/*")
+        self.assertTrue(by_path.search("run/Demultiplexing/Stats/Stats.json"))
+        self.assertFalse(by_path.search("run/Demultiplexing/Stats/Lane1/Stats.json"))
+        recursive = filesystem.rsync_pattern_to_re("Demultiplexing/**")
+        self.assertTrue(recursive.search("run/Demultiplexing/Stats/Lane1/Stats.json"))
+        anchored = filesystem.rsync_pattern_to_re("/run/*.xml")
+        self.assertTrue(anchored.search("run/RunInfo.xml"))
+        self.assertFalse(anchored.search("other/run/RunInfo.xml"))
+
+    def test_list_files_to_sync(self):
+        """ Only files matching the include patterns should be listed """
+        run = os.path.join(self.rootdir, "run")
+        os.makedirs(os.path.join(run, "Demultiplexing", "P1"))
+        os.makedirs(os.path.join(run, "Data", "Intensities"))
+        for f in ["RunInfo.xml",
+                  os.path.join("Demultiplexing", "P1", "S1_R1.fastq.gz"),
+                  os.path.join("Data", "Intensities", "s_1_1101.bcl")]:
+            with open(os.path.join(run, f), 'w') as fh:
+                fh.write("content")
+        expected = sorted([
+            (os.path.join("run", "RunInfo.xml"), 7),
+            (os.path.join("run", "Demultiplexing", "P1", "S1_R1.fastq.gz"), 7)])
+        files = filesystem.list_files_to_sync(run, ["*/", "*.xml", "*.fastq.gz"])
+        self.assertEqual(expected, sorted(files))
+        # Without scandir, the listing should be the same
+        with mock.patch.object(filesystem, 'scandir', None):
+            files = filesystem.list_files_to_sync(run, ["*/", "*.xml", "*.fastq.gz"])
+        self.assertEqual(expected, sorted(files))
+        # Skipped directories should not be descended into
+        with mock.patch.object(filesystem.os, 'listdir', wraps=os.listdir) as listdir, \
+                mock.patch.object(filesystem, 'scandir', None):
+            files = filesystem.list_files_to_sync(run, ["*"], skip=["Data/Intensities/"])
+        self.assertNotIn(os.path.join(run, "Data", "Intensities"),
+                         [c[0][0] for c in listdir.call_args_list])
+        self.assertEqual(expected, sorted(files))
+
+    def test_split_by_size(self):
+        """ Files should be split in groups of about the same total size """
+        files = [("a", 10), ("b", 6), ("c", 5), ("d", 4), ("e", 1)]
+        groups = filesystem.split_by_size(files, 2)
+        sizes = dict(files)
+        self.assertEqual([12, 14], sorted(sum(sizes[f] for f in g) for g in groups))
+        self.assertEqual([[], [], ["a"]], sorted(filesystem.split_by_size([("a", 1)], 3)))
+
+    def _make_run(self):
+        run = os.path.join(self.rootdir, "src", "run")
+        os.makedirs(os.path.join(run, "Data", "Intensities"))
+        with open(os.path.join(run, "Data", "Intensities", "s_1_1101.bcl"), 'w') as fh:
+            fh.write("bcl content")
+        os.symlink(os.path.join("Data", "Intensities"), os.path.join(run, "link"))
+        os.makedirs(os.path.join(self.rootdir, "dest"))
+        return run, os.path.join(self.rootdir, "dest", "run")
+
+    def test_move_tree_same_device(self):
+        """ On the same filesystem, a tree should simply be renamed """
+        src, dest = self._make_run()
+        with mock.patch.object(filesystem, 'copy_file') as copy_file:
+            filesystem.move_tree(src, dest)
+        self.assertFalse(copy_file.called)
+        self.assertFalse(os.path.exists(src))
+        self.assertTrue(os.path.exists(os.path.join(dest, "Data", "Intensities", "s_1_1101.bcl")))
+
+    def test_move_tree_other_device(self):
+        """ Across filesystems, a tree should be copied, verified and the source removed """
+        src, dest = self._make_run()
+        with mock.patch.object(filesystem, 'same_device', return_value=False):
+            filesystem.move_tree(src, dest, workers=2)
+        self.assertFalse(os.path.exists(src))
+        # The source is deleted in the background
+        filesystem.deletion_queue().wait()
+        trash = os.path.join(os.path.dirname(src), filesystem.TRASH_DIR)
+        self.assertEqual([filesystem.TRASH_PROGRESS], os.listdir(trash))
+        self.assertEqual([filesystem.TRASH_DIR],
+                         [f for f in os.listdir(os.path.dirname(src)) if f.startswith('.')])
+        self.assertEqual([], [f for f in os.listdir(os.path.dirname(dest)) if f.startswith('.')])
+        with open(os.path.join(dest, "Data", "Intensities", "s_1_1101.bcl")) as fh:
+            self.assertEqual("bcl content", fh.read())
+        self.assertEqual(os.path.join("Data", "Intensities"),
+                         os.readlink(os.path.join(dest, "link")))
+
+    def test_move_tree_existing_dest(self):
+        """ An existing destination should never be overwritten """
+        src, dest = self._make_run()
+        os.mkdir(dest)
+        with self.assertRaises(OSError):
+            filesystem.move_tree(src, dest)
+        self.assertTrue(os.path.exists(src))
+
+    def test_control_fastq_filename(self):
+        """ Hyphens in sample names should be replaced, listing only changed directories """
+        demux = os.path.join(self.rootdir, "run", "Demultiplexing")
+        sample = os.path.join(demux, "P1", "Sample_P1-101")
+        os.makedirs(sample)
+        open(os.path.join(sample, "P1-101_S1_L001_R1_001.fastq.gz"), 'w').close()
+        filesystem.control_fastq_filename(demux)
+        self.assertEqual(["P1_101_S1_L001_R1_001.fastq.gz"], os.listdir(sample))
+        # Pretend nothing changed for a while, the next pass records the mtimes
+        for d in [demux, os.path.join(demux, "P1"), sample]:
+            os.utime(d, (1000000000, 1000000000))
+        filesystem.control_fastq_filename(demux)
+        with mock.patch.object(filesystem, '_list_dir', wraps=filesystem._list_dir) as list_dir:
+            filesystem.control_fastq_filename(demux)
+            self.assertFalse(list_dir.called)
+            open(os.path.join(sample, "P1-101_S1_L002_R1_001.fastq.gz"), 'w').close()
+            filesystem.control_fastq_filename(demux)
+            self.assertEqual([sample], [c[0][0] for c in list_dir.call_args_list])
+        self.assertEqual(
+            ["P1_101_S1_L001_R1_001.fastq.gz", "P1_101_S1_L002_R1_001.fastq.gz"],
+            sorted(os.listdir(sample)))
+        with open(os.path.join(self.rootdir, "run", ".Demultiplexing_renames.json")) as f:
+            self.assertEqual(2, len(json.load(f)['renamed']))
+
+    def test_control_fastq_filename_removed_dir(self):
+        """ Directories removed while being listed should be skipped """
+        demux = os.path.join(self.rootdir, "run", "Demultiplexing")
+        for project in ["P1", "P2"]:
+            sample = os.path.join(demux, project, "Sample_{}-101".format(project))
+            os.makedirs(sample)
+            open(os.path.join(sample, "{}-101_S1_L001_R1_001.fastq.gz".format(project)), 'w').close()
+        list_dir = filesystem._list_dir
+        def _list_dir(path):
+            if os.path.basename(path) == "P2":
+                shutil.rmtree(path)
+            return list_dir(path)
+        with mock.patch.object(filesystem, '_list_dir', side_effect=_list_dir):
+            filesystem.control_fastq_filename(demux)
+        self.assertEqual(["P1_101_S1_L001_R1_001.fastq.gz"],
+                         os.listdir(os.path.join(demux, "P1", "Sample_P1-101")))
+        with open(os.path.join(self.rootdir, "run", ".Demultiplexing_renames.json")) as f:
+            self.assertNotIn("P2", json.load(f)['dirs'])
+
+    def test_tree_usage(self):
+        """ Disk usage should cover every file and directory of a tree """
+        src, _ = self._make_run()
+        used, inodes = filesystem.tree_usage(src, workers=2)
+        self.assertEqual(5, inodes)
+        self.assertEqual(int(subprocess.check_output(['du', '-s', '-B1', src]).split()[0]), used)
+        with mock.patch.object(filesystem, 'scandir', None):
+            self.assertEqual((used, inodes), filesystem.tree_usage(src))
+
+    def test_tree_usage_cache(self):
+        """ Unchanged directories should not be listed again """
+        src, _ = self._make_run()
+        for d in [src, os.path.join(src, "Data"), os.path.join(src, "Data", "Intensities")]:
+            os.utime(d, (1000000000, 1000000000))
+        cache = {}
+        usage = filesystem.tree_usage(src, cache=cache)
+        self.assertEqual(3, len(cache))
+        with mock.patch.object(filesystem, '_list_usage') as list_usage:
+            self.assertEqual(usage, filesystem.tree_usage(src, cache=cache))
+        self.assertFalse(list_usage.called)
+
+    def test_deletion_queue(self):
+        """ A tree should leave its place at once and be deleted in the background """
+        src, _ = self._make_run()
+        queue = filesystem.DeletionQueue(workers=2)
+        target = queue.delete(src)
+        self.assertFalse(os.path.exists(src))
+        self.assertEqual(os.path.join(os.path.dirname(src), filesystem.TRASH_DIR), os.path.dirname(target))
+        queue.wait()
+        self.assertFalse(os.path.exists(target))
+        with open(os.path.join(os.path.dirname(target), filesystem.TRASH_PROGRESS)) as f:
+            self.assertEqual({}, json.load(f))
+
+    def test_deletion_queue_resume(self):
+        """ Trees left in a trash by an earlier process should be deleted too """
+        trash = os.path.join(self.rootdir, "trash")
+        os.makedirs(os.path.join(trash, "old_run", "Data"))
+        open(os.path.join(trash, "old_run", "Data", "file"), 'w').close()
+        src, _ = self._make_run()
+        queue = filesystem.DeletionQueue(workers=2, trash_dirs=[trash])
+        queue.delete(src)
+        queue.wait()
+        self.assertEqual([filesystem.TRASH_PROGRESS], os.listdir(trash))
+
+    def test_deletion_queue_error(self):
+        """ An error deleting a tree should leave it in the trash and go on with the next ones """
+        trash = os.path.join(self.rootdir, "trash")
+        os.makedirs(os.path.join(trash, "old_run"))
+        src, _ = self._make_run()
+        queue = filesystem.DeletionQueue(workers=2, trash_dirs=[trash])
+        save_progress = queue._save_progress
+        def _save_progress(target, removed):
+            if os.path.basename(target) == "old_run":
+                raise IOError(28, 'No space left on device')
+            save_progress(target, removed)
+        with mock.patch.object(queue, '_save_progress', side_effect=_save_progress):
+            target = queue.delete(src)
+            waiting = threading.Thread(target=queue.wait)
+            waiting.daemon = True
+            waiting.start()
+            waiting.join(10)
+        self.assertFalse(waiting.is_alive())
+        self.assertFalse(os.path.exists(target))
+        self.assertTrue(os.path.exists(os.path.join(trash, "old_run")))
+
+    def test_deletion_queue_locked(self):
+        """ Trees locked by another process should be left to it """
+        trash = os.path.join(self.rootdir, "trash")
+        os.makedirs(os.path.join(trash, "other_run.1.1"))
+        fd = os.open(os.path.join(trash, "other_run.1.1"), os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            src, _ = self._make_run()
+            queue = filesystem.DeletionQueue(workers=2, trash_dirs=[trash])
+            queue.delete(src)
+            queue.wait()
+            self.assertEqual(sorted([filesystem.TRASH_PROGRESS, "other_run.1.1"]),
+                             sorted(os.listdir(trash)))
+        finally:
+            os.close(fd)
+
+class TestConnections(unittest.TestCase):
+    """ Test class for the pooled connections """
+
+    def tearDown(self):
+        connections.reset()
+
+    def test_session_is_reused(self):
+        """ The same named session should be handed out on every call """
+        self.assertIs(
+            connections.get_session('test'),
+            connections.get_session('test'))
+        self.assertIsNot(
+            connections.get_session('test'),
+            connections.get_session('other'))
+
+    def test_session_settings(self):
+        """ Timeout and retries should be taken from the configuration """
+        with mock.patch.dict(
+            connections.CONFIG,
+            {'connections': {'timeout': 5, 'retries': 7}}):
+            adapter = connections.get_session('test').get_adapter('http://localhost')
+        self.assertEqual(5, adapter.timeout)
+        self.assertEqual(7, adapter.max_retries.total)
+
+class TestTransferGovernor(unittest.TestCase):
+    """ Test class for the TransferGovernor class """
+
+    def setUp(self):
+        self.lockdir = tempfile.mkdtemp(prefix="test_taca_governor")
+
+    def tearDown(self):
+        shutil.rmtree(self.lockdir)
+
+    def test_governor_disabled(self):
+        """ Without limits, a slot should be given right away and without bandwidth limit """
+        with transfer.TransferGovernor(lock_dir=self.lockdir).slot() as bwlimit:
+            self.assertIsNone(bwlimit)
+        self.assertEqual([], os.listdir(self.lockdir))
+
+    def test_governor_bandwidth_share(self):
+        """ The bandwidth budget should be shared by priority among the transfers running """
+        governor = transfer.TransferGovernor(lock_dir=self.lockdir, bandwidth=900, max_transfers=4)
+        with governor.slot('archive') as archive_bw:
+            # Alone on the link
+            self.assertEqual(900, archive_bw)
+            with governor.slot('analysis') as analysis_bw:
+                self.assertEqual(675, analysis_bw)
+                self.assertEqual([1, 3], sorted(governor.active_weights()))
+                # Once the archive takes its share again, the budget is respected
+                self.assertEqual(900, governor.share('archive') + analysis_bw)
+        self.assertEqual([], governor.active_weights())
+
+    def test_governor_reserved_slots(self):
+        """ Lower priority transfers should not use the reserved slots """
+        governor = transfer.TransferGovernor(
+            lock_dir=self.lockdir, max_transfers=2, reserved=1)
+        with governor.slot('restore'):
+            self.assertIsNone(governor._acquire(1, False))
+            fh = governor._acquire(3, True)
+            self.assertIsNotNone(fh)
+            self.assertIsNone(governor._acquire(3, True))
+            fh.close()
+
+    @mock.patch('taca.utils.transfer.time')
+    def test_throttled_reader(self, mock_time):
+        """ Reads faster than the limit should be slowed down """
+        mock_time.time.return_value = 100.0
+        reader = transfer.ThrottledReader(StringIO('x' * 4096), 2)
+        self.assertEqual(len(reader.read(2048)), 2048)
+        mock_time.sleep.assert_called_once_with(1.0)
+
+    @mock.patch('taca.utils.transfer.time')
+    def test_throttled_reader_refresh(self, mock_time):
+        """ The limit should be taken again once the refresh interval has passed """
+        mock_time.time.return_value = 100.0
+        refresh = mock.Mock(return_value=1)
+        reader = transfer.ThrottledReader(StringIO('x' * 4096), 4, refresh=refresh, refresh_interval=30)
+        reader.read(1024)
+        self.assertFalse(refresh.called)
+        mock_time.time.return_value = 130.0
+        reader.read(2048)
+        refresh.assert_called_once_with()
+        mock_time.sleep.assert_called_with(2.0)
+
 class TestTransferAgent(unittest.TestCase):
     """ Test class for the TransferAgent class """
 